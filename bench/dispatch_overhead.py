@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures the per call overhead of finding and calling an on_* method.
+
+Compares the getattr based lookup on_message used to do on every message
+with the precomputed dispatch table.
+
+Example::
+
+    python bench/dispatch_overhead.py --number 200000
+"""
+
+import argparse
+import timeit
+
+from commissaire_service.service import CommissaireService
+
+
+class BenchService(CommissaireService):
+    """
+    Service exposing a storage.get like method which does no work.
+    """
+
+    def on_get(self, message, model_type_name, model_json_data):
+        return model_json_data
+
+
+class BenchMessage:
+    """
+    Just enough of a kombu.message.Message for dispatching.
+    """
+    delivery_info = {'routing_key': 'storage.get'}
+    properties = {}
+
+
+def getattr_dispatch(service, body, message):
+    """
+    The lookup and call on_message did before the dispatch table.
+    """
+    method = getattr(service, 'on_{}'.format(body['method']))
+    if type(body.setdefault('params', {})) is dict:
+        return method(message=message, **body['params'])
+    return method(message, *body['params'])
+
+
+def table_dispatch(service, body, message):
+    """
+    The lookup and call through the dispatch table.
+    """
+    binder = service._dispatch[body['method']]
+    args, kwargs = binder.bind(message, body.get('params', {}))
+    return binder.method(*args, **kwargs)
+
+
+def main():
+    """
+    Main entry point.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    service = BenchService('commissaire', 'memory://', [])
+    message = BenchMessage()
+    bodies = {
+        'dict params': {
+            'jsonrpc': '2.0', 'id': 1, 'method': 'get',
+            'params': {
+                'model_type_name': 'Host',
+                'model_json_data': {'address': '127.0.0.1'}}},
+        'list params': {
+            'jsonrpc': '2.0', 'id': 1, 'method': 'get',
+            'params': ['Host', {'address': '127.0.0.1'}]},
+    }
+
+    for label, body in sorted(bodies.items()):
+        for name, fn in (('getattr', getattr_dispatch),
+                         ('table', table_dispatch)):
+            seconds = min(timeit.repeat(
+                lambda: fn(service, body, message),
+                number=args.number, repeat=5))
+            print('{:>12} {:>8}: {:8.3f} us/call'.format(
+                label, name, seconds / args.number * 1e6))
+        seconds = min(timeit.repeat(
+            lambda: service._prepare_call(body, message, {}),
+            number=args.number, repeat=5))
+        print('{:>12} {:>8}: {:8.3f} us/call'.format(
+            label, 'prepare', seconds / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
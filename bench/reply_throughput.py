@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compares reply throughput of a SimpleQueue per reply against the
+long lived ReplyPublisher.
+
+Example::
+
+    python bench/reply_throughput.py --count 5000
+    python bench/reply_throughput.py --bus-uri redis://127.0.0.1:6379/
+"""
+
+import argparse
+import json
+import time
+
+from kombu import Connection
+
+from commissaire_service.service.replies import (
+    REPLY_ROUTES, ReplyPublisher)
+
+
+def simplequeue_reply(connection, body, reply_to):
+    """
+    Replies the way CommissaireService used to: one SimpleQueue per reply.
+    """
+    response_queue = connection.SimpleQueue(reply_to)
+    response_queue.put(body)
+    response_queue.close()
+
+
+def run(connection, label, count, reply_fn):
+    """
+    Sends count replies to count distinct reply queues using reply_fn.
+
+    :returns: Replies per second
+    :rtype: float
+    """
+    names = ['response-{}-{}'.format(label, x) for x in range(count)]
+    queues = [connection.SimpleQueue(
+        name, queue_opts={'auto_delete': True, 'durable': False})
+        for name in names]
+    body = json.dumps({'jsonrpc': '2.0', 'id': 1, 'result': {'ok': True}})
+
+    start = time.perf_counter()
+    for name in names:
+        reply_fn(body, name)
+    elapsed = time.perf_counter() - start
+
+    for queue in queues:
+        queue.get(timeout=5).ack()
+        queue.close()
+    return count / elapsed
+
+
+def main():
+    """
+    Main entry point.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bus-uri', default='memory://')
+    parser.add_argument('--count', type=int, default=2000)
+    args = parser.parse_args()
+
+    with Connection(args.bus_uri) as connection:
+        rate = run(connection, 'simplequeue', args.count,
+                   lambda body, name: simplequeue_reply(
+                       connection, body, name))
+        print('{:>24}: {:10.1f} replies/s'.format('SimpleQueue', rate))
+
+        for route in REPLY_ROUTES:
+            publisher = ReplyPublisher(
+                connection.channel(), route=route, cache_size=args.count)
+            rate = run(connection, route, args.count, publisher.publish)
+            print('{:>24}: {:10.1f} replies/s'.format(
+                'ReplyPublisher/' + route, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Runs a real service over the in process memory:// transport and drives it
+with a mix of requests, reporting throughput, p50/p99 latency and CPU per
+request. No broker is needed. StorageService keeps its models in
+commissaire_service.storage.memory and ContainerManagerService talks to a
+container manager which answers right away.
+
+The service and the clients share the process, so the CPU per request
+includes the clients. wordy_add calls add on the same service, so it needs
+more --max-workers than --concurrency.
+
+Example::
+
+    python bench/service_bench.py --service simple --count 5000
+    python bench/service_bench.py --service storage --mix get=8,list=1,save=1
+    python bench/service_bench.py --service containermgr \\
+        --mix get_node_status=8,node_registered=2 --max-workers 4
+    python bench/service_bench.py --mix add=3,wordy_add=1 --max-workers 4 \\
+        --concurrency 2
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+from commissaire_service.service import CommissaireService
+
+#: Name of the container manager registered for the benchmark
+MANAGER_NAME = 'bench'
+
+
+def simple_service(exchange_name, bus_uri, config_file):
+    """
+    Creates the SimpleService from the examples.
+    """
+    sys.path.insert(0, os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'example'))
+    from simpleservice import SimpleService
+    # The example logs every call at DEBUG
+    logging.getLogger('SimpleService').setLevel(logging.WARNING)
+    return SimpleService(
+        exchange_name, bus_uri,
+        [{'name': 'simple', 'routing_key': 'simple.*'}],
+        config_file=config_file)
+
+
+def storage_service(exchange_name, bus_uri, config_file):
+    """
+    Creates a StorageService storing every model in memory.
+    """
+    from commissaire_service.storage import StorageService
+    return StorageService(exchange_name, bus_uri, config_file=config_file)
+
+
+def containermgr_service(exchange_name, bus_uri, config_file):
+    """
+    Creates a ContainerManagerService with an in memory container manager.
+    """
+    from commissaire.containermgr import ContainerManagerBase
+    from commissaire_service.containermgr import ContainerManagerService
+
+    class BenchContainerManager(ContainerManagerBase):
+        """
+        Container manager which knows every node and answers right away.
+        """
+
+        def node_registered(self, address):
+            return True
+
+        def register_node(self, address):
+            return True
+
+        def remove_node(self, address):
+            return True
+
+        def remove_all_nodes(self):
+            return True
+
+        def get_node_status(self, address, raw=False):
+            return {'address': address, 'status': 'ok'}
+
+    service = ContainerManagerService(
+        exchange_name, bus_uri, config_file=config_file)
+    service.managers[MANAGER_NAME] = BenchContainerManager({})
+    return service
+
+
+def _host(n):
+    return {'address': '192.168.{}.{}'.format(n // 250, n % 250 + 1)}
+
+
+#: Per service: (factory, default mix, operations, seed operation).
+#: Operations map a name to a function of a number returning
+#: (routing_key, method, params).
+SERVICES = {
+    'simple': (simple_service, 'add=1', {
+        'add': lambda n: ('simple.add', 'add', [n, n]),
+        'wordy_add': lambda n: ('simple.wordy_add', 'wordy_add', [n, n]),
+    }, None),
+    'storage': (storage_service, 'get=8,list=1,save=1', {
+        'get': lambda n: ('storage.get', 'get', {
+            'model_type_name': 'Host', 'model_json_data': _host(n)}),
+        'list': lambda n: ('storage.list', 'list', {
+            'model_type_name': 'Hosts'}),
+        'save': lambda n: ('storage.save', 'save', {
+            'model_type_name': 'Host', 'model_json_data': _host(n)}),
+    }, 'save'),
+    'containermgr': (containermgr_service, 'get_node_status=8', {
+        'get_node_status': lambda n: (
+            'container.get_node_status', 'get_node_status', {
+                'container_manager_name': MANAGER_NAME,
+                'address': _host(n)['address']}),
+        'node_registered': lambda n: (
+            'container.node_registered', 'node_registered', {
+                'container_manager_name': MANAGER_NAME,
+                'address': _host(n)['address']}),
+    }, None),
+}
+
+
+def parse_mix(mix, operations):
+    """
+    Parses a mix such as "get=8,list=1" into a weighted list of names.
+
+    :raises: ValueError
+    """
+    weighted = []
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in operations:
+            raise ValueError('Unknown operation "{}". Choose from {}'.format(
+                name, ', '.join(sorted(operations))))
+        weighted.extend([name] * int(weight or 1))
+    return weighted
+
+
+def percentile(samples, fraction):
+    """
+    Returns the sample below which the given fraction of samples fall.
+    """
+    if not samples:
+        return 0.0
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def cpu_time():
+    """
+    Returns the user plus system CPU seconds used by the process.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def drive(client, plan, operations, latencies, errors):
+    """
+    Sends the planned (operation, number) requests one after the other.
+    """
+    for name, n in plan:
+        routing_key, method, params = operations[name](n)
+        start = time.perf_counter()
+        try:
+            client.request(routing_key, method, params=params)
+        except Exception:
+            errors[name] = errors.get(name, 0) + 1
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+
+def main():
+    """
+    Main entry point.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bus-uri', default='memory://')
+    parser.add_argument('--exchange', default='commissaire')
+    parser.add_argument(
+        '--service', choices=sorted(SERVICES), default='simple')
+    parser.add_argument(
+        '--mix', help='Weighted operations, for example "get=8,list=1"')
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--keys', type=int, default=100,
+                        help='Distinct hosts or numbers requested')
+    parser.add_argument('--max-workers', type=int, default=0)
+    parser.add_argument('--polling-interval', type=float, default=0.001)
+    args = parser.parse_args()
+
+    factory, mix, operations, seed = SERVICES[args.service]
+    weighted = parse_mix(args.mix or mix, operations)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.conf') as config:
+        json.dump({
+            'max_workers': args.max_workers,
+            'transport_options': {'polling_interval': args.polling_interval},
+            'storage_handlers': [
+                {'type': 'commissaire_service.storage.memory'}],
+        }, config)
+        config.flush()
+
+        service = factory(args.exchange, args.bus_uri, config.name)
+        server = threading.Thread(target=service.run, daemon=True)
+        server.start()
+        while not service._consumers:
+            time.sleep(0.01)
+
+        clients = [
+            CommissaireService(
+                args.exchange, args.bus_uri, [], config_file=config.name)
+            for _ in range(args.concurrency)]
+        if seed:
+            drive(clients[0], [(seed, n) for n in range(args.keys)],
+                  operations, {}, {})
+
+        plans = [[] for _ in clients]
+        for n in range(args.count):
+            plans[n % len(clients)].append(
+                (random.choice(weighted), random.randrange(args.keys)))
+        results = [({}, {}) for _ in clients]
+        threads = [
+            threading.Thread(target=drive, args=(
+                client, plan, operations, latencies, errors))
+            for client, plan, (latencies, errors)
+            in zip(clients, plans, results)]
+
+        cpu = cpu_time()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        cpu = cpu_time() - cpu
+
+        service.should_stop = True
+        server.join(5)
+
+    print('{:>24}: {:10.1f} requests/s'.format(
+        'throughput', args.count / elapsed))
+    print('{:>24}: {:10.1f} us'.format(
+        'CPU per request', cpu / args.count * 1e6))
+    for name in sorted(operations):
+        latencies = sum([r[0].get(name, []) for r in results], [])
+        if not latencies:
+            continue
+        print('{:>24}: {:10.2f} ms p50 {:10.2f} ms p99 {:6d} errors'.format(
+            name, percentile(latencies, 0.5) * 1e3,
+            percentile(latencies, 0.99) * 1e3,
+            sum(r[1].get(name, 0) for r in results)))
+
+
+if __name__ == '__main__':
+    main()
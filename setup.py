@@ -57,6 +57,10 @@ setup(
 
     install_requires=install_requires,
     tests_require=test_require,
+    extras_require={
+        # Replies in msgpack for callers which ask for them
+        'msgpack': ['msgpack'],
+    },
     package_dir={'': 'src'},
     packages=find_packages('src'),
     package_data={
@@ -74,6 +78,8 @@ setup(
              'commissaire_service.investigator:main'),
             ('commissaire-watcher-service = '
              'commissaire_service.watcher:main'),
+            ('commissaire-service-host = '
+             'commissaire_service.service.host:main'),
 
         ],
     }
@@ -13,18 +13,17 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
-
 from commissaire import constants as C
 from commissaire.models import (
-    ClusterDeploy, ClusterUpgrade, ClusterRestart, HostCreds)
+    ClusterDeploy, ClusterUpgrade, ClusterRestart, Host, HostCreds)
 from commissaire.storage.client import StorageClient
 from commissaire.util.date import formatted_dt
 from commissaire.util.ssh import TemporarySSHKey
 
 from commissaire_service.oscmd import get_oscmd
 from commissaire_service.service import (
-    CommissaireService, add_service_arguments)
+    CommissaireService, add_scaling_arguments, add_service_arguments,
+    run_scaled_service)
 from commissaire_service.transport import ansibleapi
 
 
@@ -36,7 +35,13 @@ class ClusterExecService(CommissaireService):
     #: Default configuration file
     _default_config_file = '/etc/commissaire/clusterexec.conf'
 
-    def __init__(self, exchange_name, connection_url, config_file=None):
+    #: Queues shared by every process of the service
+    _queue_kwargs = [
+        {'name': 'clusterexec', 'routing_key': 'jobs.clusterexec.*'},
+    ]
+
+    def __init__(self, exchange_name, connection_url, config_file=None,
+                 qkwargs=None):
         """
         Creates a new ClusterExecService.  If config_file is omitted,
         it will try the default location (/etc/commissaire/clusterexec.conf).
@@ -47,15 +52,13 @@ class ClusterExecService(CommissaireService):
         :type connection_url: str
         :param config_file: Optional configuration file path
         :type config_file: str or None
+        :param qkwargs: Queues to consume, defaults to _queue_kwargs
+        :type qkwargs: list or None
         """
-        queue_kwargs = [
-            {'routing_key': 'jobs.clusterexec.*'}
-        ]
-
         super().__init__(
             exchange_name,
             connection_url,
-            queue_kwargs,
+            qkwargs or self._queue_kwargs,
             config_file=config_file)
 
         self.storage = StorageClient(self)
@@ -96,16 +99,13 @@ class ClusterExecService(CommissaireService):
 
             # Respond to the caller with the initial status.
             if message.properties.get('reply_to'):
-                # XXX Have to dig up the message ID again.
-                #     CommissaireService.on_message() already
-                #     does this, but doesn't pass it to us.
-                body = message.body
-                if isinstance(body, bytes):
-                    body = json.loads(body.decode())
+                # CommissaireService.on_message() keeps the decoded
+                # request on the message.
                 self.respond(
                     message.properties['reply_to'],
-                    body.get('id', -1),
-                    model_json_data)
+                    message.jsonrpc_request.get('id', -1),
+                    model_json_data,
+                    message=message)
         except Exception as error:
             self.logger.error(
                 'Unable to save initial state for "{}" clusterexec due to '
@@ -124,9 +124,9 @@ class ClusterExecService(CommissaireService):
             self.logger.warn('No hosts in cluster "{}"'.format(cluster_name))
 
         for address in cluster.hostset:
-            # Get initial data
-            host = self.storage.get_host(address)
-            host_creds = self.storage.get(HostCreds.new(address=host.address))
+            # Get the host and its credentials in one round trip
+            host, host_creds = self.get_models(
+                Host.new(address=address), HostCreds.new(address=address))
             oscmd = get_oscmd(host.os)
 
             # os_command is only used for logging
@@ -253,15 +253,12 @@ def main():  # pragma: no cover
 
     parser = argparse.ArgumentParser()
     add_service_arguments(parser)
+    add_scaling_arguments(parser)
 
     args = parser.parse_args()
 
     try:
-        service = ClusterExecService(
-            exchange_name=args.bus_exchange,
-            connection_url=args.bus_uri,
-            config_file=args.config_file)
-        service.run()
+        run_scaled_service(ClusterExecService, args)
     except KeyboardInterrupt:
         pass
 
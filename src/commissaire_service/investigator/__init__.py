@@ -13,8 +13,6 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
-
 import commissaire.constants as C
 
 from commissaire.models import Cluster, Host, HostCreds, Network
@@ -25,7 +23,8 @@ from commissaire.util.ssh import TemporarySSHKey
 
 from commissaire_service.oscmd import get_oscmd
 from commissaire_service.service import (
-    CommissaireService, add_service_arguments)
+    CommissaireService, add_scaling_arguments, add_service_arguments,
+    run_scaled_service)
 from commissaire_service.transport import ansibleapi
 
 
@@ -37,7 +36,15 @@ class InvestigatorService(CommissaireService):
     #: Default configuration file
     _default_config_file = '/etc/commissaire/investigator.conf'
 
-    def __init__(self, exchange_name, connection_url, config_file=None):
+    #: Queues shared by every process of the service
+    _queue_kwargs = [
+        {'name': 'investigator', 'routing_key': 'jobs.investigate'},
+        # jobs.investigate.ping and the other built-in methods
+        {'name': 'investigator.health', 'routing_key': 'jobs.investigate.*'},
+    ]
+
+    def __init__(self, exchange_name, connection_url, config_file=None,
+                 qkwargs=None):
         """
         Creates a new InvestigatorService.  If config_file is omitted,
         it will try the default location (/etc/commissaire/investigator.conf).
@@ -48,15 +55,13 @@ class InvestigatorService(CommissaireService):
         :type connection_url: str
         :param config_file: Optional configuration file path
         :type config_file: str or None
+        :param qkwargs: Queues to consume, defaults to _queue_kwargs
+        :type qkwargs: list or None
         """
-        queue_kwargs = [
-            {'routing_key': 'jobs.investigate'}
-        ]
-
         super().__init__(
             exchange_name,
             connection_url,
-            queue_kwargs,
+            qkwargs or self._queue_kwargs,
             config_file=config_file)
 
         self.storage = StorageClient(self)
@@ -115,8 +120,9 @@ class InvestigatorService(CommissaireService):
         if cluster_data:
             self.logger.debug('Related cluster: {}'.format(cluster_data))
 
-        host = self.storage.get_host(address)
-        host_creds = self.storage.get(HostCreds.new(address=host.address))
+        # Get the host and its credentials in one round trip
+        host, host_creds = self.get_models(
+            Host.new(address=address), HostCreds.new(address=address))
         transport = ansibleapi.Transport(host.remote_user)
 
         key = TemporarySSHKey(host_creds, self.logger)
@@ -131,7 +137,7 @@ class InvestigatorService(CommissaireService):
         try:
             facts = transport.get_info(address, key.path)
             # recreate the host instance with new data
-            data = json.loads(host.to_json())
+            data = host.to_dict()
             data.update(facts)
             host = Host.new(**data)
             host.last_check = formatted_dt()
@@ -227,15 +233,12 @@ def main():  # pragma: no cover
 
     parser = argparse.ArgumentParser()
     add_service_arguments(parser)
+    add_scaling_arguments(parser)
 
     args = parser.parse_args()
 
     try:
-        service = InvestigatorService(
-            exchange_name=args.bus_exchange,
-            connection_url=args.bus_uri,
-            config_file=args.config_file)
-        service.run()
+        run_scaled_service(InvestigatorService, args)
     except KeyboardInterrupt:
         pass
 
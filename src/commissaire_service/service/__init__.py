@@ -1,4 +1,3 @@
-
 # Copyright (C) 2016  Red Hat, Inc
 #
 # This program is free software: you can redistribute it and/or modify
@@ -16,20 +15,69 @@
 """
 Service base class.
 """
-import json
+import contextlib
+import functools
 import logging
 import multiprocessing
-import traceback
+import multiprocessing.connection
+import os
+import signal
+import sys
+import threading
+import uuid
 
-from time import sleep
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, time
 
 from commissaire import constants as C
 from commissaire.bus import BusMixin, RemoteProcedureCallError
 from commissaire.util.config import read_config_file
 
-from kombu import Connection, Exchange, Producer, Queue
+from kombu import Connection, Consumer, Exchange, Producer, Queue
 from kombu.mixins import ConsumerMixin
 
+from . import codec
+from .batch import (
+    BatchElementMessage, batch_reply, check_batch, check_element,
+    is_notification)
+from .autoscale import Autoscaler, QueueBacklog
+from .caching import cacheable, install_result_caches  # noqa: F401
+from .deadlines import (
+    DeadlineContext, DeadlineExceededError, deadline_headers, read_deadline,
+    time_remaining)
+from .dispatch import (
+    JSONRPC_INVALID_PARAMS, InvalidParamsError, MethodBinder,
+    build_dispatch_table)
+from .errors import rebuild_error
+from .health import Heartbeat, config_digest
+from .idempotency import IN_PROGRESS, build_response_cache
+from .isolation import (
+    build_isolation_pools, isolated_routing_key, isolation_routing_keys)
+from .limits import (
+    JSONRPC_SERVICE_BUSY, ServiceBusyError, build_in_flight_limits,
+    retry_after)
+from .lanes import (
+    QUEUE_ORDER_STRATEGY, LaneCycle, PendingWork, lane_of, lane_queues,
+    lane_routing_key, parse_lanes)
+from .logs import ExceptionLogger, log_event
+from .metrics import MetricsServer, ServiceMetrics
+from .pools import BusPool
+from .replies import REPLY_ROUTE_DEFAULT, ReplyPublisher
+from .tracing import (
+    KIND_CLIENT, KIND_SERVER, build_tracer, read_trace, trace_headers)
+
+#: Metrics label for messages which did not resolve to a bus method.
+METHOD_UNKNOWN = 'unknown'
+
+#: Built-in methods answered on the consumer thread, ahead of other work
+#: and without counting against in flight limits.
+HEALTH_METHODS = frozenset(['ping', 'introspect'])
+
+#: on_* attributes which are consumer callbacks rather than bus methods.
+RESERVED_HANDLERS = frozenset(
+    [x for x in dir(ConsumerMixin) if x.startswith('on_')] + ['on_message'])
+
 
 def add_service_arguments(parser):
     """
@@ -57,7 +105,58 @@ def add_service_arguments(parser):
             'http://kombu.readthedocs.io/en/latest/userguide/connections.html'))  # noqa
 
 
-def run_service(service_class, kwargs):
+def add_scaling_arguments(parser):
+    """
+    Adds command-line arguments to run a service in several processes.
+
+    These include:
+
+        --processes      (int, default 1)
+        --max-processes  (int, no default)
+
+    :param parser: An argument parser instance
+    :type parser: argparse.ArgumentParser
+    """
+    parser.add_argument(
+        '--processes', type=int, default=1,
+        help='Number of processes to run, the minimum when autoscaling.')
+    parser.add_argument(
+        '--max-processes', type=int,
+        help='Scale up to this many processes as the queues back up.')
+
+
+def run_scaled_service(service_class, args):
+    """
+    Runs a service from its command-line arguments. A single process runs
+    the service directly, otherwise a ServiceManager runs the processes
+    and scales them when --max-processes is given. The service class must
+    list its queues in _queue_kwargs and accept them as qkwargs.
+
+    :param service_class: The CommissaireService class to run.
+    :type service_class: class
+    :param args: Parsed arguments, see add_service_arguments and
+                 add_scaling_arguments.
+    :type args: argparse.Namespace
+    """
+    if args.processes == 1 and args.max_processes is None:
+        service_class(
+            exchange_name=args.bus_exchange,
+            connection_url=args.bus_uri,
+            config_file=args.config_file).run()
+        return
+    autoscaler = None
+    if args.max_processes is not None:
+        autoscaler = Autoscaler(args.processes, args.max_processes)
+    config = read_config_file(
+        args.config_file, service_class._default_config_file)
+    ServiceManager(
+        service_class, args.processes, args.bus_exchange, args.bus_uri,
+        service_class._queue_kwargs, autoscaler=autoscaler,
+        lanes=config.get('priority_lanes'),
+        config_file=args.config_file).run()
+
+
+def run_service(service_class, kwargs, heartbeat=None, worker_index=None):
     """
     Creates a service instance and executes it's run method.
 
@@ -65,18 +164,129 @@ def run_service(service_class, kwargs):
     :type service_cls: class
     :param kwargs: Other keyword arguments to pass to service initializer.
     :type kwargs: dict
+    :param heartbeat: Beaten by the consumer loop of the service.
+    :type heartbeat: commissaire_service.service.health.Heartbeat or None
+    :param worker_index: Slot of the process in its ServiceManager.
+    :type worker_index: int or None
     """
+    # Drop the handlers inherited from a ServiceManager
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
     service = service_class(**kwargs)
+    service._heartbeat = heartbeat
+    service._worker_index = worker_index
     service.run()
 
 
+class WorkerState:
+    """
+    Book keeping for one process run by the ServiceManager.
+    """
+
+    def __init__(self, index):
+        """
+        Initializes a new WorkerState instance.
+
+        :param index: Slot of the worker in the ServiceManager.
+        :type index: int
+        """
+        self.index = index
+        #: The current multiprocessing.Process or None
+        self.process = None
+        #: When (monotonic) the current process was started
+        self.started_at = None
+        #: How many times the worker has been restarted
+        self.restarts = 0
+        #: How many times in a row the worker exited too early
+        self.failures = 0
+        #: When (monotonic) the worker should be started again or None
+        self.restart_at = None
+        #: Exit code of the last process
+        self.exitcode = None
+        #: True once the worker has been asked to stop for good
+        self.retiring = False
+        #: Beaten by the current process when hangs are detected, or None
+        self.heartbeat = None
+        #: How many processes of the worker were killed for hanging
+        self.hangs = 0
+
+    @property
+    def pid(self):
+        """
+        The process id of the current process or None.
+        """
+        return self.process.pid if self.process is not None else None
+
+    @property
+    def alive(self):
+        """
+        True if the current process is running.
+        """
+        return self.process is not None and self.process.is_alive()
+
+    def to_dict(self):
+        """
+        Returns the worker state as a dict.
+
+        :returns: The index, pid, uptime, restarts and last exit code.
+        :rtype: dict
+        """
+        now = monotonic()
+        alive = self.alive
+        return {
+            'index': self.index,
+            'pid': self.pid,
+            'alive': alive,
+            'uptime': (now - self.started_at) if alive else 0.0,
+            'restarts': self.restarts,
+            'exitcode': self.exitcode,
+            'retiring': self.retiring,
+            'hangs': self.hangs,
+            'restart_in': (
+                max(self.restart_at - now, 0.0)
+                if self.restart_at is not None else None),
+        }
+
+
 class ServiceManager:
     """
     Multiprocessed Service Manager.
+
+    Waits on the sentinels of its processes and replaces any which exit
+    right away. Processes which keep exiting shortly after starting are
+    restarted with an exponential backoff.
+
+    When given an Autoscaler the number of processes follows the backlog
+    of the named queues in qkwargs, in every lane, instead of staying at
+    process_count.
+
+    When given a hang_timeout processes whose consumer loop has not gone
+    around for that long are killed and replaced like processes which
+    exited.
+
+    SIGHUP replaces the processes one at a time and SIGTERM or SIGINT stops
+    them all. Processes are stopped with SIGTERM so they drain first.
     """
 
+    #: Seconds to wait before the second restart in a row of a process
+    #: which exited early. Doubles on every further early exit.
+    _backoff_initial = 0.5
+
+    #: Maximum seconds to wait before restarting a process.
+    _backoff_max = 60.0
+
+    #: Seconds a process must run before its exit no longer counts as
+    #: part of a crash loop.
+    _stable_after = 30.0
+
+    #: Seconds a process gets to drain after SIGTERM before it is killed.
+    #: Should exceed the drain_grace of the service.
+    _stop_timeout = 40.0
+
     def __init__(self, service_class, process_count, exchange_name,
-                 connection_url, qkwargs, **kwargs):
+                 connection_url, qkwargs, autoscaler=None, hang_timeout=None,
+                 lanes=None, **kwargs):
         """
         Initializes a new ServiceManager instance.
 
@@ -90,8 +300,20 @@ class ServiceManager:
         :type connection_url: str
         :param qkwargs: One or more dicts keyword arguments for queue creation
         :type qkwargs: list
+        :param autoscaler: Scales the processes between its limits, starting
+                           from process_count.
+        :type autoscaler: commissaire_service.service.autoscale.Autoscaler
+        :param hang_timeout: Seconds without a heartbeat after which a
+                             process is killed. Must exceed the longest
+                             handler run on the consumer thread. None
+                             disables the check.
+        :type hang_timeout: float or None
+        :param lanes: The priority_lanes of the service, so the queues of
+                      every lane are measured when autoscaling.
+        :type lanes: list or None
         :param kwargs: Other keyword arguments to pass to service initializer.
         :type kwargs: dict
+        :raises: ValueError
         """
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.debug('Initializing {}'.format(self.__class__.__name__))
@@ -101,13 +323,51 @@ class ServiceManager:
         self.exchange_name = exchange_name
         self.qkwargs = qkwargs
         self.kwargs = kwargs
-        self._pool = multiprocessing.Pool(
-            self._process_count, maxtasksperchild=1)
-        self._asyncs = []
+        self._autoscaler = autoscaler
+        self._hang_timeout = hang_timeout
+        if hang_timeout is not None and hang_timeout <= 0:
+            raise ValueError('hang_timeout must be positive')
+        self._backlog = None
+        self._next_scale = None
+        if autoscaler is not None:
+            queue_names = [
+                q['name'] for q in lane_queues(qkwargs, parse_lanes(lanes))
+                if q.get('name')]
+            if not queue_names:
+                raise ValueError(
+                    'Autoscaling requires named queues to measure')
+            self._backlog = QueueBacklog(connection_url, queue_names)
+            self._next_scale = 0.0
+            self._process_count = autoscaler.clamp(process_count)
+        self._workers = [WorkerState(x) for x in range(self._process_count)]
+        self._stopping = False
+        self._restart_requested = False
+        # Written to by signal handlers to wake up _supervise
+        self._wakeup = None
+
+    @property
+    def workers(self):
+        """
+        The state of every worker process.
+
+        :returns: A list of dicts, see WorkerState.to_dict.
+        :rtype: list
+        """
+        return [worker.to_dict() for worker in self._workers]
+
+    @property
+    def process_count(self):
+        """
+        The number of processes which should be running.
+        """
+        return self._process_count
 
-    def _start_process(self):
+    def _start_process(self, worker):
         """
         Starts a single process based on class attributes.
+
+        :param worker: The worker to start a process for.
+        :type worker: WorkerState
         """
         kwargs = self.kwargs.copy()
         kwargs.update({
@@ -116,28 +376,248 @@ class ServiceManager:
             'qkwargs': self.qkwargs,
         })
         self.logger.debug('Starting a new {} process with {}'.format(
-            self.service_class.__class__.__name__, kwargs))
-        self._asyncs.append(
-            self._pool.apply_async(
-                run_service,
-                args=[self.service_class], kwds={'kwargs': kwargs}))
+            self.service_class.__name__, kwargs))
+        args = (self.service_class, kwargs)
+        if self._hang_timeout is not None:
+            worker.heartbeat = Heartbeat()
+            args += (worker.heartbeat, )
+        process = multiprocessing.Process(
+            target=run_service,
+            args=args,
+            kwargs={'worker_index': worker.index},
+            name='{}-{}'.format(self.service_class.__name__, worker.index))
+        process.daemon = True
+        process.start()
+        if worker.process is not None:
+            worker.restarts += 1
+        worker.process = process
+        worker.started_at = monotonic()
+        worker.restart_at = None
+
+    def _reap(self, worker):
+        """
+        Handles the exit of a worker process and schedules its restart.
+
+        :param worker: The worker whose process exited.
+        :type worker: WorkerState
+        """
+        worker.process.join()
+        worker.exitcode = worker.process.exitcode
+        if worker.retiring:
+            self._workers.remove(worker)
+            self.logger.info('Process {} retired'.format(worker.pid))
+            return
+        now = monotonic()
+        if now - worker.started_at >= self._stable_after:
+            worker.failures = 0
+        worker.failures += 1
+        delay = 0.0
+        if worker.failures > 1:
+            delay = min(
+                self._backoff_initial * 2 ** (worker.failures - 2),
+                self._backoff_max)
+        worker.restart_at = now + delay
+        self.logger.warn(
+            'Process {} exited with {}. Replacing it in {:.1f}s'.format(
+                worker.pid, worker.exitcode, delay))
+
+    def _scale(self):
+        """
+        Samples the queue backlog and adds or retires processes.
+        """
+        active = [w for w in self._workers if not w.retiring]
+        try:
+            backlog = self._backlog()
+        except Exception as error:
+            self.logger.warn(
+                'Unable to measure the queue backlog: {}: {}'.format(
+                    type(error).__name__, error))
+            self._backlog.close()
+            return
+        target = self._autoscaler.decide(len(active), backlog)
+        if target == len(active):
+            return
+        self.logger.info(
+            'Scaling from {} to {} processes for a backlog of {}'.format(
+                len(active), target, backlog))
+        self._process_count = target
+        while len(active) < target:
+            # Reuse the lowest free slot so per-worker ports stay in range
+            taken = {w.index for w in self._workers}
+            worker = WorkerState(min(
+                x for x in range(len(taken) + 1) if x not in taken))
+            self._workers.append(worker)
+            active.append(worker)
+            self._start_process(worker)
+        while len(active) > target:
+            # Retire the newest process first
+            worker = active.pop()
+            worker.retiring = True
+            if worker.restart_at is not None:
+                self._workers.remove(worker)
+            else:
+                worker.process.terminate()
+
+    def _kill_hung(self):
+        """
+        Kills processes whose heartbeat is older than the hang timeout.
+        They are replaced once the kill is noticed like any other exit.
+        Their unacked messages go back to the broker.
+        """
+        now = monotonic()
+        for worker in self._workers:
+            if worker.heartbeat is None or worker.restart_at is not None or (
+                    worker.retiring):
+                continue
+            last = max(worker.heartbeat.last or 0.0, worker.started_at)
+            if now - last < self._hang_timeout:
+                continue
+            self.logger.warn(
+                'Process {} has not been heard from in {:.1f}s. '
+                'Killing it'.format(worker.pid, now - last))
+            worker.hangs += 1
+            # Not checked again until the replacement starts
+            worker.heartbeat = None
+            try:
+                os.kill(worker.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+    def _supervise(self):
+        """
+        Waits for processes to exit or be due for restart and handles them.
+        """
+        now = monotonic()
+        if self._autoscaler is not None and now >= self._next_scale:
+            self._scale()
+            self._next_scale = now + self._autoscaler.interval
+        if self._hang_timeout is not None:
+            self._kill_hung()
+        for worker in self._workers:
+            if worker.restart_at is not None and worker.restart_at <= now:
+                self._start_process(worker)
+
+        running = dict(
+            (w.process.sentinel, w) for w in self._workers
+            if w.restart_at is None)
+        pending = [
+            w.restart_at for w in self._workers if w.restart_at is not None]
+        if self._autoscaler is not None:
+            pending.append(self._next_scale)
+        if self._hang_timeout is not None:
+            pending.append(now + self._hang_timeout / 2)
+        timeout = None
+        if pending:
+            timeout = max(min(pending) - monotonic(), 0.0)
+
+        waitables = list(running)
+        if self._wakeup is not None:
+            waitables.append(self._wakeup[0])
+        for ready in multiprocessing.connection.wait(waitables, timeout):
+            if ready in running:
+                self._reap(running[ready])
+            else:
+                os.read(ready, 512)
+
+    def _stop_processes(self, workers):
+        """
+        Asks processes to drain and waits for them, killing any which are
+        still running after _stop_timeout.
+
+        :param workers: The workers to stop.
+        :type workers: list
+        """
+        processes = [
+            w.process for w in workers
+            if w.process is not None and w.restart_at is None]
+        for process in processes:
+            process.terminate()
+        deadline = monotonic() + self._stop_timeout
+        for process in processes:
+            process.join(max(deadline - monotonic(), 0.0))
+            if process.is_alive():
+                self.logger.warn(
+                    'Process {} did not drain in {}s. Killing it'.format(
+                        process.pid, self._stop_timeout))
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+        for worker in workers:
+            if worker.process is not None:
+                worker.exitcode = worker.process.exitcode
+
+    def rolling_restart(self):
+        """
+        Replaces every process, one at a time, so the others keep serving
+        while each drains.
+        """
+        self.logger.info('Rolling restart of {} processes'.format(
+            len(self._workers)))
+        for worker in list(self._workers):
+            if worker.retiring or worker.process is None:
+                continue
+            self._stop_processes([worker])
+            worker.failures = 0
+            self._start_process(worker)
+
+    def stop(self):
+        """
+        Makes run return after draining every process. Safe to call from a
+        signal handler.
+        """
+        self._stopping = True
+        self._wake()
+
+    def _wake(self):
+        """
+        Interrupts the wait in _supervise.
+        """
+        if self._wakeup is not None:
+            os.write(self._wakeup[1], b'.')
+
+    def _on_signal(self, signum, frame):
+        """
+        Stops on SIGTERM and SIGINT and restarts processes on SIGHUP.
+
+        :param signum: The signal number.
+        :type signum: int
+        :param frame: The interrupted stack frame.
+        :type frame: frame
+        """
+        if signum == signal.SIGHUP:
+            self._restart_requested = True
+            self._wake()
+        else:
+            self.stop()
 
     def run(self):
         """
-        Runs the manager "forever".
+        Runs the manager until stop is called or a stop signal arrives.
         """
-        for x in range(0, self._process_count):
-            self._start_process()
-        while True:
-            for process_result in self._asyncs:
-                if process_result.ready():
-                    self.logger.warn(
-                        'Process {} finished. Replacing it with a '
-                        'new one..'.format(process_result))
-                    idx = self._asyncs.index(process_result)
-                    process_result = self._asyncs.pop(idx)
-                    self._start_process()
-            sleep(1)
+        previous = {}
+        if threading.current_thread() is threading.main_thread():
+            self._wakeup = os.pipe()
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                previous[signum] = signal.signal(signum, self._on_signal)
+        try:
+            for worker in self._workers:
+                self._start_process(worker)
+            if self._autoscaler is not None:
+                self._next_scale = monotonic() + self._autoscaler.interval
+            while not self._stopping:
+                if self._restart_requested:
+                    self._restart_requested = False
+                    self.rolling_restart()
+                self._supervise()
+            self.logger.info('Stopping {} processes'.format(
+                len(self._workers)))
+            self._stop_processes(self._workers)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            if self._wakeup is not None:
+                for fd in self._wakeup:
+                    os.close(fd)
+                self._wakeup = None
 
 
 class CommissaireService(ConsumerMixin, BusMixin):
@@ -149,6 +629,13 @@ class CommissaireService(ConsumerMixin, BusMixin):
     #: should override this.
     _default_config_file = C.DEFAULT_CONFIGURATION_FILE
 
+    #: How long (in seconds) the consumer waits for new messages before
+    #: checking for handlers finished by the worker pool.
+    _completion_interval = 0.05
+
+    #: Whether the isolation_pools configuration key is honoured.
+    _supports_isolation_pools = True
+
     def __init__(
             self, exchange_name, connection_url, qkwargs, config_file=None):
         """
@@ -166,11 +653,25 @@ class CommissaireService(ConsumerMixin, BusMixin):
         name = self.__class__.__name__
         self.logger = logging.getLogger(name)
         self.logger.debug('Initializing {}'.format(name))
+        self._started_at = monotonic()
+        self._started_time = time()
+        # Beaten by the consumer loop when run by a ServiceManager
+        self._heartbeat = None
+        # Slot of the process when run by a ServiceManager
+        self._worker_index = None
+        # The last error returned, for introspect
+        self._last_error = None
 
         # If we are given no default, use the global one
         # Read the configuration file
         self._config_data = read_config_file(
             config_file, self._default_config_file)
+        self._config_digest = config_digest(self._config_data)
+        if self._config_data.get('isolation_pools') and (
+                not self._supports_isolation_pools):
+            raise ValueError(
+                '{} does not support isolation_pools. Use in_flight_limits '
+                'to cap expensive methods'.format(name))
 
         if connection_url is None and 'bus_uri' in self._config_data:
             connection_url = self._config_data.get('bus_uri')
@@ -181,7 +682,19 @@ class CommissaireService(ConsumerMixin, BusMixin):
                 'Using exchange_name=%s from config file', exchange_name)
             exchange_name = self._config_data.get('bus_exchange')
 
-        self.connection = Connection(connection_url)
+        # Priority lanes, highest first. Each lane gets its own queues.
+        self._lanes = parse_lanes(self._config_data.get('priority_lanes'))
+        transport_options = dict(
+            self._config_data.get('transport_options') or {})
+        if len(self._lanes) > 1:
+            # The Redis transport reads its queues round robin otherwise
+            transport_options.setdefault(
+                'queue_order_strategy', QUEUE_ORDER_STRATEGY)
+
+        # Pooled connection lent to the current thread, see _lend_bus
+        self._lent = threading.local()
+        self.connection = Connection(
+            connection_url, transport_options=transport_options)
         self._channel = self.connection.default_channel
         self._exchange = Exchange(
             exchange_name, type='topic').bind(self._channel)
@@ -189,17 +702,217 @@ class CommissaireService(ConsumerMixin, BusMixin):
 
         # Set up queues
         self._queues = []
-        for kwargs in qkwargs:
+        for kwargs in lane_queues(qkwargs, self._lanes):
             queue = Queue(**kwargs)
             queue.exchange = self._exchange
             queue = queue.bind(self._channel)
             self._queues.append(queue)
+            LaneCycle.rank(queue.name, self._queue_priority(queue))
             self.logger.debug(queue.as_dict())
 
         # Create producer for publishing on topics
         self.producer = Producer(self._channel, self._exchange)
+
+        # Create the long lived publisher used for replies. It has its own
+        # connection so replies are not held up by a worker thread waiting
+        # on a nested request.
+        self._reply_connection = self.connection.clone()
+        self._reply_lock = threading.Lock()
+        self._replies = ReplyPublisher(
+            self._reply_connection.default_channel,
+            route=self._config_data.get('reply_route', REPLY_ROUTE_DEFAULT),
+            cache_size=self._config_data.get('reply_cache_size', 128))
+
+        # Repeats of the same failure are only logged once per interval
+        self._exception_logger = ExceptionLogger(
+            self.logger,
+            interval=self._config_data.get('exception_log_interval', 60.0))
+
+        # Request metrics, served over HTTP once running, see _serve_metrics
+        self.metrics = ServiceMetrics()
+        self._metrics_server = None
+
+        # Completed requests, so redelivered ones are not run twice
+        self._responses = build_response_cache(
+            self._config_data, name, connection_url)
+
+        # Content types consumers accept, None for kombu's default
+        self._accept = codec.accept_content(
+            self._config_data.get('accept_content'))
+
+        # Compressions offered to services we call and used for large
+        # replies and batches
+        self._compression = codec.compressions(
+            self._config_data.get('compression', ['zlib']))
+        self._compression_threshold = int(
+            self._config_data.get('compression_threshold', 65536))
+
+        # Bus method name to MethodBinder for every on_* method
+        self._dispatch = build_dispatch_table(self, RESERVED_HANDLERS)
+
+        # Results of @cacheable methods, by bus method name
+        self._result_caches = install_result_caches(
+            self._dispatch, self.metrics.cache_hits, self.metrics.cache_misses)
+
+        # Deadline of the request each thread is handling, passed on to
+        # nested requests
+        self._context = DeadlineContext()
+
+        # Spans of handlers and nested requests, passed on in headers
+        self._tracer = build_tracer(name, self._config_data.get('tracing'))
+
+        # Serializes use of self.connection by handlers (one-off replies)
+        self._bus_lock = threading.RLock()
+
+        # Optional worker pool. When max_workers is set handlers run on
+        # the pool and messages are acked by the consumer after completion.
+        self._executor = None
+        self._completed = deque()
+        self._pending = PendingWork()
+        # Messages received but not yet acked or requeued, by id(), and
+        # the ids of those a worker started handling. A drain only
+        # requeues messages no worker has claimed.
+        self._in_flight = {}
+        self._running = set()
+        self._claim_lock = threading.Lock()
+        # Caps on the messages in flight and the method each admitted
+        # message counts against, by id()
+        self._limits = build_in_flight_limits(self._config_data)
+        self._limited = {}
+        # Consumers to cancel when draining and when the drain must end
+        self._consumers = []
+        self._drain_grace = float(self._config_data.get('drain_grace', 30.0))
+        # How long get_models waits for the storage service
+        self._storage_timeout = float(
+            self._config_data.get('storage_timeout', 30.0))
+        self._drain_deadline = None
+        max_workers = int(self._config_data.get('max_workers', 0))
+        # Methods with their own threads and concurrency budget
+        self._isolation_pools = build_isolation_pools(
+            self._config_data.get('isolation_pools'))
+        # Each method with a pool is consumed from queues of its own, by
+        # routing key, see _isolate
+        self._isolation_queues = {}
+        for pool in self._isolation_pools.values():
+            routing_keys = isolation_routing_keys(qkwargs, pool.name)
+            if not routing_keys:
+                raise ValueError(
+                    'No queue of {} routes {}, which has an isolation '
+                    'pool'.format(name, pool.name))
+            for routing_key in routing_keys:
+                queue = Queue(name=routing_key, routing_key=routing_key)
+                queue.exchange = self._exchange
+                self._isolation_queues[routing_key] = (
+                    queue.bind(self._channel), pool)
+        # Channels the isolation queues are consumed on
+        self._isolation_channels = []
+        self._prefetch_count = self._config_data.get(
+            'prefetch_count', max_workers or None)
+        # Optional pool for running the elements of batch requests
+        self._batch_executor = None
+        batch_workers = int(self._config_data.get('batch_workers', 0))
+        if batch_workers > 0:
+            self._batch_executor = ThreadPoolExecutor(
+                max_workers=batch_workers)
+        if max_workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+            self.logger.debug(
+                'Dispatching handlers to {} workers with a prefetch '
+                'count of {}'.format(max_workers, self._prefetch_count))
+        # Connections for outgoing requests and notifications. By default
+        # every thread which runs handlers can have one.
+        self._bus_pool = BusPool(
+            self.connection, self._exchange,
+            self._config_data.get('bus_pool_size', 1 + max_workers + (
+                batch_workers + sum(
+                    pool.slots for pool in self._isolation_pools.values()))))
         self.logger.debug('Initializing of {} finished'.format(name))
 
+    @property
+    def connection(self):
+        """
+        The connection of the service, or the pooled connection lent to the
+        current thread while it sends a request.
+
+        :rtype: kombu.Connection
+        """
+        bus = getattr(self._lent, 'bus', None)
+        return self._connection if bus is None else bus.connection
+
+    @connection.setter
+    def connection(self, connection):
+        self._connection = connection
+
+    @property
+    def producer(self):
+        """
+        The producer of the service, or the pooled producer lent to the
+        current thread while it sends a request.
+
+        :rtype: kombu.Producer
+        """
+        bus = getattr(self._lent, 'bus', None)
+        return self._producer if bus is None else bus.producer
+
+    @producer.setter
+    def producer(self, producer):
+        self._producer = producer
+
+    @contextlib.contextmanager
+    def _lend_bus(self):
+        """
+        Lends the current thread a pooled connection for a block. Within
+        it self.connection and self.producer are the pooled ones, so a
+        request waiting on its reply does not block other threads.
+
+        :returns: The lent connection and producer.
+        :rtype: commissaire_service.service.pools.PooledBus
+        """
+        with self._bus_pool.acquire() as bus:
+            previous = getattr(self._lent, 'bus', None)
+            self._lent.bus = bus
+            try:
+                yield bus
+            finally:
+                self._lent.bus = previous
+
+    def _serve_metrics(self):
+        """
+        Starts the metrics endpoint if metrics_port is configured. Processes
+        of a ServiceManager listen on metrics_port plus their worker index
+        so they do not fight over one port.
+        """
+        port = self._config_data.get('metrics_port')
+        if port is None or self._metrics_server is not None:
+            return
+        port = int(port)
+        # Port 0 already picks a free port for each process
+        if port and self._worker_index:
+            port += self._worker_index
+        self._start_metrics_server(
+            port, self._config_data.get('metrics_address', '127.0.0.1'))
+
+    def _start_metrics_server(self, port, address):
+        """
+        Serves the metrics in the Prometheus text format. Failing to bind
+        is logged and the service carries on without the endpoint.
+
+        :param port: The port to listen on.
+        :type port: int
+        :param address: The address to listen on.
+        :type address: str
+        """
+        try:
+            self._metrics_server = MetricsServer(self.metrics, port, address)
+        except OSError as error:
+            self.logger.warn(
+                'Unable to serve metrics on {}:{}: {}'.format(
+                    address, port, error))
+            return
+        self._metrics_server.start()
+        self.logger.info('Serving metrics on http://{}:{}/metrics'.format(
+            address, self._metrics_server.port))
+
     def get_consumers(self, Consumer, channel):
         """
         Returns the a list of consumers to watch. Called by the parent Mixin.
@@ -212,159 +925,1613 @@ class CommissaireService(ConsumerMixin, BusMixin):
         :rtype: list
         """
         consumers = []
+        kwargs = {'callbacks': [self.on_message]}
+        if self._accept is not None:
+            kwargs['accept'] = self._accept
+        if self._prefetch_count:
+            kwargs['prefetch_count'] = self._prefetch_count
         self.logger.debug('Setting up consumers')
-        for queue in self._queues:
+        # Consumers of higher priority lanes are registered first. Brokers
+        # which poll, like Redis, also read in lane order through LaneCycle.
+        for queue in sorted(self._queues, key=self._queue_priority):
             self.logger.debug('Will consume on {}'.format(queue.name))
-            consumers.append(
-                Consumer(queue, callbacks=[self.on_message]))
+            consumers.append(Consumer(queue, **kwargs))
+        consumers += self._isolation_consumers(channel, kwargs)
         self.logger.debug('Consumers: {}'.format(consumers))
         return consumers
 
+    def _isolation_consumers(self, channel, kwargs):
+        """
+        Returns the consumers of the isolation queues. Each consumes on a
+        channel of its own with the capacity of its pool as prefetch
+        count, so a backlog of one method never holds up the others.
+
+        :param channel: The channel of the other consumers.
+        :type channel: kombu.transport.*.Channel
+        :param kwargs: Keyword arguments of the other consumers.
+        :type kwargs: dict
+        :returns: A list of Consumer instances.
+        :rtype: list
+        """
+        # Channels of a lost connection went with it
+        self._isolation_channels = []
+        consumers = []
+        for routing_key, (queue, pool) in sorted(
+                self._isolation_queues.items()):
+            own = channel.connection.client.channel()
+            self._isolation_channels.append(own)
+            self.logger.debug('Will consume on {}'.format(queue.name))
+            consumers.append(Consumer(
+                own, [queue], on_decode_error=self.on_decode_error,
+                **dict(kwargs, prefetch_count=pool.capacity)))
+        return consumers
+
+    def consume(self, *args, **kwargs):
+        """
+        Consumes messages. Overridden so the consumer wakes up often enough
+        to ack messages finished by the worker pool.
+
+        :param args: Positional arguments for ConsumerMixin.consume.
+        :type args: tuple
+        :param kwargs: Keyword arguments for ConsumerMixin.consume.
+        :type kwargs: dict
+        """
+        self._before_consume(kwargs)
+        return super().consume(*args, **kwargs)
+
+    def _before_consume(self, kwargs):
+        """
+        Prepares the service to consume messages.
+
+        :param kwargs: Keyword arguments for ConsumerMixin.consume. A
+                       safety_interval is set if the service needs one.
+        :type kwargs: dict
+        """
+        if self._executor is not None or self._isolation_pools:
+            kwargs.setdefault('safety_interval', self._completion_interval)
+
+    def _use_worker_pool(self):
+        """
+        Makes handlers run on a worker pool, one worker unless max_workers
+        says otherwise, instead of on the consumer thread. Used by
+        ServiceHost so a handler waiting on a reply from a service in the
+        same process does not block the thread which would answer it.
+        """
+        if self._executor is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        if self._prefetch_count is None:
+            self._prefetch_count = 1
+
+    def _share_bus(self, other):
+        """
+        Moves the service onto the connections of another service in the
+        same process and closes its own. Used by ServiceHost.
+
+        :param other: The service whose connections are used.
+        :type other: CommissaireService
+        """
+        own = (self._connection, self._reply_connection)
+        self._bus_pool.close()
+        self.connection = other._connection
+        self._channel = other._channel
+        self._exchange = Exchange(
+            self._exchange.name, type='topic').bind(self._channel)
+        self.producer = Producer(self._channel, self._exchange)
+        self._reply_connection = other._reply_connection
+        self._reply_lock = other._reply_lock
+        self._replies = other._replies
+        self._bus_pool = other._bus_pool
+        for connection in own:
+            connection.release()
+
     def on_message(self, body, message):
         """
         Called when a new message arrives.
 
+        When a worker pool is configured the handler is run on the pool and
+        the message is replied to and acked by on_iteration once it is done.
+        Otherwise the handler runs inline on the consumer thread. Methods
+        with an isolation pool are moved to their own queue and run on
+        their pool once they arrive from it.
+
         :param body: Body of the message.
         :type body: dict or json string
         :param message: The message instance.
         :type message: kombu.message.Message
         """
-        self.logger.debug('Received message "{}" {}'.format(
-            message.delivery_tag, body))
-        expected_method = message.delivery_info['routing_key'].rsplit(
-            '.', 1)[1]
+        log_event(
+            self.logger, logging.DEBUG, 'message.received',
+            delivery_tag=message.delivery_tag, body=body)
+        pool = self._isolation_pools.get(self._method_of(message))
+        if pool is not None and self._isolate(message):
+            return
+        self._received(message)
+        if self._method_of(message) in HEALTH_METHODS:
+            self._finish(message, self._handle(body, message))
+            return
+        if not self._admit(body, message):
+            return
+        if pool is not None:
+            pool.submit(self._handle_in_pool, body, message)
+        elif self._executor is None:
+            self._finish(message, self._handle(body, message))
+        else:
+            self._pending.put(self._message_priority(message), (body, message))
+            self._executor.submit(self._handle_next)
 
-        # If we don't get a valid message we default to -1 for the id
+    def _isolate(self, message):
+        """
+        Moves a message for a method with an isolation pool onto the queue
+        of the method, unless it came from there. The message is published
+        again as it was and acked.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: True if the message was moved.
+        :rtype: bool
+        """
+        routing_key = message.delivery_info.get('routing_key', '')
+        target = isolated_routing_key(routing_key, self._lanes)
+        if target == routing_key or target not in self._isolation_queues:
+            return False
+        # kombu already decompressed the body
+        headers = dict(message.headers or {})
+        headers.pop('compression', None)
+        kwargs = {
+            key: message.properties[key]
+            for key in ('reply_to', 'correlation_id')
+            if message.properties.get(key)}
+        remaining = time_remaining(read_deadline(message))
+        if remaining is not None:
+            kwargs['expiration'] = max(remaining, 0.001)
+        with self._bus_lock:
+            self.producer.publish(
+                message.body, routing_key=target,
+                content_type=message.content_type,
+                content_encoding=message.content_encoding,
+                headers=headers, **kwargs)
+        message.ack()
+        log_event(
+            self.logger, logging.DEBUG, 'message.isolated',
+            delivery_tag=message.delivery_tag, routing_key=target)
+        return True
+
+    def _admit(self, body, message):
+        """
+        Counts a message against the in flight limits. A message over a
+        limit is answered right away with a ServiceBusyError and acked.
+
+        :param body: Body of the message.
+        :type body: dict or json string
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: False if the message was turned away.
+        :rtype: bool
+        """
+        if not self._limits.enabled:
+            return True
+        method_name = self._method_of(message)
+        if self._limits.try_acquire(method_name):
+            self._limited[id(message)] = method_name
+            return True
         response = {'jsonrpc': '2.0', 'id': -1}
         try:
-            # If we don't have a dict then it should be a json string
-            if isinstance(body, str):
-                body = json.loads(body)
-
-            # If we have a method and it matches the routing key treat it
-            # as a jsonrpc call
-            if (
-                    isinstance(body, dict) and
-                    'method' in body.keys() and
-                    body.get('method') == expected_method):
-                response['id'] = body.get('id', -1)
-                method = getattr(self, 'on_{}'.format(body['method']))
-                if type(body.setdefault('params', {})) is dict:
-                    result = method(message=message, **body['params'])
-                else:
-                    result = method(message, *body['params'])
-                response['result'] = result
-
-                self.logger.debug('Result for "{}": "{}"'.format(
-                    response['id'], result))
-            else:
-                # Drop it
-                self.logger.error(
-                    'Dropping unknown message: payload="{}", '
-                    'properties="{}"'.format(body, message.properties))
-        except Exception as error:
-            # Subclasses of RemoteProcedureCallError are re-created and
-            # raised on the client-side.
-            if isinstance(error, RemoteProcedureCallError):
-                response['error'] = {
-                    'code': error.code,
-                    'message': str(error),
-                    'data': error.data
-                }
-            else:
-                jsonrpc_error_code = C.JSONRPC_ERRORS['INVALID_REQUEST']
-                # If there is an attribute error then use the Method Not Found
-                # code in the error response
-                if type(error) is AttributeError:
-                    jsonrpc_error_code = C.JSONRPC_ERRORS['METHOD_NOT_FOUND']
-                elif type(error) is json.decoder.JSONDecodeError:
-                    jsonrpc_error_code = C.JSONRPC_ERRORS['INVALID_JSON']
-                response['error'] = {
-                    'code': jsonrpc_error_code,
-                    'message': str(error),
-                    'data': {
-                        'exception': str(type(error))
-                    }
-                }
-                self.logger.warn(
-                    'Exception raised during method call:\n{}'.format(
-                        traceback.format_exc()))
-
-        # Reply back if needed
-        if message.properties.get('reply_to'):
-            self.logger.debug('Responding to {}'.format(
-                message.properties['reply_to']))
-            response_queue = self.connection.SimpleQueue(
-                message.properties['reply_to'])
-            response_queue.put(json.dumps(response))
-            response_queue.close()
+            request = self._decode(body, message)
+            if isinstance(request, dict):
+                response['id'] = request.get('id', -1)
+        except codec.DecodeError:
+            pass
+        self._set_error(response, self._limits.busy_error(method_name))
+        log_event(
+            self.logger, logging.DEBUG, 'message.busy',
+            delivery_tag=message.delivery_tag, method=method_name)
+        self._count_request(method_name, response)
+        self._finish(message, response)
+        return False
 
-        message.ack()
-        self.logger.debug('Message "{}" {} ackd'.format(
-            message.delivery_tag,
-            ('was' if message.acknowledged else 'was not')))
+    def _method_of(self, message):
+        """
+        Returns the bus method a message was routed to.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: The last part of the routing key.
+        :rtype: str
+        """
+        return message.delivery_info.get('routing_key', '').rsplit('.', 1)[-1]
 
-    def respond(self, queue_name, id, payload, **kwargs):
+    def _requeue(self, message, method_name):
         """
-        Sends a response to a simple queue. Responses are sent back to a
-        request and never should be the owner of the queue.
+        Hands a message back to the broker without handling it.
 
-        :param queue_name: The name of the queue to use.
-        :type queue_name: str
-        :param id: The unique request id
-        :type id: str
-        :param payload: The content of the message.
-        :type payload: dict
-        :param kwargs: Keyword arguments to pass to SimpleQueue
-        :type kwargs: dict
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :param method_name: The bus method name.
+        :type method_name: str
         """
-        self.logger.debug('Sending response for message id "{}"'.format(id))
-        send_queue = self.connection.SimpleQueue(queue_name, **kwargs)
-        jsonrpc_msg = {
-            'jsonrpc': "2.0",
-            'id': id,
-            'result': payload,
-        }
-        self.logger.debug('jsonrpc msg: {}'.format(jsonrpc_msg))
-        send_queue.put(jsonrpc_msg)
-        self.logger.debug('Sent response for message id "{}"'.format(id))
-        send_queue.close()
+        log_event(
+            self.logger, logging.DEBUG, 'message.requeued',
+            delivery_tag=message.delivery_tag, method=method_name)
+        message.requeue()
+        self.metrics.requeued.inc((method_name, ))
+        self._forget(message)
 
-    def onconnection_revived(self):  # pragma: no cover
+    def _queue_priority(self, queue):
         """
-        Called when a reconnection occurs.
+        Returns the priority of the lane a queue belongs to.
+
+        :param queue: The queue.
+        :type queue: kombu.Queue
+        :returns: The lane index, lower is more urgent.
+        :rtype: int
         """
-        self.logger.info('Connection (re)established')
+        return self._lanes.index(lane_of(queue.routing_key or '', self._lanes))
 
-    def on_consume_ready(
-            self, connection, channel, consumers):  # pragma: no cover
+    def _message_priority(self, message):
         """
-        Called when the service is ready to consume messages.
+        Returns the priority of the lane a message came through.
 
-        :param connection: The current connection instance.
-        :type connection: kombu.Connection
-        :param channel: The current channel.
-        :type channel: kombu.transport.*.Channel
-        :param consumers: A list of consumers.
-        :type consumers: list
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: The lane index, lower is more urgent.
+        :rtype: int
         """
-        self.logger.info('Ready to consume')
-        if self.logger.level == logging.DEBUG:
-            queue_names = []
-            for consumer in consumers:
-                queue_names += [x.name for x in consumer.queues]
-            self.logger.debug(
-                'Consuming via connection "{}" and channel "{}" on '
-                'the following queues: "{}"'.format(
-                    connection.as_uri(), channel, '", "'.join(queue_names)))
+        return self._lanes.index(lane_of(
+            message.delivery_info.get('routing_key', ''), self._lanes))
 
-    def on_consume_end(self, connection, channel):  # pragma: no cover
+    def _handle_next(self):
         """
-        Called when the service stops consuming.
+        Handles the most urgent message waiting for a pool worker, unless
+        a drain requeued it.
+        """
+        body, message = self._pending.get()
+        self._handle_in_pool(body, message)
 
-        :param connection: The current connection instance.
-        :type connection: kombu.Connection
-        :param channel: The current channel.
-        :type channel: kombu.transport.*.Channel
+    def _received(self, message):
         """
-        self.logger.warn('Consuming has ended')
+        Records the arrival of a message.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        """
+        message.received_at = monotonic()
+        self._in_flight[id(message)] = message
+        self.metrics.in_flight.inc()
+
+    def _claim(self, message):
+        """
+        Marks a message as started by a worker unless a drain requeued it
+        in the meantime.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: False if the message must not be handled.
+        :rtype: bool
+        """
+        with self._claim_lock:
+            if (self._drain_deadline is not None and
+                    id(message) not in self._in_flight):
+                return False
+            self._running.add(id(message))
+            return True
+
+    def _forget(self, message):
+        """
+        Stops tracking a message which was acked or requeued.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        """
+        self._running.discard(id(message))
+        if self._in_flight.pop(id(message), None) is not None:
+            self.metrics.in_flight.dec()
+        method_name = self._limited.pop(id(message), None)
+        if method_name is not None:
+            self._limits.release(
+                method_name, monotonic() - message.received_at)
+
+    def on_iteration(self):
+        """
+        Called by the parent Mixin on every pass of the consumer loop.
+        Replies to and acks messages finished by the worker pool, moves
+        a drain along and beats the heartbeat.
+        """
+        if self._heartbeat is not None:
+            self._heartbeat.beat()
+        while self._completed:
+            message, response = self._completed.popleft()
+            self._finish(message, response)
+        if self._drain_deadline is not None:
+            self._drain_step()
+
+    def drain(self, grace=None):
+        """
+        Stops taking new messages and stops the service once the messages
+        in flight are replied to and acked. Messages still waiting for a
+        worker after the grace period are requeued, messages a worker
+        already started are finished. Safe to call from a signal handler.
+
+        :param grace: Seconds to wait for messages in flight. Defaults to
+                      the drain_grace configuration key.
+        :type grace: float or None
+        """
+        if self._drain_deadline is not None:
+            return
+        if grace is None:
+            grace = self._drain_grace
+        self._drain_deadline = monotonic() + grace
+        log_event(
+            self.logger, logging.INFO, 'service.draining',
+            in_flight=len(self._in_flight), grace=grace)
+
+    def _drain_step(self):
+        """
+        Cancels the consumers and stops the service when nothing is left
+        in flight. Once the grace period is over messages no worker
+        started are requeued, so they never run here as well.
+        """
+        while self._consumers:
+            self._consumers.pop().cancel()
+        if self._in_flight and monotonic() < self._drain_deadline:
+            return
+        with self._claim_lock:
+            waiting = [
+                message for key, message in self._in_flight.items()
+                if key not in self._running]
+            for message in waiting:
+                self._requeue(message, self._method_of(message))
+        if self._in_flight:
+            # Started handlers are finished rather than run twice
+            return
+        self._stop_workers()
+        log_event(self.logger, logging.INFO, 'service.drained')
+        self.should_stop = True
+
+    def _stop_workers(self):
+        """
+        Stops the worker threads once nothing is left in flight. Work
+        items of requeued messages are cancelled where the interpreter
+        allows it and do nothing otherwise.
+        """
+        kwargs = {'wait': False}
+        if sys.version_info >= (3, 9):
+            kwargs['cancel_futures'] = True
+        for executor in (self._executor, self._batch_executor):
+            if executor is not None:
+                executor.shutdown(**kwargs)
+        for pool in self._isolation_pools.values():
+            pool.shutdown(wait=False)
+
+    def _on_sigterm(self, signum, frame):
+        """
+        Starts draining when the process is asked to terminate.
+
+        :param signum: The signal number.
+        :type signum: int
+        :param frame: The interrupted stack frame.
+        :type frame: frame
+        """
+        self.drain()
+
+    def run(self, *args, **kwargs):
+        """
+        Consumes messages until the service is stopped. SIGTERM drains the
+        service when it runs on the main thread.
+
+        :param args: Positional arguments for ConsumerMixin.run.
+        :type args: tuple
+        :param kwargs: Keyword arguments for ConsumerMixin.run.
+        :type kwargs: dict
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._on_sigterm)
+        self._serve_metrics()
+        return super().run(*args, **kwargs)
+
+    def _handle_in_pool(self, body, message):
+        """
+        Runs a handler on a pool worker and queues the result for the
+        consumer thread.
+
+        :param body: Body of the message.
+        :type body: dict or json string
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        """
+        if not self._claim(message):
+            # Requeued by a drain, another process handles it
+            return
+        self._completed.append((message, self._handle(body, message)))
+
+    def _handle(self, body, message):
+        """
+        Calls the on_* method for a message and builds the response.
+
+        :param body: Body of the message.
+        :type body: dict or json string
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: The jsonrpc response.
+        :rtype: dict
+        """
+        deadline = read_deadline(message)
+        if self._expired(message, deadline):
+            return None
+        with self._context.scope(deadline), \
+                self._tracer.scope(read_trace(message)):
+            # If we don't get a valid message we default to -1 for the id
+            response = {'jsonrpc': '2.0', 'id': -1}
+            method_name = METHOD_UNKNOWN
+            try:
+                body = self._decode(body, message)
+                if type(body) is list:
+                    return self._handle_batch(body, message)
+                call = self._prepare_call(body, message, response)
+                if call is not None:
+                    binder, args, kwargs = call
+                    method_name = binder.name
+                    self._call(binder, args, kwargs, response)
+            except Exception as error:
+                self._set_error(response, error)
+        self._count_request(method_name, response)
+        return response
+
+    def _expired(self, message, deadline):
+        """
+        Returns True if the caller stopped waiting for a message. Expired
+        messages are acked without running the handler or replying.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :param deadline: The deadline of the message.
+        :type deadline: float or None
+        :rtype: bool
+        """
+        remaining = time_remaining(deadline)
+        if remaining is None or remaining > 0:
+            return False
+        log_event(
+            self.logger, logging.INFO, 'message.expired',
+            delivery_tag=message.delivery_tag, late=-remaining)
+        self.metrics.expired.inc()
+        return True
+
+    def _handle_batch(self, batch, message):
+        """
+        Calls the on_* methods for a batch request and builds the reply.
+        Elements run on the batch pool when batch_workers is configured.
+
+        :param batch: The decoded batch.
+        :type batch: list
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: The jsonrpc responses or None if all were notifications.
+        :rtype: list or None
+        :raises: ValueError
+        """
+        check_batch(batch)
+        if self._batch_executor is not None and len(batch) > 1:
+            responses = list(self._batch_executor.map(
+                self._handle_element, batch, [message] * len(batch)))
+        else:
+            responses = [self._handle_element(x, message) for x in batch]
+        return batch_reply(responses)
+
+    def _handle_element(self, request, message):
+        """
+        Calls the on_* method for one element of a batch request. Methods
+        with an isolation pool are refused.
+
+        :param request: The batch element.
+        :type request: mixed
+        :param message: The message carrying the batch.
+        :type message: kombu.message.Message
+        :returns: The jsonrpc response or None for a notification.
+        :rtype: dict or None
+        """
+        response = {'jsonrpc': '2.0', 'id': -1}
+        method_name = METHOD_UNKNOWN
+        with self._context.scope(read_deadline(message)), \
+                self._tracer.scope(read_trace(message)):
+            try:
+                check_element(request)
+                binder, args, kwargs = self._bind(
+                    request, BatchElementMessage(message, request), response)
+                method_name = binder.name
+                if method_name in self._isolation_pools:
+                    # Would run off its pool on a batch or consumer thread
+                    raise ValueError(
+                        '{} runs on an isolation pool and can not be '
+                        'called in a batch'.format(method_name))
+                with self._element_limit(method_name, message):
+                    self._call(binder, args, kwargs, response)
+            except Exception as error:
+                self._set_error(response, error)
+        self._count_request(method_name, response)
+        if is_notification(request):
+            return None
+        return response
+
+    @contextlib.contextmanager
+    def _element_limit(self, method_name, message):
+        """
+        Counts a batch element against the in flight limit of its method
+        for a block. The batch itself counts against the service limit.
+
+        :param method_name: The bus method name of the element.
+        :type method_name: str
+        :param message: The message carrying the batch.
+        :type message: kombu.message.Message
+        :raises: commissaire_service.service.limits.ServiceBusyError
+        """
+        if method_name not in self._limits.methods:
+            yield
+            return
+        if not self._limits.try_acquire(method_name, count_total=False):
+            log_event(
+                self.logger, logging.DEBUG, 'message.busy',
+                delivery_tag=message.delivery_tag, method=method_name)
+            raise self._limits.busy_error(method_name)
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self._limits.release(
+                method_name, monotonic() - started, count_total=False)
+
+    def _call(self, binder, args, kwargs, response):
+        """
+        Calls an on_* method and adds its result to a response.
+
+        :param binder: The binder of the method.
+        :type binder: commissaire_service.service.dispatch.MethodBinder
+        :param args: Positional arguments for the method.
+        :type args: tuple
+        :param kwargs: Keyword arguments for the method.
+        :type kwargs: dict
+        :param response: The jsonrpc response being built.
+        :type response: dict
+        """
+        with self._tracer.span(binder.name, KIND_SERVER):
+            key = self._idempotency_key(binder, response)
+            if key is not None and self._replay(key, response):
+                return
+            started = self._call_started(binder.name)
+            try:
+                result = binder.method(*args, **kwargs)
+            except Exception:
+                self._release(key)
+                raise
+            finally:
+                self._call_finished(binder.name, started)
+        self._set_result(response, result)
+        if key is not None:
+            self._responses.set(key, {'result': result})
+
+    def _idempotency_key(self, binder, response):
+        """
+        Returns the key completed requests are remembered by, or None if
+        the request can not be recognized when it is delivered again.
+
+        :param binder: The binder of the method.
+        :type binder: commissaire_service.service.dispatch.MethodBinder
+        :param response: The jsonrpc response being built.
+        :type response: dict
+        :returns: The key or None.
+        :rtype: str or None
+        """
+        if self._responses is None or response['id'] in (-1, None):
+            return None
+        return '{}:{}'.format(binder.name, response['id'])
+
+    def _replay(self, key, response):
+        """
+        Fills in a response from the cache if the request already completed,
+        otherwise marks it as running. A duplicate of a request which is
+        still running is turned away with a ServiceBusyError.
+
+        :param key: The idempotency key.
+        :type key: str
+        :param response: The jsonrpc response being built.
+        :type response: dict
+        :returns: True if the response was filled in.
+        :rtype: bool
+        :raises: commissaire_service.service.limits.ServiceBusyError
+        """
+        cached = self._responses.claim(key)
+        if cached is None:
+            return False
+        method_name = key.split(':', 1)[0]
+        log_event(self.logger, logging.INFO, 'message.duplicate', key=key)
+        self.metrics.duplicates.inc((method_name, ))
+        if cached == IN_PROGRESS:
+            wait = self._limits.retry_after
+            raise ServiceBusyError(
+                'Request {} is already running, retry in {:.3f}s'.format(
+                    key, wait),
+                {'code': JSONRPC_SERVICE_BUSY, 'method': method_name,
+                 'retry_after': round(wait, 3)})
+        response.update(cached)
+        return True
+
+    def _release(self, key):
+        """
+        Drops the running mark of a request which failed, so a redelivery
+        runs it again.
+
+        :param key: The idempotency key or None.
+        :type key: str or None
+        """
+        if key is not None:
+            self._responses.release(key)
+
+    def _call_started(self, method_name):
+        """
+        Records the start of an on_* method call.
+
+        :param method_name: The bus method name.
+        :type method_name: str
+        :returns: The start time.
+        :rtype: float
+        """
+        self.metrics.in_progress.inc((method_name, ))
+        return monotonic()
+
+    def _call_finished(self, method_name, started):
+        """
+        Records the end of an on_* method call.
+
+        :param method_name: The bus method name.
+        :type method_name: str
+        :param started: The start time from _call_started.
+        :type started: float
+        """
+        self.metrics.latency.observe(monotonic() - started, (method_name, ))
+        self.metrics.in_progress.dec((method_name, ))
+
+    def _count_request(self, method_name, response):
+        """
+        Counts a handled request and its error, if any.
+
+        :param method_name: The bus method name.
+        :type method_name: str
+        :param response: The jsonrpc response.
+        :type response: dict
+        """
+        self.metrics.requests.inc((method_name, ))
+        if 'error' in response:
+            self.metrics.errors.inc(
+                (method_name, str(response['error']['code'])))
+            self._last_error = {
+                'method': method_name,
+                'code': response['error']['code'],
+                'message': response['error']['message'],
+                'time': time(),
+            }
+
+    def _prepare_call(self, body, message, response):
+        """
+        Decodes a message and finds the on_* method and arguments to call.
+        The response id is filled in as soon as it is known.
+
+        :param body: Body of the message.
+        :type body: dict or json string
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :param response: The jsonrpc response being built.
+        :type response: dict
+        :returns: The MethodBinder, positional and keyword arguments or
+                  None if the message is not a jsonrpc call for this
+                  service.
+        :rtype: tuple or None
+        """
+        expected_method = message.delivery_info['routing_key'].rsplit(
+            '.', 1)[1]
+
+        body = self._decode(body, message)
+
+        # If we have a method and it matches the routing key treat it
+        # as a jsonrpc call
+        if (
+                isinstance(body, dict) and
+                'method' in body.keys() and
+                body.get('method') == expected_method):
+            return self._bind(body, message, response)
+
+        # Drop it
+        log_event(
+            self.logger, logging.ERROR, 'message.dropped',
+            payload=body, properties=message.properties)
+        return None
+
+    def _decode(self, body, message):
+        """
+        Decodes a message body if needed and keeps the result on the
+        message as jsonrpc_request so handlers need not decode it again.
+
+        :param body: Body of the message.
+        :type body: dict, list or json string
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: The decoded body.
+        :rtype: mixed
+        :raises: commissaire_service.service.codec.DecodeError
+        """
+        # If we don't have a dict then it should be a json string
+        if isinstance(body, (str, bytes)):
+            body = codec.loads(body)
+        message.jsonrpc_request = body
+        return body
+
+    def _bind(self, request, message, response):
+        """
+        Finds the on_* method for a jsonrpc request and binds its params.
+        The response id is filled in first.
+
+        :param request: The jsonrpc request.
+        :type request: dict
+        :param message: The message to pass to the method.
+        :type message: kombu.message.Message
+        :param response: The jsonrpc response being built.
+        :type response: dict
+        :returns: The MethodBinder, positional and keyword arguments.
+        :rtype: tuple
+        :raises: AttributeError, InvalidParamsError
+        """
+        response['id'] = request.get('id', -1)
+        binder = self._get_binder(request['method'])
+        args, kwargs = binder.bind(message, request.get('params', {}))
+        return binder, args, kwargs
+
+    def _get_binder(self, method_name):
+        """
+        Returns the MethodBinder for a bus method. Methods added to the
+        instance after it was created are looked up and remembered.
+
+        :param method_name: The bus method name.
+        :type method_name: str
+        :returns: The binder for the method.
+        :rtype: commissaire_service.service.dispatch.MethodBinder
+        :raises: AttributeError
+        """
+        binder = self._dispatch.get(method_name)
+        if binder is None:
+            attr = 'on_{}'.format(method_name)
+            if attr in RESERVED_HANDLERS:
+                raise AttributeError(
+                    '{} is not exposed on the bus'.format(attr))
+            binder = MethodBinder(method_name, getattr(self, attr))
+            self._dispatch[method_name] = binder
+        return binder
+
+    def _set_result(self, response, result):
+        """
+        Adds a method result to a response.
+
+        :param response: The jsonrpc response being built.
+        :type response: dict
+        :param result: The result of the on_* method.
+        :type result: mixed
+        """
+        response['result'] = result
+        log_event(
+            self.logger, logging.DEBUG, 'message.result',
+            id=response['id'], result=result)
+
+    def _set_error(self, response, error):
+        """
+        Adds an error raised while handling a message to a response.
+
+        :param response: The jsonrpc response being built.
+        :type response: dict
+        :param error: The exception which was raised.
+        :type error: Exception
+        """
+        # Subclasses of RemoteProcedureCallError are re-created and
+        # raised on the client-side.
+        if isinstance(error, RemoteProcedureCallError):
+            response['error'] = {
+                'code': error.code,
+                'message': str(error),
+                'data': error.data
+            }
+        else:
+            jsonrpc_error_code = C.JSONRPC_ERRORS['INVALID_REQUEST']
+            # If there is an attribute error then use the Method Not Found
+            # code in the error response
+            if type(error) is AttributeError:
+                jsonrpc_error_code = C.JSONRPC_ERRORS['METHOD_NOT_FOUND']
+            elif type(error) is InvalidParamsError:
+                jsonrpc_error_code = JSONRPC_INVALID_PARAMS
+            elif isinstance(error, codec.DecodeError):
+                jsonrpc_error_code = C.JSONRPC_ERRORS['INVALID_JSON']
+            response['error'] = {
+                'code': jsonrpc_error_code,
+                'message': str(error),
+                'data': {
+                    'exception': str(type(error))
+                }
+            }
+            self._exception_logger.log(
+                error, 'message.exception', id=response['id'])
+
+    def _finish(self, message, response):
+        """
+        Replies to a message if needed and acks it.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :param response: The jsonrpc response(s) or None for no reply.
+        :type response: dict, list or None
+        """
+        if self._drain_deadline is not None and (
+                id(message) not in self._in_flight):
+            # Requeued when the drain ran out of time
+            return
+        if response is not None and message.properties.get('reply_to'):
+            log_event(
+                self.logger, logging.DEBUG, 'message.reply',
+                reply_to=message.properties['reply_to'])
+            started = monotonic()
+            body, publish_kwargs = codec.encode_reply(
+                response, codec.reply_serializer(message))
+            publish_kwargs.update(self._compress(message, body))
+            with self._reply_lock:
+                self._replies.publish(
+                    body, message.properties['reply_to'], **publish_kwargs)
+            self.metrics.reply_latency.observe(monotonic() - started)
+
+        message.ack()
+        received_at = getattr(message, 'received_at', None)
+        if received_at is not None:
+            self.metrics.ack_latency.observe(monotonic() - received_at)
+        self._forget(message)
+        log_event(
+            self.logger, logging.DEBUG, 'message.ack',
+            delivery_tag=message.delivery_tag,
+            acknowledged=message.acknowledged)
+
+    def _compress(self, message, body):
+        """
+        Returns the publish arguments which compress a reply when the
+        requester accepts a compression and the reply is large enough.
+
+        :param message: The request message.
+        :type message: kombu.message.Message
+        :param body: The encoded reply, see codec.encode_reply.
+        :type body: str or bytes
+        :returns: Keyword arguments for Producer.publish.
+        :rtype: dict
+        """
+        name = codec.reply_compression(message, self._compression)
+        if name is None:
+            return {}
+        if len(body) < self._compression_threshold:
+            return {}
+        return {'compression': name}
+
+    def get_deadline(self, message):
+        """
+        Returns the time after which the caller of a request stops waiting.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: Seconds since the epoch or None if there is no deadline.
+        :rtype: float or None
+        """
+        return read_deadline(message)
+
+    def time_remaining(self, message):
+        """
+        Returns how long the caller of a request still waits.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: Seconds left or None if there is no deadline.
+        :rtype: float or None
+        """
+        return time_remaining(read_deadline(message))
+
+    def _with_deadline(self, deadline, kwargs):
+        """
+        Adds a deadline to the publish arguments of a nested request.
+        Without an explicit deadline the one of the request being handled
+        by the current thread is used.
+
+        :param deadline: Seconds since the epoch or None.
+        :type deadline: float or None
+        :param kwargs: Keyword arguments for Producer.publish.
+        :type kwargs: dict
+        :returns: The seconds left or None if there is no deadline.
+        :rtype: float or None
+        :raises: commissaire_service.service.deadlines.DeadlineExceededError
+        """
+        if deadline is None:
+            deadline = self._context.deadline
+        remaining = time_remaining(deadline)
+        if remaining is None:
+            return None
+        if remaining <= 0:
+            raise DeadlineExceededError(
+                'Deadline passed {:.3f}s before the request was sent'.format(
+                    -remaining))
+        kwargs['headers'] = deadline_headers(deadline, kwargs.get('headers'))
+        kwargs.setdefault('expiration', remaining)
+        return remaining
+
+    def _request_headers(self, span, headers):
+        """
+        Returns the headers of an outgoing request: the trace and the
+        compressions replies may use.
+
+        :param span: The span of the request.
+        :type span: commissaire_service.service.tracing.Span
+        :param headers: Other headers to send.
+        :type headers: dict or None
+        :returns: The headers to publish with.
+        :rtype: dict
+        """
+        headers = trace_headers(span, headers)
+        if self._compression:
+            headers[codec.ACCEPT_ENCODING_HEADER] = ', '.join(
+                self._compression)
+        return headers
+
+    def _request_timeout(self, deadline, timeout, kwargs):
+        """
+        Adds the deadline to the publish arguments of a request and returns
+        how long to wait for the reply. A timeout is also sent as the
+        deadline when there is none.
+
+        :param deadline: Seconds since the epoch or None.
+        :type deadline: float or None
+        :param timeout: Seconds to wait for the reply or None to block.
+        :type timeout: float or None
+        :param kwargs: Keyword arguments for Producer.publish.
+        :type kwargs: dict
+        :returns: Seconds to wait for the reply or None to block.
+        :rtype: float or None
+        :raises: commissaire_service.service.deadlines.DeadlineExceededError
+        """
+        if deadline is None and self._context.deadline is None and (
+                timeout is not None):
+            deadline = time() + timeout
+        remaining = self._with_deadline(deadline, kwargs)
+        if remaining is not None:
+            timeout = remaining if timeout is None else min(
+                timeout, remaining)
+        return timeout
+
+    def _send_request(self, routing_key, body, timeout=None, **kwargs):
+        """
+        Publishes an encoded request on a lent connection and waits for
+        the reply on a queue of its own.
+
+        :param routing_key: Routing key to publish on.
+        :type routing_key: str
+        :param body: The encoded jsonrpc request or batch.
+        :type body: str
+        :param timeout: Seconds to wait for the reply or None to block.
+        :type timeout: float or None
+        :param kwargs: Keyword arguments to pass to Producer.publish, such
+                       as headers and expiration.
+        :type kwargs: dict
+        :returns: The decoded reply.
+        :rtype: dict or list
+        :raises: queue.Empty
+        """
+        # Large requests, like batches of saves, are compressed
+        if self._compression and len(body) >= self._compression_threshold:
+            kwargs.setdefault('compression', self._compression[0])
+        reply_to = 'response-{}'.format(uuid.uuid4())
+        with self._lend_bus() as bus:
+            queue = bus.connection.SimpleQueue(
+                reply_to, queue_opts={'auto_delete': True, 'durable': False})
+            try:
+                bus.producer.publish(
+                    body, routing_key,
+                    declare=[self._exchange],
+                    content_type=codec.CONTENT_TYPE_JSON,
+                    content_encoding='utf-8',
+                    reply_to=reply_to, **kwargs)
+                reply = queue.get(block=True, timeout=timeout)
+                reply.ack()
+            finally:
+                queue.close()
+
+        payload = reply.payload
+        if isinstance(payload, (str, bytes)):
+            payload = codec.loads(payload)
+        return payload
+
+    def request(self, routing_key, method=None, params=None, timeout=None,
+                deadline=None, lane=None, **kwargs):
+        """
+        Sends a request and waits for the response. Overridden so worker
+        threads send on pooled connections, and so requests made while
+        handling a message carry its deadline and trace.
+
+        :param routing_key: Routing key of the method to call.
+        :type routing_key: str
+        :param method: The method to call. Defaults to the last part of
+                       the routing key.
+        :type method: str or None
+        :param params: Positional or named params of the method.
+        :type params: list, dict or None
+        :param timeout: Seconds to wait for the reply or None to block.
+                        Also sent as the deadline when there is none.
+        :type timeout: float or None
+        :param deadline: Seconds since the epoch after which the reply is
+                         useless. Defaults to the deadline of the request
+                         being handled.
+        :type deadline: float or None
+        :param lane: Priority lane of the receiving service to use.
+        :type lane: str or None
+        :param kwargs: Keyword arguments to pass to Producer.publish.
+        :type kwargs: dict
+        :returns: The jsonrpc response.
+        :rtype: dict
+        :raises: commissaire.bus.RemoteProcedureCallError or the subclass
+                 the called method raised, queue.Empty,
+                 commissaire_service.service.deadlines.DeadlineExceededError,
+                 commissaire_service.service.limits.ServiceBusyError
+        """
+        if method is None:
+            method = routing_key.rsplit('.', 1)[-1]
+        timeout = self._request_timeout(deadline, timeout, kwargs)
+        body = codec.dumps({
+            'jsonrpc': '2.0',
+            'id': str(uuid.uuid4()),
+            'method': method,
+            'params': {} if params is None else params,
+        })
+        with self._tracer.span(routing_key, KIND_CLIENT) as span:
+            kwargs['headers'] = self._request_headers(
+                span, kwargs.get('headers'))
+            response = self._send_request(
+                lane_routing_key(routing_key, lane), body, timeout, **kwargs)
+            if 'error' in response:
+                error = rebuild_error(response['error'])
+                if not isinstance(error, ServiceBusyError) and (
+                        retry_after(error) is not None):
+                    error = ServiceBusyError(str(error), error.data)
+                raise error
+        return response
+
+    def notify(self, *args, **kwargs):
+        """
+        Sends a notification. Overridden so worker threads send on pooled
+        connections.
+
+        :param args: Positional arguments for BusMixin.notify.
+        :type args: tuple
+        :param kwargs: Keyword arguments for BusMixin.notify.
+        :type kwargs: dict
+        """
+        with self._lend_bus():
+            return super().notify(*args, **kwargs)
+
+    def request_batch(
+            self, routing_key, calls, timeout=None, deadline=None, lane=None,
+            **kwargs):
+        """
+        Sends several requests to a service as one JSON-RPC batch and waits
+        for the reply.
+
+        :param routing_key: Routing key of the service, for example
+                            "storage.batch". Only the service part matters.
+        :type routing_key: str
+        :param calls: (method, params) pairs to call in order.
+        :type calls: list
+        :param timeout: Seconds to wait for the reply or None to block.
+                        Also sent as the deadline when there is none.
+        :type timeout: float or None
+        :param deadline: Seconds since the epoch after which the reply is
+                         useless. Defaults to the deadline of the request
+                         being handled.
+        :type deadline: float or None
+        :param lane: Priority lane of the receiving service to use.
+        :type lane: str or None
+        :param kwargs: Keyword arguments to pass to Producer.publish.
+        :type kwargs: dict
+        :returns: The jsonrpc responses, in the order of calls.
+        :rtype: list
+        :raises: commissaire.bus.RemoteProcedureCallError, queue.Empty,
+                 commissaire_service.service.limits.ServiceBusyError
+        """
+        timeout = self._request_timeout(deadline, timeout, kwargs)
+        requests = [{
+            'jsonrpc': '2.0',
+            'id': str(uuid.uuid4()),
+            'method': method,
+            'params': params,
+        } for method, params in calls]
+        with self._tracer.span(
+                routing_key, KIND_CLIENT, calls=len(calls)) as span:
+            kwargs['headers'] = self._request_headers(
+                span, kwargs.get('headers'))
+            payload = self._send_request(
+                lane_routing_key(routing_key, lane), codec.dumps(requests),
+                timeout, **kwargs)
+        if isinstance(payload, dict):
+            # The batch as a whole was rejected
+            raise rebuild_error(payload['error'])
+        by_id = dict((x.get('id'), x) for x in payload)
+        return [by_id.get(x['id']) for x in requests]
+
+    def get_models(self, *model_instances, timeout=None):
+        """
+        Gets several models from the storage service in one round trip.
+
+        :param model_instances: Models with enough data to identify them.
+        :type model_instances: commissaire.models.Model
+        :param timeout: Seconds to wait for storage. Defaults to the
+                        storage_timeout configuration key.
+        :type timeout: float or None
+        :returns: The full models, in the order given.
+        :rtype: list
+        :raises: commissaire.bus.RemoteProcedureCallError or the subclass
+                 storage raised, such as commissaire.bus.StorageLookupError,
+                 queue.Empty
+        """
+        if timeout is None:
+            timeout = self._storage_timeout
+        responses = self.request_batch('storage.batch', [
+            ('get', {
+                'model_type_name': model.__class__.__name__,
+                'model_json_data': model.to_dict(),
+            }) for model in model_instances], timeout=timeout)
+        results = []
+        for index, (model, response) in enumerate(
+                zip(model_instances, responses)):
+            if response is None:
+                raise RemoteProcedureCallError(
+                    'Storage sent no response for {} #{} of the '
+                    'batch'.format(model.__class__.__name__, index))
+            if 'error' in response:
+                raise rebuild_error(response['error'])
+            results.append(model.__class__.new(**response['result']))
+        return results
+
+    def respond(self, queue_name, id, payload, message=None, **kwargs):
+        """
+        Sends a response to a reply queue. Responses are sent back to a
+        request and never should be the owner of the queue.
+
+        :param queue_name: The name of the queue to use.
+        :type queue_name: str
+        :param id: The unique request id
+        :type id: str
+        :param payload: The content of the message.
+        :type payload: dict
+        :param message: The request being responded to. When given the
+                        response uses the serializer and compression the
+                        requester asked for.
+        :type message: kombu.message.Message or None
+        :param kwargs: Keyword arguments to pass to SimpleQueue. When given
+                       the reply is sent through a one-off SimpleQueue
+                       instead of the shared reply publisher.
+        :type kwargs: dict
+        """
+        jsonrpc_msg = {
+            'jsonrpc': "2.0",
+            'id': id,
+            'result': payload,
+        }
+        log_event(
+            self.logger, logging.DEBUG, 'response.send',
+            queue=queue_name, jsonrpc=jsonrpc_msg)
+        started = monotonic()
+        body, publish_kwargs = codec.encode_reply(
+            jsonrpc_msg, message and codec.reply_serializer(message))
+        if message:
+            publish_kwargs.update(self._compress(message, body))
+        if kwargs:
+            with self._bus_lock:
+                send_queue = self.connection.SimpleQueue(queue_name, **kwargs)
+                send_queue.put(body, **publish_kwargs)
+                send_queue.close()
+        else:
+            with self._reply_lock:
+                self._replies.publish(body, queue_name, **publish_kwargs)
+        self.metrics.reply_latency.observe(monotonic() - started)
+        log_event(self.logger, logging.DEBUG, 'response.sent', id=id)
+
+    def invalidate_cache(self, method_name, *args, **kwargs):
+        """
+        Drops cached results of a @cacheable method. With no params every
+        result of the method is dropped, otherwise only the result for
+        the given params.
+
+        :param method_name: The bus method name.
+        :type method_name: str
+        :param args: Positional params of the method, without the message.
+        :type args: tuple
+        :param kwargs: Named params of the method, without the message.
+        :type kwargs: dict
+        :raises: KeyError
+        """
+        self._result_caches[method_name].invalidate(*args, **kwargs)
+
+    def on_stats(self, message):
+        """
+        Returns the metrics of the service.
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :returns: Mapping of metric name to its type and values.
+        :rtype: dict
+        """
+        return self.metrics.snapshot()
+
+    def on_ping(self, message):
+        """
+        Answers health checks. Every service answers <prefix>.ping on the
+        consumer thread, so a reply means messages are being taken.
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :returns: The status, service name, pid, uptime and in flight count.
+        :rtype: dict
+        """
+        return {
+            'status': 'ok' if self._drain_deadline is None else 'draining',
+            'service': self.__class__.__name__,
+            'pid': os.getpid(),
+            'uptime': monotonic() - self._started_at,
+            'in_flight': len(self._in_flight),
+        }
+
+    def on_introspect(self, message):
+        """
+        Describes the process answering. Every service answers
+        <prefix>.introspect.
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :returns: The ping details plus the start time, messages handled,
+                  queue bindings, bus methods, configuration digest and
+                  last error.
+        :rtype: dict
+        """
+        details = self.on_ping(message)
+        details.update({
+            'started': self._started_time,
+            'handled': sum(
+                value for _, _, value in self.metrics.requests.samples()),
+            'queues': [{
+                'name': queue.name,
+                'exchange': queue.exchange.name,
+                'routing_key': queue.routing_key,
+            } for queue in self._queues],
+            'methods': sorted(self._dispatch),
+            'config_digest': self._config_digest,
+            'last_error': self._last_error,
+        })
+        return details
+
+    def onconnection_revived(self):  # pragma: no cover
+        """
+        Called when a reconnection occurs.
+        """
+        self.logger.info('Connection (re)established')
+
+    def on_consume_ready(
+            self, connection, channel, consumers):  # pragma: no cover
+        """
+        Called when the service is ready to consume messages.
+
+        :param connection: The current connection instance.
+        :type connection: kombu.Connection
+        :param channel: The current channel.
+        :type channel: kombu.transport.*.Channel
+        :param consumers: A list of consumers.
+        :type consumers: list
+        """
+        self.logger.info('Ready to consume')
+        self._consumers = list(consumers)
+        if self._drain_deadline is not None:
+            self._drain_step()
+        if self.logger.level == logging.DEBUG:
+            queue_names = []
+            for consumer in consumers:
+                queue_names += [x.name for x in consumer.queues]
+            self.logger.debug(
+                'Consuming via connection "{}" and channel "{}" on '
+                'the following queues: "{}"'.format(
+                    connection.as_uri(), channel, '", "'.join(queue_names)))
+
+    def on_consume_end(self, connection, channel):  # pragma: no cover
+        """
+        Called when the service stops consuming.
+
+        :param connection: The current connection instance.
+        :type connection: kombu.Connection
+        :param channel: The current channel.
+        :type channel: kombu.transport.*.Channel
+        """
+        self.logger.warn('Consuming has ended')
+        while self._isolation_channels:
+            self._isolation_channels.pop().close()
+        self._bus_pool.close()
+        if self._tracer.exporter is not None:
+            self._tracer.exporter.flush()
+
+
+class AsyncCommissaireService(CommissaireService):
+    """
+    Commissaire service class running handlers on an asyncio event loop.
+
+    ``on_*`` methods may be coroutine functions (``async def``). Many
+    requests can then be in flight at once, bounded by prefetch_count.
+    Plain ``on_*`` methods are run in an executor so they do not block the
+    loop. Replies are handed back to the consumer thread for publishing.
+    """
+
+    #: Default maximum number of requests in flight if the configuration
+    #: file does not give a prefetch_count.
+    _default_prefetch_count = 100
+
+    #: Handlers share the event loop and executor, not per-method pools
+    _supports_isolation_pools = False
+
+    def __init__(
+            self, exchange_name, connection_url, qkwargs, config_file=None):
+        """
+        Initializes a new AsyncCommissaireService instance.
+
+        :param exchange_name: Name of the topic exchange.
+        :type exchange_name: str
+        :param connection_url: Kombu connection url.
+        :type connection_url: str
+        :param qkwargs: One or more dicts keyword arguments for queue creation
+        :type qkwargs: list
+        :param config_file: Path to the configuration file location.
+        :type config_file: str or None
+        """
+        super().__init__(
+            exchange_name, connection_url, qkwargs, config_file=config_file)
+        self._prefetch_count = self._config_data.get(
+            'prefetch_count', self._default_prefetch_count)
+        # Plain handlers and nested requests each hold an executor thread
+        # and a pooled connection, so both allow a request in flight each
+        # unless max_workers says otherwise.
+        workers = int(self._config_data.get('max_workers', 0)) or (
+            self._prefetch_count or self._default_prefetch_count)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._bus_pool = BusPool(
+            self.connection, self._exchange,
+            self._config_data.get('bus_pool_size', workers))
+        # asyncio is only loaded by services which use it
+        import asyncio
+        import contextvars
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = None
+        # The span and deadline of the call each task is running, for
+        # the executor threads its nested requests run on
+        self._call_scope = contextvars.ContextVar(
+            'call_scope', default=(None, None))
+
+    def _start_loop(self):
+        """
+        Runs the event loop on a background thread if it is not running.
+        """
+        if self._loop_thread is not None:
+            return
+        self._loop_thread = threading.Thread(
+            target=self._loop.run_forever, daemon=True,
+            name='{}-loop'.format(self.__class__.__name__))
+        self._loop_thread.start()
+
+    def _before_consume(self, kwargs):
+        """
+        Makes sure the event loop is running before consuming.
+
+        :param kwargs: Keyword arguments for ConsumerMixin.consume.
+        :type kwargs: dict
+        """
+        self._start_loop()
+        kwargs.setdefault('safety_interval', self._completion_interval)
+
+    def on_message(self, body, message):
+        """
+        Called when a new message arrives. Schedules the handler on the
+        event loop and returns right away.
+
+        :param body: Body of the message.
+        :type body: dict or json string
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        """
+        log_event(
+            self.logger, logging.DEBUG, 'message.received',
+            delivery_tag=message.delivery_tag, body=body)
+        import asyncio
+        self._received(message)
+        if self._method_of(message) in HEALTH_METHODS:
+            self._finish(message, self._handle(body, message))
+            return
+        if not self._admit(body, message):
+            return
+        asyncio.run_coroutine_threadsafe(
+            self._handle_async(body, message), self._loop)
+
+    async def _handle_async(self, body, message):
+        """
+        Calls the on_* method for a message on the event loop and queues
+        the response for the consumer thread.
+
+        :param body: Body of the message.
+        :type body: dict or json string
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        """
+        if not self._claim(message):
+            # Requeued by a drain, another process handles it
+            return
+        if self._expired(message, read_deadline(message)):
+            self._completed.append((message, None))
+            return
+        # If we don't get a valid message we default to -1 for the id
+        response = {'jsonrpc': '2.0', 'id': -1}
+        method_name = METHOD_UNKNOWN
+        try:
+            body = self._decode(body, message)
+            if type(body) is list:
+                response = await self._handle_batch_async(body, message)
+                method_name = None
+            else:
+                call = self._prepare_call(body, message, response)
+                if call is not None:
+                    binder, args, kwargs = call
+                    method_name = binder.name
+                    await self._call_async(
+                        binder, args, kwargs, response, read_trace(message),
+                        read_deadline(message))
+        except Exception as error:
+            self._set_error(response, error)
+        if method_name is not None:
+            self._count_request(method_name, response)
+        self._completed.append((message, response))
+
+    async def _handle_batch_async(self, batch, message):
+        """
+        Calls the on_* methods for a batch request concurrently on the
+        event loop and builds the reply.
+
+        :param batch: The decoded batch.
+        :type batch: list
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: The jsonrpc responses or None if all were notifications.
+        :rtype: list or None
+        :raises: ValueError
+        """
+        import asyncio
+        check_batch(batch)
+        responses = await asyncio.gather(
+            *[self._handle_element_async(x, message) for x in batch])
+        return batch_reply(responses)
+
+    async def _handle_element_async(self, request, message):
+        """
+        Calls the on_* method for one element of a batch request. The
+        element counts against the in flight limit of its method.
+
+        :param request: The batch element.
+        :type request: mixed
+        :param message: The message carrying the batch.
+        :type message: kombu.message.Message
+        :returns: The jsonrpc response or None for a notification.
+        :rtype: dict or None
+        """
+        response = {'jsonrpc': '2.0', 'id': -1}
+        method_name = METHOD_UNKNOWN
+        try:
+            check_element(request)
+            binder, args, kwargs = self._bind(
+                request, BatchElementMessage(message, request), response)
+            method_name = binder.name
+            with self._element_limit(method_name, message):
+                await self._call_async(
+                    binder, args, kwargs, response, read_trace(message),
+                    read_deadline(message))
+        except Exception as error:
+            self._set_error(response, error)
+        self._count_request(method_name, response)
+        if is_notification(request):
+            return None
+        return response
+
+    async def _call_async(
+            self, binder, args, kwargs, response, parent=None, deadline=None):
+        """
+        Calls an on_* method and adds its result to a response. Coroutine
+        functions are awaited, other methods run on the worker pool.
+        Either way requests made by the method continue its span and carry
+        the deadline.
+
+        :param binder: The binder of the method.
+        :type binder: commissaire_service.service.dispatch.MethodBinder
+        :param args: Positional arguments for the method.
+        :type args: tuple
+        :param kwargs: Keyword arguments for the method.
+        :type kwargs: dict
+        :param response: The jsonrpc response being built.
+        :type response: dict
+        :param parent: The span the request was sent from.
+        :type parent: commissaire_service.service.tracing.SpanContext or None
+        :param deadline: The deadline of the request.
+        :type deadline: float or None
+        """
+        import asyncio
+        key = self._idempotency_key(binder, response)
+        if key is not None and self._replay(key, response):
+            return
+        # The event loop runs many calls at once, so the span can not be
+        # the thread's current span. Each call runs in its own task, which
+        # has its own copy of _call_scope.
+        span = self._tracer.start_span(binder.name, KIND_SERVER, parent)
+        self._call_scope.set((span, deadline))
+        started = self._call_started(binder.name)
+        try:
+            if asyncio.iscoroutinefunction(binder.method):
+                result = await binder.method(*args, **kwargs)
+            else:
+                result = await self._loop.run_in_executor(
+                    self._executor, functools.partial(
+                        self._in_call_scope, span, deadline, binder.method,
+                        *args, **kwargs))
+        except Exception as error:
+            span.tag('error', '{}: {}'.format(type(error).__name__, error))
+            self._release(key)
+            raise
+        finally:
+            self._call_finished(binder.name, started)
+            self._tracer.finish_span(span)
+        self._set_result(response, result)
+        if key is not None:
+            self._responses.set(key, {'result': result})
+
+    def _in_call_scope(self, span, deadline, fn, *args, **kwargs):
+        """
+        Calls a function on an executor thread with the span and deadline
+        of the call it was made for as the thread's own.
+
+        :param span: The span of the call.
+        :type span: commissaire_service.service.tracing.Span or None
+        :param deadline: The deadline of the call.
+        :type deadline: float or None
+        :param fn: The function to call.
+        :type fn: callable
+        :param args: Positional arguments for fn.
+        :type args: tuple
+        :param kwargs: Keyword arguments for fn.
+        :type kwargs: dict
+        :returns: The result of fn.
+        :rtype: mixed
+        """
+        with self._context.scope(deadline), self._tracer.scope(span):
+            return fn(*args, **kwargs)
+
+    async def request_async(self, *args, **kwargs):
+        """
+        Sends a request from a coroutine without blocking the event loop.
+        Requests made while handling a message continue its trace and
+        carry its deadline.
+
+        :param args: Positional arguments for request.
+        :type args: tuple
+        :param kwargs: Keyword arguments for request.
+        :type kwargs: dict
+        :returns: The jsonrpc response.
+        :rtype: dict
+        """
+        span, deadline = self._call_scope.get()
+        result = await self._loop.run_in_executor(
+            self._executor, functools.partial(
+                self._in_call_scope, span, deadline, self.request,
+                *args, **kwargs))
+        return result
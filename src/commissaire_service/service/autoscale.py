@@ -0,0 +1,220 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Queue backlog driven scaling of ServiceManager processes.
+"""
+
+import math
+
+from kombu import Connection
+from kombu.exceptions import ChannelError
+
+
+class QueueBacklog:
+    """
+    Measures how many messages are waiting on a set of named queues.
+
+    Queues are declared passively so nothing is created. On Redis this is
+    the length of the queue lists.
+    """
+
+    def __init__(self, connection_url, queue_names):
+        """
+        Initializes a new QueueBacklog instance.
+
+        :param connection_url: Kombu connection url.
+        :type connection_url: str
+        :param queue_names: Names of the queues to measure.
+        :type queue_names: list
+        """
+        self.connection_url = connection_url
+        self.queue_names = list(queue_names)
+        self.connection = None
+
+    def __call__(self):
+        """
+        Returns the number of messages waiting on the queues. Queues which
+        do not exist yet count as empty.
+
+        :returns: The backlog.
+        :rtype: int
+        """
+        if self.connection is None:
+            self.connection = Connection(self.connection_url)
+        channel = self.connection.default_channel
+        backlog = 0
+        for name in self.queue_names:
+            try:
+                _, message_count, _ = channel.queue_declare(
+                    queue=name, passive=True)
+            except ChannelError:
+                continue
+            backlog += message_count
+        return backlog
+
+    def close(self):
+        """
+        Releases the connection. The next call opens a new one.
+        """
+        if self.connection is not None:
+            self.connection.release()
+            self.connection = None
+
+
+class Autoscaler:
+    """
+    Decides how many processes should run from periodic backlog samples.
+
+    The wait a new message would see is estimated from the backlog and the
+    rate at which it has been draining. Processes are added when the
+    backlog per process or that estimate stay above their thresholds for
+    scale_up_samples samples in a row, and retired one at a time when the
+    backlog per process stays at or below scale_down_backlog for
+    scale_down_samples samples. The gap between the thresholds and the
+    sample counts keeps bursts from flapping the process count.
+    """
+
+    def __init__(
+            self, min_workers, max_workers, interval=5.0,
+            scale_up_backlog=10, scale_down_backlog=0, target_latency=None,
+            scale_up_samples=2, scale_down_samples=12):
+        """
+        Initializes a new Autoscaler instance.
+
+        :param min_workers: The fewest processes to run.
+        :type min_workers: int
+        :param max_workers: The most processes to run.
+        :type max_workers: int
+        :param interval: Seconds between backlog samples.
+        :type interval: float
+        :param scale_up_backlog: Waiting messages per process above which
+                                 processes are added.
+        :type scale_up_backlog: int
+        :param scale_down_backlog: Waiting messages per process at or below
+                                   which processes are retired.
+        :type scale_down_backlog: int
+        :param target_latency: Seconds of estimated wait above which
+                               processes are added, or None to ignore it.
+        :type target_latency: float or None
+        :param scale_up_samples: Samples in a row needed to add processes.
+        :type scale_up_samples: int
+        :param scale_down_samples: Samples in a row needed to retire one.
+        :type scale_down_samples: int
+        :raises: ValueError
+        """
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError(
+                'Expected 1 <= min_workers <= max_workers, got {} and '
+                '{}'.format(min_workers, max_workers))
+        if scale_down_backlog >= scale_up_backlog:
+            raise ValueError(
+                'scale_down_backlog must be lower than scale_up_backlog')
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.scale_up_backlog = scale_up_backlog
+        self.scale_down_backlog = scale_down_backlog
+        self.target_latency = target_latency
+        self.scale_up_samples = max(scale_up_samples, 1)
+        self.scale_down_samples = max(scale_down_samples, 1)
+        #: Smoothed messages drained per second, None until measured
+        self.drain_rate = None
+        self._previous = None
+        self._above = 0
+        self._below = 0
+
+    def clamp(self, workers):
+        """
+        Returns workers limited to the min and max.
+
+        :param workers: A process count.
+        :type workers: int
+        :returns: The process count within the limits.
+        :rtype: int
+        """
+        return min(max(workers, self.min_workers), self.max_workers)
+
+    def estimated_latency(self, backlog):
+        """
+        Returns how long a new message would wait for the backlog to drain.
+
+        :param backlog: The number of waiting messages.
+        :type backlog: int
+        :returns: Seconds, infinite if the backlog is not draining.
+        :rtype: float
+        """
+        if not backlog:
+            return 0.0
+        if not self.drain_rate:
+            return float('inf')
+        return backlog / self.drain_rate
+
+    def _update_drain_rate(self, backlog):
+        """
+        Updates the smoothed drain rate from a new sample.
+        """
+        if self._previous is not None:
+            if backlog < self._previous:
+                rate = (self._previous - backlog) / self.interval
+                if self.drain_rate is None:
+                    self.drain_rate = rate
+                else:
+                    self.drain_rate = 0.7 * self.drain_rate + 0.3 * rate
+            elif backlog > self._previous and self.drain_rate:
+                # Falling behind; decay the estimate
+                self.drain_rate *= 0.7
+        self._previous = backlog
+
+    def decide(self, workers, backlog):
+        """
+        Records a backlog sample and returns how many processes should run.
+
+        :param workers: How many processes run now.
+        :type workers: int
+        :param backlog: The number of waiting messages.
+        :type backlog: int
+        :returns: The process count to run.
+        :rtype: int
+        """
+        self._update_drain_rate(backlog)
+        per_worker = backlog / max(workers, 1)
+
+        behind = per_worker > self.scale_up_backlog or (
+            self.target_latency is not None and
+            self.drain_rate is not None and
+            per_worker > self.scale_down_backlog and
+            self.estimated_latency(backlog) > self.target_latency)
+        if behind:
+            self._above += 1
+            self._below = 0
+        elif per_worker <= self.scale_down_backlog:
+            self._below += 1
+            self._above = 0
+        else:
+            self._above = self._below = 0
+
+        target = workers
+        if self._above >= self.scale_up_samples:
+            # Enough processes to bring the backlog under the threshold
+            target = max(
+                workers + 1,
+                int(math.ceil(backlog / float(self.scale_up_backlog))))
+        elif self._below >= self.scale_down_samples:
+            target = workers - 1
+
+        target = self.clamp(target)
+        if target != workers:
+            self._above = self._below = 0
+        return target
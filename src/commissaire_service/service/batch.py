@@ -0,0 +1,91 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Helpers for JSON-RPC 2.0 batch requests.
+"""
+
+
+class BatchElementMessage:
+    """
+    The message handed to an on_* method called from a batch. Behaves like
+    the batch message except that jsonrpc_request is the batch element
+    being handled.
+    """
+
+    def __init__(self, message, request):
+        """
+        Initializes a new BatchElementMessage instance.
+
+        :param message: The message carrying the batch.
+        :type message: kombu.message.Message
+        :param request: The batch element.
+        :type request: dict
+        """
+        self.__dict__['message'] = message
+        self.__dict__['jsonrpc_request'] = request
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['message'], name)
+
+    def __setattr__(self, name, value):
+        setattr(self.__dict__['message'], name, value)
+
+
+def check_batch(batch):
+    """
+    Raises if a batch can not be handled at all.
+
+    :param batch: The decoded batch.
+    :type batch: list
+    :raises: ValueError
+    """
+    if not batch:
+        raise ValueError('Batch requests may not be empty')
+
+
+def check_element(request):
+    """
+    Raises if a batch element is not a jsonrpc request object.
+
+    :param request: The batch element.
+    :type request: mixed
+    :raises: ValueError
+    """
+    if not isinstance(request, dict) or not isinstance(
+            request.get('method'), str):
+        raise ValueError('Batch elements must be jsonrpc request objects')
+
+
+def is_notification(request):
+    """
+    Returns True if a batch element expects no response.
+
+    :param request: The batch element.
+    :type request: mixed
+    :rtype: bool
+    """
+    return isinstance(request, dict) and 'id' not in request
+
+
+def batch_reply(responses):
+    """
+    Returns the reply to a batch from its element responses.
+
+    :param responses: Element responses, None for notifications.
+    :type responses: list
+    :returns: The responses to send or None when there is nothing to send.
+    :rtype: list or None
+    """
+    return [r for r in responses if r is not None] or None
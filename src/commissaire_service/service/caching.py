@@ -0,0 +1,215 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Result caching for read-only on_* methods.
+"""
+
+import inspect
+import json
+import threading
+
+from collections import OrderedDict, namedtuple
+from time import monotonic
+
+#: Attribute cacheable() sets on the methods it marks.
+CACHE_ATTRIBUTE = '_commissaire_cacheable'
+
+#: How a method's results are cached.
+CacheOptions = namedtuple('CacheOptions', ('ttl', 'maxsize', 'key'))
+
+
+def default_key(*args, **kwargs):
+    """
+    Builds a cache key from method params.
+
+    :param args: Positional params.
+    :type args: tuple
+    :param kwargs: Named params.
+    :type kwargs: dict
+    :returns: The cache key.
+    :rtype: str
+    """
+    return json.dumps([args, kwargs], sort_keys=True, default=repr)
+
+
+def cacheable(ttl=60, maxsize=128, key=None):
+    """
+    Marks an on_* method as read-only so its results may be cached.
+
+    Results are kept per service instance for ttl seconds, in an LRU of
+    maxsize entries. Errors are never cached. Use
+    CommissaireService.invalidate_cache when the underlying data changes.
+
+    :param ttl: Seconds to keep a result.
+    :type ttl: float
+    :param maxsize: Maximum number of results to keep.
+    :type maxsize: int
+    :param key: Builds the cache key from the method params (not the
+                message). Defaults to default_key.
+    :type key: callable or None
+    :returns: The decorator.
+    :rtype: callable
+    """
+    def decorator(method):
+        setattr(method, CACHE_ATTRIBUTE, CacheOptions(
+            ttl, max(int(maxsize), 1), key or default_key))
+        return method
+    return decorator
+
+
+class ResultCache:
+    """
+    Calls a method through a bounded cache of its results.
+    """
+
+    def __init__(self, name, method, options, hits=None, misses=None):
+        """
+        Initializes a new ResultCache instance.
+
+        :param name: The bus method name.
+        :type name: str
+        :param method: The bound on_* method.
+        :type method: callable
+        :param options: How to cache results.
+        :type options: CacheOptions
+        :param hits: Counter to increment on hits, labelled by method.
+        :type hits: commissaire_service.service.metrics.Counter or None
+        :param misses: Counter to increment on misses, labelled by method.
+        :type misses: commissaire_service.service.metrics.Counter or None
+        """
+        self.name = name
+        self.method = method
+        self.options = options
+        self.hits = 0
+        self.misses = 0
+        self._hit_counter = hits
+        self._miss_counter = misses
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        try:
+            self._signature = inspect.signature(method)
+        except (TypeError, ValueError):
+            self._signature = None
+
+    def _params(self, args, kwargs):
+        """
+        Returns the params of a call, leaving the message out. Params are
+        bound to the method signature first so f(a, b), f(a, b=b) and,
+        when b defaults to b, f(a) give the same params.
+        """
+        if self._signature is not None:
+            bound = self._signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            args, kwargs = bound.args, bound.kwargs
+        if 'message' in kwargs:
+            kwargs = dict(kwargs)
+            del kwargs['message']
+        else:
+            args = args[1:]
+        return args, kwargs
+
+    def _key(self, args, kwargs):
+        """
+        Returns the cache key for a call, leaving the message out.
+        """
+        args, kwargs = self._params(args, kwargs)
+        return self.options.key(*args, **kwargs)
+
+    def _count(self, hit):
+        """
+        Counts a hit or a miss.
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        counter = self._hit_counter if hit else self._miss_counter
+        if counter is not None:
+            counter.inc((self.name, ))
+
+    def __call__(self, *args, **kwargs):
+        """
+        Returns a cached result or calls the method.
+        """
+        key = self._key(args, kwargs)
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                result = entry[1]
+            else:
+                entry = None
+        if entry is not None:
+            self._count(True)
+            return result
+
+        self._count(False)
+        result = self.method(*args, **kwargs)
+        with self._lock:
+            self._entries[key] = (monotonic() + self.options.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.options.maxsize:
+                self._entries.popitem(last=False)
+        return result
+
+    def invalidate(self, *args, **kwargs):
+        """
+        Drops the result for the given params, or every result if no
+        params are given. Params match however the call passed them.
+
+        :param args: Positional params.
+        :type args: tuple
+        :param kwargs: Named params.
+        :type kwargs: dict
+        :raises: TypeError
+        """
+        if not args and not kwargs:
+            with self._lock:
+                self._entries.clear()
+            return
+        # Bound with a stand-in for the message
+        key = self._key((None, ) + args, kwargs)
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+def install_result_caches(table, hits=None, misses=None):
+    """
+    Routes the calls of cacheable methods in a dispatch table through
+    ResultCaches.
+
+    :param table: Mapping of method name to MethodBinder.
+    :type table: dict
+    :param hits: Counter to increment on hits, labelled by method.
+    :type hits: commissaire_service.service.metrics.Counter or None
+    :param misses: Counter to increment on misses, labelled by method.
+    :type misses: commissaire_service.service.metrics.Counter or None
+    :returns: Mapping of method name to ResultCache.
+    :rtype: dict
+    :raises: TypeError
+    """
+    caches = {}
+    for name, binder in table.items():
+        options = getattr(binder.method, CACHE_ATTRIBUTE, None)
+        if options is not None:
+            if inspect.iscoroutinefunction(binder.method):
+                raise TypeError(
+                    'on_{}() is a coroutine and can not be cacheable'.format(
+                        name))
+            caches[name] = binder.method = ResultCache(
+                name, binder.method, options, hits, misses)
+    return caches
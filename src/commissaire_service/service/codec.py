@@ -0,0 +1,282 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+JSON encoding and decoding for bus messages.
+
+The fastest installed backend is used: orjson, then ujson, then the
+standard library json module. The COMMISSAIRE_JSON_BACKEND environment
+variable can force a specific one. Whatever the backend, decoding errors
+are raised as json.JSONDecodeError (or a subclass of it).
+
+Use the module attributes (codec.loads, codec.dumps) rather than importing
+the functions so a later use_backend() call is honored.
+
+Replies may also be sent as msgpack when the requester asks for it, see
+reply_serializer(), and large replies compressed, see reply_compression().
+"""
+
+import json
+import logging
+import os
+
+from kombu import compression, serialization
+
+try:
+    import msgpack  # noqa: F401 (registered with kombu on import)
+    HAVE_MSGPACK = True
+except ImportError:  # pragma: no cover
+    HAVE_MSGPACK = False
+
+#: Content type of JSON messages.
+CONTENT_TYPE_JSON = 'application/json'
+
+#: Content type of msgpack messages.
+CONTENT_TYPE_MSGPACK = 'application/x-msgpack'
+
+#: Content types kombu uses for raw str and bytes bodies. These are always
+#: accepted since bus clients publish JSON documents as plain strings.
+PLAIN_CONTENT_TYPES = ('text/plain', 'application/data')
+
+#: Header listing the compressions a requester can decompress, most
+#: preferred first, for example "zlib, bzip2".
+ACCEPT_ENCODING_HEADER = 'accept-encoding'
+
+#: Backends in order of preference.
+BACKENDS = ('orjson', 'ujson', 'json')
+
+#: Raised when data can not be decoded.
+DecodeError = json.JSONDecodeError
+
+#: Name of the backend in use.
+BACKEND = None
+
+
+def _text(data):
+    """
+    Returns data as a str.
+    """
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return bytes(data).decode('utf-8')
+    return data
+
+
+def _json_backend():
+    """
+    Standard library json functions.
+    """
+    def loads(data):
+        return json.loads(_text(data))
+
+    return loads, json.dumps
+
+
+def _orjson_backend():
+    """
+    orjson functions. Objects orjson can not encode, like integers larger
+    than 64 bits, fall back to the json module.
+    """
+    import orjson
+
+    option = orjson.OPT_NON_STR_KEYS
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj, option=option).decode('utf-8')
+        except orjson.JSONEncodeError:
+            return json.dumps(obj)
+
+    return orjson.loads, dumps
+
+
+def _ujson_backend():
+    """
+    ujson functions. Errors are re-raised as json.JSONDecodeError so they
+    can be told apart from other ValueErrors.
+    """
+    import ujson
+
+    def loads(data):
+        try:
+            return ujson.loads(data)
+        except ValueError as error:
+            raise DecodeError(str(error), str(_text(data)), 0)
+
+    def dumps(obj):
+        try:
+            return ujson.dumps(obj, ensure_ascii=False)
+        except (OverflowError, TypeError):
+            return json.dumps(obj)
+
+    return loads, dumps
+
+
+_BACKEND_FACTORIES = {
+    'orjson': _orjson_backend,
+    'ujson': _ujson_backend,
+    'json': _json_backend,
+}
+
+
+def use_backend(name=None):
+    """
+    Switches the backend used by loads and dumps.
+
+    :param name: Backend name from BACKENDS, or None for the fastest one
+                 installed.
+    :type name: str or None
+    :returns: The name of the backend now in use.
+    :rtype: str
+    :raises: ImportError, ValueError
+    """
+    global BACKEND, loads, dumps
+    if name is not None:
+        if name not in _BACKEND_FACTORIES:
+            raise ValueError('Unknown JSON backend "{}"'.format(name))
+        loads, dumps = _BACKEND_FACTORIES[name]()
+        BACKEND = name
+        return BACKEND
+
+    for candidate in BACKENDS:
+        try:
+            loads, dumps = _BACKEND_FACTORIES[candidate]()
+        except ImportError:
+            continue
+        BACKEND = candidate
+        break
+    logging.getLogger(__name__).debug(
+        'Using the {} JSON backend'.format(BACKEND))
+    return BACKEND
+
+
+#: Decodes a str or bytes JSON document.
+loads = None
+
+#: Encodes an object to a JSON str.
+dumps = None
+
+use_backend(os.environ.get('COMMISSAIRE_JSON_BACKEND') or None)
+
+
+def accept_content(names):
+    """
+    Returns the content types a consumer should accept for a list of
+    kombu serializer names or content types. msgpack is left out when the
+    msgpack package is not installed.
+
+    :param names: Serializer names (json, msgpack) or content types.
+    :type names: list or None
+    :returns: The content types to accept or None for kombu's default.
+    :rtype: list or None
+    """
+    if not names:
+        return None
+    accepted = list(names)
+    if not HAVE_MSGPACK:
+        for name in ('msgpack', CONTENT_TYPE_MSGPACK):
+            if name in accepted:
+                accepted.remove(name)
+                logging.getLogger(__name__).warn(
+                    'Not accepting {} content, msgpack is not '
+                    'installed'.format(name))
+    accepted.extend(x for x in PLAIN_CONTENT_TYPES if x not in accepted)
+    return accepted
+
+
+def reply_serializer(message):
+    """
+    Negotiates the serializer for a reply to message. The requester opts
+    in to msgpack either by sending its request as msgpack or by listing
+    application/x-msgpack in an "accept" header. JSON is used otherwise.
+
+    :param message: The request message.
+    :type message: kombu.message.Message
+    :returns: "msgpack" or None for the default JSON encoding.
+    :rtype: str or None
+    """
+    if not HAVE_MSGPACK:
+        return None
+    headers = message.headers or {}
+    accept = headers.get('accept') or message.content_type
+    if isinstance(accept, str):
+        for content_type in accept.split(','):
+            if content_type.strip() == CONTENT_TYPE_MSGPACK:
+                return 'msgpack'
+    return None
+
+
+def encode_reply(reply, serializer=None):
+    """
+    Encodes a reply once, so its size can be checked before compressing
+    and the same body published.
+
+    :param reply: The jsonrpc response(s).
+    :type reply: dict or list
+    :param serializer: A name from reply_serializer or None for JSON.
+    :type serializer: str or None
+    :returns: The encoded body and the Producer.publish arguments naming
+              its content type.
+    :rtype: tuple
+    """
+    if serializer is None:
+        return dumps(reply), {
+            'content_type': CONTENT_TYPE_JSON, 'content_encoding': 'utf-8'}
+    content_type, content_encoding, body = serialization.dumps(
+        reply, serializer)
+    return body, {
+        'content_type': content_type, 'content_encoding': content_encoding}
+
+
+def compressions(names):
+    """
+    Validates a list of kombu compression names.
+
+    :param names: Compression names such as "zlib" or "bzip2".
+    :type names: list or None
+    :returns: The names, most preferred first.
+    :rtype: tuple
+    :raises: ValueError
+    """
+    names = tuple(names or ())
+    for name in names:
+        try:
+            compression.get_encoder(name)
+        except KeyError:
+            raise ValueError(
+                'Unknown or unavailable compression "{}"'.format(name))
+    return names
+
+
+def reply_compression(message, supported):
+    """
+    Negotiates the compression of a reply to message. The requester lists
+    what it can decompress in an "accept-encoding" header and the first of
+    those also in supported is used.
+
+    :param message: The request message.
+    :type message: kombu.message.Message
+    :param supported: Compression names this side may use.
+    :type supported: tuple
+    :returns: A kombu compression name or None to send uncompressed.
+    :rtype: str or None
+    """
+    headers = message.headers
+    if not supported or not isinstance(headers, dict):
+        return None
+    accept = headers.get(ACCEPT_ENCODING_HEADER)
+    if isinstance(accept, str):
+        for name in accept.split(','):
+            if name.strip() in supported:
+                return name.strip()
+    return None
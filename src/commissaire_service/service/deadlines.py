@@ -0,0 +1,106 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Request deadlines carried in message headers.
+"""
+
+import contextlib
+import threading
+import time
+
+from commissaire.bus import RemoteProcedureCallError
+
+#: Header holding the time, in seconds since the epoch, after which the
+#: caller no longer waits for the reply.
+DEADLINE_HEADER = 'x-commissaire-deadline'
+
+
+class DeadlineExceededError(RemoteProcedureCallError):
+    """
+    Raised when a request would be sent after its deadline.
+    """
+    pass
+
+
+def read_deadline(message):
+    """
+    Returns the deadline of a message.
+
+    :param message: The message instance.
+    :type message: kombu.message.Message
+    :returns: Seconds since the epoch or None if the message has none.
+    :rtype: float or None
+    """
+    headers = getattr(message, 'headers', None)
+    if not isinstance(headers, dict):
+        return None
+    try:
+        return float(headers[DEADLINE_HEADER])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def time_remaining(deadline):
+    """
+    Returns the seconds left before a deadline.
+
+    :param deadline: Seconds since the epoch or None.
+    :type deadline: float or None
+    :returns: Seconds left, negative once passed, or None without deadline.
+    :rtype: float or None
+    """
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def deadline_headers(deadline, headers=None):
+    """
+    Returns message headers carrying a deadline.
+
+    :param deadline: Seconds since the epoch.
+    :type deadline: float
+    :param headers: Other headers to send.
+    :type headers: dict or None
+    :returns: The headers to publish with.
+    :rtype: dict
+    """
+    headers = dict(headers or {})
+    headers[DEADLINE_HEADER] = deadline
+    return headers
+
+
+class DeadlineContext(threading.local):
+    """
+    The deadline of the request being handled by the current thread.
+    """
+
+    #: Seconds since the epoch or None.
+    deadline = None
+
+    @contextlib.contextmanager
+    def scope(self, deadline):
+        """
+        Sets the deadline of the current thread for a block.
+
+        :param deadline: Seconds since the epoch or None.
+        :type deadline: float or None
+        """
+        previous = self.deadline
+        self.deadline = deadline
+        try:
+            yield
+        finally:
+            self.deadline = previous
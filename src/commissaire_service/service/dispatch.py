@@ -0,0 +1,172 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Method dispatch table and parameter binding for on_* methods.
+"""
+
+import inspect
+
+#: Invalid method parameter(s), from the JSON-RPC 2.0 specification.
+JSONRPC_INVALID_PARAMS = -32602
+
+
+class InvalidParamsError(TypeError):
+    """
+    Raised when jsonrpc params do not match an on_* method signature.
+    """
+    pass
+
+
+class MethodBinder:
+    """
+    Checks jsonrpc params against an on_* method signature and builds the
+    arguments to call it with. The signature is inspected only once.
+    """
+
+    __slots__ = (
+        'method', 'name', 'names', 'required', 'max_positional',
+        'required_positional', 'requires_keywords', 'var_positional',
+        'var_keyword')
+
+    def __init__(self, name, method):
+        """
+        Initializes a new MethodBinder instance.
+
+        :param name: The bus method name.
+        :type name: str
+        :param method: The bound on_* method.
+        :type method: callable
+        """
+        self.method = method
+        self.name = name
+        self.names = frozenset()
+        self.required = frozenset()
+        self.requires_keywords = False
+        self.max_positional = 0
+        self.required_positional = 0
+        self.var_positional = False
+        self.var_keyword = False
+        try:
+            parameters = list(
+                inspect.signature(method).parameters.values())
+        except (TypeError, ValueError):
+            # No signature available; accept anything.
+            self.var_positional = self.var_keyword = True
+            return
+
+        # The first parameter receives the message itself.
+        if parameters and parameters[0].kind in (
+                parameters[0].POSITIONAL_ONLY,
+                parameters[0].POSITIONAL_OR_KEYWORD):
+            parameters = parameters[1:]
+
+        names = set()
+        required = set()
+        for parameter in parameters:
+            if parameter.kind == parameter.VAR_POSITIONAL:
+                self.var_positional = True
+            elif parameter.kind == parameter.VAR_KEYWORD:
+                self.var_keyword = True
+            else:
+                names.add(parameter.name)
+                has_default = parameter.default is not parameter.empty
+                if parameter.kind == parameter.KEYWORD_ONLY:
+                    self.requires_keywords |= not has_default
+                else:
+                    self.max_positional += 1
+                    if not has_default:
+                        self.required_positional = self.max_positional
+                if not has_default:
+                    required.add(parameter.name)
+        self.names = frozenset(names)
+        self.required = frozenset(required)
+
+    def _describe_mismatch(self, keys):
+        """
+        Explains why named params do not match the signature.
+
+        :param keys: The param names given.
+        :type keys: set-like
+        :returns: An error message
+        :rtype: str
+        """
+        if 'message' in keys:
+            return '{}() params may not include "message"'.format(self.name)
+        missing = self.required - keys
+        if missing:
+            return '{}() missing params: {}'.format(
+                self.name, ', '.join(sorted(missing)))
+        return '{}() got unexpected params: {}'.format(
+            self.name, ', '.join(sorted(keys - self.names)))
+
+    def bind(self, message, params):
+        """
+        Builds the arguments for calling the method with jsonrpc params.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :param params: The jsonrpc params.
+        :type params: dict or list
+        :returns: Positional and keyword arguments
+        :rtype: tuple
+        :raises: InvalidParamsError
+        """
+        if type(params) is dict:
+            keys = params.keys()
+            if not (self.required <= keys and (
+                    self.var_keyword or keys <= self.names)) or (
+                    'message' in params):
+                raise InvalidParamsError(self._describe_mismatch(keys))
+            kwargs = params.copy()
+            kwargs['message'] = message
+            return (), kwargs
+
+        if not isinstance(params, (list, tuple)):
+            raise InvalidParamsError(
+                '{}() params must be an object or an array'.format(
+                    self.name))
+        count = len(params)
+        if count < self.required_positional or (
+                count > self.max_positional and not self.var_positional):
+            raise InvalidParamsError(
+                '{}() takes {} to {} params but {} were given'.format(
+                    self.name, self.required_positional,
+                    self.max_positional, count))
+        if self.requires_keywords:
+            raise InvalidParamsError(
+                '{}() requires named params'.format(self.name))
+        return (message, ) + tuple(params), {}
+
+
+def build_dispatch_table(service, reserved=()):
+    """
+    Builds a mapping of bus method names to MethodBinders for every on_*
+    method of a service.
+
+    :param service: The service instance.
+    :type service: commissaire_service.service.CommissaireService
+    :param reserved: on_* attribute names which are not bus methods.
+    :type reserved: iterable
+    :returns: Mapping of method name to MethodBinder
+    :rtype: dict
+    """
+    table = {}
+    for attr in dir(type(service)):
+        if not attr.startswith('on_') or attr in reserved:
+            continue
+        method = getattr(service, attr, None)
+        if callable(method):
+            table[attr[3:]] = MethodBinder(attr[3:], method)
+    return table
@@ -0,0 +1,52 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Re-creates the errors of jsonrpc responses on the client side.
+"""
+
+from commissaire.bus import RemoteProcedureCallError
+
+
+def _error_classes(cls=RemoteProcedureCallError):
+    """
+    Yields every subclass of an error class, depth first.
+
+    :param cls: The error class.
+    :type cls: type
+    """
+    for subclass in cls.__subclasses__():
+        yield subclass
+        yield from _error_classes(subclass)
+
+
+def rebuild_error(error):
+    """
+    Returns the exception for the error of a jsonrpc response. The
+    RemoteProcedureCallError subclass which declares the error code, for
+    example StorageLookupError or ServiceBusyError, is used when there is
+    one.
+
+    :param error: The error member of a jsonrpc response.
+    :type error: dict
+    :returns: The exception to raise.
+    :rtype: commissaire.bus.RemoteProcedureCallError
+    """
+    message = error.get('message', '')
+    data = error.get('data') or {}
+    code = error.get('code')
+    for cls in _error_classes():
+        if 'code' in vars(cls) and cls.code == code:
+            return cls(message, data)
+    return RemoteProcedureCallError(message, data)
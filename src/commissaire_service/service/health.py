@@ -0,0 +1,68 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Liveness of services: heartbeats shared with the ServiceManager and the
+details reported by the built-in ping and introspect methods.
+"""
+
+import hashlib
+import json
+import multiprocessing
+
+from time import monotonic
+
+
+def config_digest(config):
+    """
+    Returns a digest of a configuration so processes running different
+    configurations can be told apart without sending the values.
+
+    :param config: The configuration data.
+    :type config: dict
+    :returns: The hex SHA-256 of the configuration with sorted keys.
+    :rtype: str
+    """
+    data = json.dumps(config, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class Heartbeat:
+    """
+    When the consumer loop of a service process last went around, in
+    shared memory so the ServiceManager can read it. The monotonic clock
+    is shared by the processes of one host.
+    """
+
+    def __init__(self):
+        """
+        Initializes a new Heartbeat instance. It must be created before
+        the process which beats it is started.
+        """
+        self._value = multiprocessing.Value('d', 0.0, lock=False)
+
+    def beat(self):
+        """
+        Records that the consumer loop is alive.
+        """
+        self._value.value = monotonic()
+
+    @property
+    def last(self):
+        """
+        When (monotonic) the last beat happened, or None before the first.
+
+        :rtype: float or None
+        """
+        return self._value.value or None
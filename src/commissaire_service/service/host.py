@@ -0,0 +1,311 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Runs several services in one process, sharing their bus connections and
+one consumer loop.
+"""
+
+import importlib
+import logging
+import signal
+import threading
+
+from functools import partial
+
+from kombu import Consumer
+from kombu.mixins import ConsumerMixin
+
+from .pools import BusPool
+
+#: Services which can be hosted, by name, as "module:class". The modules
+#: are only imported for the services which are run.
+SERVICES = {
+    'clusterexec': 'commissaire_service.clusterexec:ClusterExecService',
+    'containermgr': (
+        'commissaire_service.containermgr:ContainerManagerService'),
+    'investigator': 'commissaire_service.investigator:InvestigatorService',
+    'storage': 'commissaire_service.storage:StorageService',
+    'watcher': 'commissaire_service.watcher:WatcherService',
+}
+
+
+def load_service_class(name):
+    """
+    Imports the class of a service which can be hosted.
+
+    :param name: A key of SERVICES.
+    :type name: str
+    :returns: The service class.
+    :rtype: class
+    :raises: ValueError
+    """
+    if name not in SERVICES:
+        raise ValueError('Unknown service "{}". Choose from {}'.format(
+            name, ', '.join(sorted(SERVICES))))
+    module_name, class_name = SERVICES[name].split(':')
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class ServiceHost(ConsumerMixin):
+    """
+    Consumes the queues of several services on one connection. Each
+    service keeps its own queues, handlers, workers and configuration, and
+    consumes on its own channel so its prefetch_count only limits its own
+    messages. Handlers always run on worker pools so the consumer thread
+    stays free to answer requests the services send each other. Replies
+    and outgoing requests of all services share the connections of the
+    first service.
+    """
+
+    def __init__(self, services):
+        """
+        Initializes a new ServiceHost instance. The other services are moved
+        onto the connections of the first one.
+
+        :param services: The services to run.
+        :type services: list
+        :raises: ValueError
+        """
+        self.logger = logging.getLogger('ServiceHost')
+        self.services = list(services)
+        if not self.services:
+            raise ValueError('A service host needs at least one service')
+        first = self.services[0]
+        for service in self.services[1:]:
+            if service._exchange.name != first._exchange.name:
+                raise ValueError(
+                    '{} uses the exchange "{}" instead of "{}"'.format(
+                        service.__class__.__name__, service._exchange.name,
+                        first._exchange.name))
+
+        # A handler on the shared consumer thread could wait forever for
+        # a reply only that thread can deliver
+        for service in self.services:
+            service._use_worker_pool()
+
+        # One pool as large as the pools of all services together
+        limit = sum(service._bus_pool.limit for service in self.services)
+        first._bus_pool.close()
+        first._bus_pool = BusPool(first.connection, first._exchange, limit)
+        for service in self.services[1:]:
+            service._share_bus(first)
+        self.connection = first.connection
+        # Channel and consumers of each service, set by get_consumers
+        self._consumers_of = []
+        # Channels opened for all but the first service
+        self._channels = []
+        self._consumer_connection = None
+        self.logger.debug('Hosting {}'.format(', '.join(
+            service.__class__.__name__ for service in self.services)))
+
+    @property
+    def should_stop(self):
+        """
+        True once every service stopped.
+
+        :rtype: bool
+        """
+        return all(service.should_stop for service in self.services)
+
+    @should_stop.setter
+    def should_stop(self, value):
+        for service in self.services:
+            service.should_stop = value
+
+    def create_connection(self):
+        """
+        Creates the connection the consumer loop runs on. Overridden so
+        get_consumers can open more channels on it.
+
+        :returns: A new connection.
+        :rtype: kombu.Connection
+        """
+        self._consumer_connection = super().create_connection()
+        return self._consumer_connection
+
+    def get_consumers(self, Consumer, channel):
+        """
+        Returns the consumers of every service. Called by the parent Mixin.
+        The first service consumes on the given channel, every other one on
+        a channel of its own.
+
+        :param Consumer: Message consumer class.
+        :type Consumer: kombu.Consumer
+        :param channel: An opened channel.
+        :type channel: kombu.transport.*.Channel
+        :returns: A list of Consumer instances.
+        :rtype: list
+        """
+        # Channels of a lost connection went with it
+        self._channels = []
+        self._consumers_of = [
+            (self.services[0], channel,
+             self.services[0].get_consumers(Consumer, channel))]
+        for service in self.services[1:]:
+            own = self._consumer_connection.channel()
+            self._channels.append(own)
+            self._consumers_of.append((service, own, service.get_consumers(
+                self._consumer_class(own), own)))
+        return [
+            consumer for _, _, consumers in self._consumers_of
+            for consumer in consumers]
+
+    def _consumer_class(self, channel):
+        """
+        Returns the consumer class bound to a channel, like the one the
+        parent Mixin passes to get_consumers.
+
+        :param channel: An opened channel.
+        :type channel: kombu.transport.*.Channel
+        :returns: Message consumer class.
+        :rtype: callable
+        """
+        return partial(
+            Consumer, channel, on_decode_error=self.on_decode_error)
+
+    def consume(self, *args, **kwargs):
+        """
+        Consumes messages, waking up as often as the most demanding service
+        needs to.
+
+        :param args: Positional arguments for ConsumerMixin.consume.
+        :type args: tuple
+        :param kwargs: Keyword arguments for ConsumerMixin.consume.
+        :type kwargs: dict
+        """
+        intervals = []
+        for service in self.services:
+            options = {}
+            service._before_consume(options)
+            if 'safety_interval' in options:
+                intervals.append(options['safety_interval'])
+        if intervals:
+            kwargs.setdefault('safety_interval', min(intervals))
+        return super().consume(*args, **kwargs)
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        """
+        Hands each service its consumers.
+
+        :param connection: The current connection instance.
+        :type connection: kombu.Connection
+        :param channel: The current channel.
+        :type channel: kombu.transport.*.Channel
+        :param consumers: The consumers of all services.
+        :type consumers: list
+        """
+        for service, own_channel, own in self._consumers_of:
+            service.on_consume_ready(connection, own_channel, own)
+
+    def on_iteration(self):
+        """
+        Lets every service finish replies and move drains along.
+        """
+        for service in self.services:
+            service.on_iteration()
+
+    def on_consume_end(self, connection, channel):
+        """
+        Lets every service know consuming ended.
+
+        :param connection: The current connection instance.
+        :type connection: kombu.Connection
+        :param channel: The current channel.
+        :type channel: kombu.transport.*.Channel
+        """
+        for service in self.services:
+            service.on_consume_end(connection, channel)
+        while self._channels:
+            self._channels.pop().close()
+
+    def drain(self, grace=None):
+        """
+        Drains every service. The host stops once all are drained.
+
+        :param grace: Seconds to wait for messages in flight. Defaults to
+                      the drain_grace of each service.
+        :type grace: float or None
+        """
+        for service in self.services:
+            service.drain(grace)
+
+    def _on_sigterm(self, signum, frame):
+        """
+        Starts draining when the process is asked to terminate.
+
+        :param signum: The signal number.
+        :type signum: int
+        :param frame: The interrupted stack frame.
+        :type frame: frame
+        """
+        self.drain()
+
+    def run(self, *args, **kwargs):
+        """
+        Consumes messages until every service stopped. SIGTERM drains the
+        services when the host runs on the main thread.
+
+        :param args: Positional arguments for ConsumerMixin.run.
+        :type args: tuple
+        :param kwargs: Keyword arguments for ConsumerMixin.run.
+        :type kwargs: dict
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._on_sigterm)
+        for service in self.services:
+            service._serve_metrics()
+        return super().run(*args, **kwargs)
+
+
+def main():  # pragma: no cover
+    """
+    Main entry point.
+    """
+    import argparse
+
+    from commissaire_service.service import add_service_arguments
+
+    parser = argparse.ArgumentParser(
+        description='Runs several Commissaire services in one process.')
+    add_service_arguments(parser)
+    parser.add_argument(
+        'services', nargs='+', metavar='SERVICE[=CONFIG_FILE]',
+        help='Services to run: {}. A service reads CONFIG_FILE if given, '
+             'else --config-file if given, else its default configuration '
+             'file.'.format(', '.join(sorted(SERVICES))))
+
+    args = parser.parse_args()
+    services = []
+    for spec in args.services:
+        name, _, config_file = spec.partition('=')
+        try:
+            services.append((load_service_class(name), config_file))
+        except ValueError as error:
+            parser.error(str(error))
+
+    try:
+        host = ServiceHost([
+            service_class(
+                exchange_name=args.bus_exchange,
+                connection_url=args.bus_uri,
+                config_file=config_file or args.config_file)
+            for service_class, config_file in services])
+        host.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
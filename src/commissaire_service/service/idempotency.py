@@ -0,0 +1,273 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Caches of completed requests so redelivered requests are not run twice.
+"""
+
+import logging
+import threading
+
+from collections import OrderedDict
+from time import monotonic
+
+from . import codec
+
+#: Keep completed requests in the memory of each process.
+IDEMPOTENCY_MEMORY = 'memory'
+
+#: Keep completed requests in Redis, shared by every process.
+IDEMPOTENCY_REDIS = 'redis'
+
+IDEMPOTENCY_BACKENDS = (IDEMPOTENCY_MEMORY, IDEMPOTENCY_REDIS)
+
+#: Stored while a request runs so duplicates do not run it as well.
+IN_PROGRESS = {'in_progress': True}
+
+
+class ResponseCache:
+    """
+    Bounded in-memory cache of completed requests. Entries expire after
+    ttl seconds and the least recently used entry is evicted when full.
+    """
+
+    def __init__(self, ttl=3600, max_size=10000, claim_ttl=300):
+        """
+        Initializes a new ResponseCache instance.
+
+        :param ttl: Seconds to remember a completed request.
+        :type ttl: float
+        :param max_size: Maximum number of requests to remember.
+        :type max_size: int
+        :param claim_ttl: Seconds a request is marked as running.
+        :type claim_ttl: float
+        """
+        self.ttl = ttl
+        self.max_size = max(int(max_size), 1)
+        self.claim_ttl = claim_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the cached outcome of a request.
+
+        :param key: The request key.
+        :type key: str
+        :returns: The cached value or None.
+        :rtype: dict or None
+        """
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def claim(self, key):
+        """
+        Marks a request as running unless it completed or runs already.
+
+        :param key: The request key.
+        :type key: str
+        :returns: None if the caller should run the request, otherwise the
+                  cached value, IN_PROGRESS while it still runs.
+        :rtype: dict or None
+        """
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+            self._store(key, now + self.claim_ttl, IN_PROGRESS)
+        return None
+
+    def release(self, key):
+        """
+        Forgets a claimed request which failed so it can run again.
+
+        :param key: The request key.
+        :type key: str
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def set(self, key, value):
+        """
+        Remembers the outcome of a request.
+
+        :param key: The request key.
+        :type key: str
+        :param value: What to return for duplicates.
+        :type value: dict
+        """
+        with self._lock:
+            self._store(key, monotonic() + self.ttl, value)
+
+    def _store(self, key, expires, value):
+        """
+        Stores an entry and evicts the oldest ones. The lock must be held.
+
+        :param key: The request key.
+        :type key: str
+        :param expires: When the entry expires.
+        :type expires: float
+        :param value: The value to store.
+        :type value: dict
+        """
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class RedisResponseCache:
+    """
+    Cache of completed requests kept in Redis so every process of a service
+    sees them. Entries expire after ttl seconds. Redis errors are logged
+    and treated as cache misses.
+    """
+
+    def __init__(self, url, ttl=3600, prefix='commissaire:idempotency:',
+                 claim_ttl=300):
+        """
+        Initializes a new RedisResponseCache instance.
+
+        :param url: Redis connection url.
+        :type url: str
+        :param ttl: Seconds to remember a completed request.
+        :type ttl: int
+        :param prefix: Prefix of the Redis keys.
+        :type prefix: str
+        :param claim_ttl: Seconds a request is marked as running.
+        :type claim_ttl: int
+        """
+        import redis
+
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.ttl = int(ttl)
+        self.claim_ttl = int(claim_ttl)
+        self.prefix = prefix
+        self._errors = redis.RedisError
+        self.client = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        """
+        Returns the cached outcome of a request.
+
+        :param key: The request key.
+        :type key: str
+        :returns: The cached value or None.
+        :rtype: dict or None
+        """
+        try:
+            data = self.client.get(self.prefix + key)
+        except self._errors as error:
+            self.logger.warn('Unable to read {}: {}'.format(key, error))
+            return None
+        if data is None:
+            return None
+        return codec.loads(data)
+
+    def claim(self, key):
+        """
+        Marks a request as running unless it completed or runs already.
+        Only one process of the service can claim a key.
+
+        :param key: The request key.
+        :type key: str
+        :returns: None if the caller should run the request, otherwise the
+                  cached value, IN_PROGRESS while it still runs.
+        :rtype: dict or None
+        """
+        try:
+            if self.client.set(
+                    self.prefix + key, codec.dumps(IN_PROGRESS),
+                    nx=True, ex=self.claim_ttl):
+                return None
+        except self._errors as error:
+            self.logger.warn('Unable to claim {}: {}'.format(key, error))
+            return None
+        return self.get(key)
+
+    def release(self, key):
+        """
+        Forgets a claimed request which failed so it can run again.
+
+        :param key: The request key.
+        :type key: str
+        """
+        try:
+            self.client.delete(self.prefix + key)
+        except self._errors as error:
+            self.logger.warn('Unable to release {}: {}'.format(key, error))
+
+    def set(self, key, value):
+        """
+        Remembers the outcome of a request.
+
+        :param key: The request key.
+        :type key: str
+        :param value: What to return for duplicates.
+        :type value: dict
+        """
+        try:
+            self.client.setex(self.prefix + key, self.ttl, codec.dumps(value))
+        except self._errors as error:
+            self.logger.warn('Unable to store {}: {}'.format(key, error))
+
+
+def build_response_cache(config, name, connection_url=None):
+    """
+    Creates the response cache described by a service configuration.
+
+    :param config: The service configuration.
+    :type config: dict
+    :param name: Name of the service, used to namespace shared caches.
+    :type name: str
+    :param connection_url: The bus url, used as the Redis url when it is
+                           one and idempotency_redis_url is not set.
+    :type connection_url: str or None
+    :returns: The cache or None if idempotency is not configured.
+    :rtype: ResponseCache, RedisResponseCache or None
+    :raises: ValueError
+    """
+    backend = config.get('idempotency')
+    if not backend:
+        return None
+    ttl = config.get('idempotency_ttl', 3600)
+    claim_ttl = config.get('idempotency_claim_ttl', 300)
+    if backend == IDEMPOTENCY_MEMORY:
+        return ResponseCache(
+            ttl=ttl, max_size=config.get('idempotency_cache_size', 10000),
+            claim_ttl=claim_ttl)
+    if backend == IDEMPOTENCY_REDIS:
+        url = config.get('idempotency_redis_url')
+        if url is None and str(connection_url).startswith('redis://'):
+            url = connection_url
+        if url is None:
+            raise ValueError(
+                'idempotency_redis_url is required when the bus is not Redis')
+        return RedisResponseCache(
+            url, ttl=ttl, prefix='commissaire:idempotency:{}:'.format(name),
+            claim_ttl=claim_ttl)
+    raise ValueError(
+        'Unknown idempotency backend "{}". Expected one of: {}'.format(
+            backend, ', '.join(IDEMPOTENCY_BACKENDS)))
@@ -0,0 +1,169 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Per-method pools so expensive methods can not use all of a process.
+"""
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .lanes import LANE_DEFAULT, lane_of
+
+#: First word of the routing keys and names of isolation queues. It comes
+#: first so no binding of a service, such as "storage.*", also matches
+#: them, even on transports whose "*" matches more than one word.
+ISOLATION_PREFIX = 'isolated'
+
+
+class IsolationPool:
+    """
+    Runs the calls of one method on their own threads. At most slots calls
+    run at once. The method is consumed from a queue of its own with a
+    prefetch of slots plus backlog, so at most backlog more calls wait in
+    the process and the rest wait on the broker.
+    """
+
+    def __init__(self, name, slots, backlog=None):
+        """
+        Initializes a new IsolationPool instance.
+
+        :param name: The bus method name.
+        :type name: str
+        :param slots: How many calls may run at once.
+        :type slots: int
+        :param backlog: How many calls may wait. Defaults to slots.
+        :type backlog: int or None
+        :raises: ValueError
+        """
+        self.name = name
+        self.slots = int(slots)
+        self.backlog = self.slots if backlog is None else int(backlog)
+        if self.slots < 1 or self.backlog < 0:
+            raise ValueError(
+                'Pool for {} needs at least 1 slot and a backlog of at '
+                'least 0'.format(name))
+        self.pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.slots)
+
+    @property
+    def capacity(self):
+        """
+        How many calls the pool accepts at once, running or waiting. Used
+        as the prefetch count of the queue of the method.
+
+        :rtype: int
+        """
+        return self.slots + self.backlog
+
+    def submit(self, fn, *args):
+        """
+        Schedules a call on the threads of the pool.
+
+        :param fn: The callable to run.
+        :type fn: callable
+        :param args: Arguments for fn.
+        :type args: tuple
+        """
+        with self._lock:
+            self.pending += 1
+        self._executor.submit(fn, *args).add_done_callback(self._done)
+
+    def _done(self, future):
+        """
+        Counts a finished call.
+
+        :param future: The future of the call.
+        :type future: concurrent.futures.Future
+        """
+        with self._lock:
+            self.pending -= 1
+
+    def shutdown(self, wait=True):
+        """
+        Stops the threads of the pool.
+
+        :param wait: Wait for accepted calls to finish.
+        :type wait: bool
+        """
+        self._executor.shutdown(wait=wait)
+
+
+def isolated_routing_key(routing_key, lanes):
+    """
+    Returns the routing key of the isolation queue for a request. The lane
+    is dropped, so "storage.list" and "storage.bulk.list" both become
+    "isolated.storage.list". Isolated routing keys are returned as is.
+
+    :param routing_key: The routing key of the request.
+    :type routing_key: str
+    :param lanes: Lane names from parse_lanes.
+    :type lanes: tuple
+    :returns: The routing key of the isolation queue.
+    :rtype: str
+    """
+    if routing_key.startswith(ISOLATION_PREFIX + '.'):
+        return routing_key
+    prefix, _, method = routing_key.rpartition('.')
+    if lane_of(routing_key, lanes) != LANE_DEFAULT:
+        prefix = prefix.rpartition('.')[0]
+    return '.'.join(x for x in (ISOLATION_PREFIX, prefix, method) if x)
+
+
+def isolation_routing_keys(qkwargs, method):
+    """
+    Returns the routing keys of the isolation queues of a method, one for
+    every queue binding which routes requests for it.
+
+    :param qkwargs: Keyword arguments of the queues of the service.
+    :type qkwargs: list
+    :param method: The bus method name.
+    :type method: str
+    :returns: The routing keys.
+    :rtype: list
+    """
+    keys = []
+    for kwargs in qkwargs:
+        prefix, _, last = (kwargs.get('routing_key') or '').rpartition('.')
+        if not prefix or last not in ('*', method):
+            continue
+        key = '{}.{}.{}'.format(ISOLATION_PREFIX, prefix, method)
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def build_isolation_pools(config):
+    """
+    Creates the pools described by the isolation_pools configuration key.
+
+    :param config: Mapping of routing key, for example "storage.list", or
+                   method name to a slot count or to a dict with "slots"
+                   and optionally "backlog".
+    :type config: dict or None
+    :returns: Mapping of method name to IsolationPool.
+    :rtype: dict
+    :raises: ValueError
+    """
+    pools = {}
+    for key, value in (config or {}).items():
+        name = key.rsplit('.', 1)[-1]
+        if isinstance(value, dict):
+            pools[name] = IsolationPool(
+                name, value.get('slots', 1), value.get('backlog'))
+        else:
+            pools[name] = IsolationPool(name, value)
+    return pools
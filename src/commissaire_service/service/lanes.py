@@ -0,0 +1,199 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Priority lanes: extra queues per service so urgent requests do not wait
+behind bulk ones.
+"""
+
+import heapq
+import itertools
+import threading
+
+from kombu.utils.scheduling import priority_cycle
+
+#: The lane of the routing keys and queues a service was created with.
+LANE_DEFAULT = 'default'
+
+#: kombu queue_order_strategy transport option which makes the Redis
+#: transport read the queues of more urgent lanes first.
+QUEUE_ORDER_STRATEGY = 'commissaire_service.service.lanes:LaneCycle'
+
+
+def parse_lanes(lanes):
+    """
+    Validates the configured lanes.
+
+    :param lanes: Lane names from highest to lowest priority, including
+                  LANE_DEFAULT. None means only the default lane.
+    :type lanes: list or None
+    :returns: The lane names, highest priority first.
+    :rtype: tuple
+    :raises: ValueError
+    """
+    if not lanes:
+        return (LANE_DEFAULT, )
+    lanes = tuple(lanes)
+    if LANE_DEFAULT not in lanes:
+        raise ValueError(
+            'priority_lanes must include "{}" to place the existing '
+            'queues'.format(LANE_DEFAULT))
+    if len(set(lanes)) != len(lanes):
+        raise ValueError('priority_lanes may not repeat a lane')
+    for lane in lanes:
+        if not lane or '.' in lane or '*' in lane or '#' in lane:
+            raise ValueError('Invalid lane name "{}"'.format(lane))
+    return lanes
+
+
+def lane_routing_key(routing_key, lane):
+    """
+    Returns the routing key which sends a request through a lane. The
+    lane is inserted before the method, so "storage.list" in the "bulk"
+    lane becomes "storage.bulk.list".
+
+    :param routing_key: The routing key of the request.
+    :type routing_key: str
+    :param lane: The lane name or None for the default lane.
+    :type lane: str or None
+    :returns: The routing key to publish with.
+    :rtype: str
+    """
+    if lane in (None, LANE_DEFAULT):
+        return routing_key
+    prefix, method = routing_key.rsplit('.', 1)
+    return '{}.{}.{}'.format(prefix, lane, method)
+
+
+def lane_queues(qkwargs, lanes):
+    """
+    Returns the queue arguments for every lane of a service.
+
+    :param qkwargs: Keyword arguments of the default lane queues.
+    :type qkwargs: list
+    :param lanes: Lane names from parse_lanes.
+    :type lanes: tuple
+    :returns: Queue keyword arguments for all lanes.
+    :rtype: list
+    """
+    result = list(qkwargs)
+    for lane in lanes:
+        if lane == LANE_DEFAULT:
+            continue
+        for kwargs in qkwargs:
+            kwargs = dict(kwargs)
+            if kwargs.get('name'):
+                kwargs['name'] = '{}.{}'.format(kwargs['name'], lane)
+            if kwargs.get('routing_key'):
+                kwargs['routing_key'] = lane_routing_key(
+                    kwargs['routing_key'], lane)
+            result.append(kwargs)
+    return result
+
+
+def lane_of(routing_key, lanes):
+    """
+    Returns the lane a message was routed through.
+
+    :param routing_key: The routing key of the message.
+    :type routing_key: str
+    :param lanes: Lane names from parse_lanes.
+    :type lanes: tuple
+    :returns: The lane name.
+    :rtype: str
+    """
+    parts = routing_key.rsplit('.', 2)
+    if len(parts) == 3 and parts[1] in lanes:
+        return parts[1]
+    return LANE_DEFAULT
+
+
+class PendingWork:
+    """
+    Messages waiting for a worker, handed out highest priority first and
+    in arrival order within a priority.
+    """
+
+    def __init__(self):
+        """
+        Initializes a new PendingWork instance.
+        """
+        self._lock = threading.Lock()
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, priority, item):
+        """
+        Adds an item.
+
+        :param priority: Lower values are handed out first.
+        :type priority: int
+        :param item: The work item.
+        :type item: mixed
+        """
+        with self._lock:
+            heapq.heappush(
+                self._heap, (priority, next(self._sequence), item))
+
+    def get(self):
+        """
+        Removes and returns the most urgent item.
+
+        :returns: The work item.
+        :rtype: mixed
+        :raises: IndexError
+        """
+        with self._lock:
+            return heapq.heappop(self._heap)[2]
+
+
+class LaneCycle(priority_cycle):
+    """
+    Order in which kombu's Redis transport reads the queues of a channel.
+    Queues of more urgent lanes come first and the order never rotates,
+    so a lane is only read when the lanes before it are empty. kombu's own
+    "priority" strategy keeps the order of a set, which is arbitrary.
+    """
+
+    #: Lane index of every queue of the process, by queue name. Shared so
+    #: kombu can create the cycle by name.
+    ranks = {}
+
+    @classmethod
+    def rank(cls, queue_name, priority):
+        """
+        Records the lane index of a queue.
+
+        :param queue_name: The queue name.
+        :type queue_name: str
+        :param priority: The lane index, lower is more urgent.
+        :type priority: int
+        """
+        cls.ranks[queue_name] = priority
+
+    def consume(self, n):
+        """
+        Returns the first n queues, most urgent first. Queues without a
+        rank come last.
+
+        :param n: How many queues to return.
+        :type n: int
+        :rtype: list
+        """
+        last = len(self.ranks)
+        return sorted(
+            self.items, key=lambda name: self.ranks.get(name, last))[:n]
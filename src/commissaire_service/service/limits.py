@@ -0,0 +1,177 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Caps on the requests a service holds at once. Requests over a cap are
+answered right away with a ServiceBusyError telling the caller when to
+retry.
+"""
+
+import threading
+
+from commissaire.bus import RemoteProcedureCallError
+
+#: The service is at capacity, a JSON-RPC 2.0 implementation defined
+#: server error.
+JSONRPC_SERVICE_BUSY = -32001
+
+
+class ServiceBusyError(RemoteProcedureCallError):
+    """
+    Returned when a service or method has as many requests in flight as it
+    may. The call was not run and can be retried after
+    ``data['retry_after']`` seconds.
+    """
+    code = JSONRPC_SERVICE_BUSY
+
+
+def retry_after(error):
+    """
+    Returns how long a caller should wait before retrying a failed request.
+
+    :param error: The error raised by request.
+    :type error: Exception
+    :returns: Seconds to wait or None if the request should not be retried.
+    :rtype: float or None
+    """
+    data = getattr(error, 'data', None)
+    if getattr(error, 'code', None) != JSONRPC_SERVICE_BUSY and not (
+            isinstance(data, dict) and data.get('code') ==
+            JSONRPC_SERVICE_BUSY):
+        return None
+    try:
+        return float(data['retry_after'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class InFlightLimits:
+    """
+    Counts the requests in flight per method and for the whole service.
+    """
+
+    #: Weight of the latest call in the average call duration
+    smoothing = 0.2
+
+    def __init__(self, methods=None, total=None, retry_after=1.0):
+        """
+        Initializes a new InFlightLimits instance.
+
+        :param methods: Mapping of routing key, for example "storage.list",
+                        or method name to the most requests of that method
+                        in flight.
+        :type methods: dict or None
+        :param total: Most requests in flight for the service.
+        :type total: int or None
+        :param retry_after: Least seconds callers are told to wait.
+        :type retry_after: float
+        :raises: ValueError
+        """
+        self.methods = {}
+        for key, value in (methods or {}).items():
+            self.methods[key.rsplit('.', 1)[-1]] = int(value)
+        self.total = None if total is None else int(total)
+        self.retry_after = float(retry_after)
+        if any(x < 1 for x in self.methods.values()) or (
+                self.total is not None and self.total < 1):
+            raise ValueError('In flight limits must be at least 1')
+        self.in_flight = {}
+        self.durations = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """
+        Whether any limit is set.
+
+        :rtype: bool
+        """
+        return bool(self.methods) or self.total is not None
+
+    def try_acquire(self, method_name, count_total=True):
+        """
+        Counts a request in flight unless a limit is reached.
+
+        :param method_name: The bus method name.
+        :type method_name: str
+        :param count_total: Count against the service limit as well. Batch
+                            elements do not, their batch already does.
+        :type count_total: bool
+        :returns: False if the request must be turned away.
+        :rtype: bool
+        """
+        limit = self.methods.get(method_name)
+        with self._lock:
+            current = self.in_flight.get(method_name, 0)
+            if count_total and self.total is not None and (
+                    self._count >= self.total):
+                return False
+            if limit is not None and current >= limit:
+                return False
+            self.in_flight[method_name] = current + 1
+            if count_total:
+                self._count += 1
+        return True
+
+    def release(self, method_name, duration, count_total=True):
+        """
+        Stops counting a request from try_acquire.
+
+        :param method_name: The bus method name.
+        :type method_name: str
+        :param duration: Seconds the request was in flight.
+        :type duration: float
+        :param count_total: Must match the try_acquire call.
+        :type count_total: bool
+        """
+        with self._lock:
+            self.in_flight[method_name] -= 1
+            if count_total:
+                self._count -= 1
+            average = self.durations.get(method_name, duration)
+            self.durations[method_name] = average + self.smoothing * (
+                duration - average)
+
+    def busy_error(self, method_name):
+        """
+        Returns the error for a request which was turned away.
+
+        :param method_name: The bus method name.
+        :type method_name: str
+        :returns: The error with a retry_after hint in its data.
+        :rtype: ServiceBusyError
+        """
+        wait = max(self.retry_after, self.durations.get(method_name, 0.0))
+        return ServiceBusyError(
+            'Too many requests in flight for {}, retry in {:.3f}s'.format(
+                method_name, wait),
+            {'code': JSONRPC_SERVICE_BUSY, 'method': method_name,
+             'retry_after': round(wait, 3)})
+
+
+def build_in_flight_limits(config):
+    """
+    Creates the limits described by the configuration.
+
+    :param config: The service configuration, using the in_flight_limits,
+                   max_in_flight and busy_retry_after keys.
+    :type config: dict
+    :returns: The limits.
+    :rtype: InFlightLimits
+    :raises: ValueError
+    """
+    return InFlightLimits(
+        config.get('in_flight_limits'), config.get('max_in_flight'),
+        config.get('busy_retry_after', 1.0))
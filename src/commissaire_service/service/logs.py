@@ -0,0 +1,145 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Structured, lazily formatted logging for services.
+"""
+
+import logging
+import threading
+import time
+
+
+class StructuredMessage:
+    """
+    A log message made of an event name and fields. Nothing is formatted
+    until a handler actually emits the record.
+    """
+
+    __slots__ = ('event', 'fields')
+
+    def __init__(self, event, fields):
+        """
+        Initializes a new StructuredMessage instance.
+
+        :param event: Short dotted name of what happened.
+        :type event: str
+        :param fields: Values describing the event.
+        :type fields: dict
+        """
+        self.event = event
+        self.fields = fields
+
+    def __str__(self):
+        """
+        Renders the message as: event key=value key=value
+        """
+        return ' '.join([self.event] + [
+            '{}={!r}'.format(k, v) for k, v in sorted(self.fields.items())])
+
+
+def log_event(logger, level, event, **fields):
+    """
+    Logs a structured event if the logger is enabled for level.
+
+    Formatting is deferred to the handler, so this costs a level check when
+    the level is disabled.
+
+    :param logger: The logger to use.
+    :type logger: logging.Logger
+    :param level: The logging level.
+    :type level: int
+    :param event: Short dotted name of what happened.
+    :type event: str
+    :param fields: Values describing the event.
+    :type fields: dict
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, StructuredMessage(event, fields))
+
+
+class ExceptionLogger:
+    """
+    Logs exceptions with their tracebacks but only once per interval for
+    repeats of the same failure. Repeats are counted and reported with the
+    next exception logged for that failure.
+
+    A failure is identified by the exception type and the place it was
+    raised from.
+    """
+
+    def __init__(self, logger, interval=60.0, level=logging.WARNING):
+        """
+        Initializes a new ExceptionLogger instance.
+
+        :param logger: The logger to use.
+        :type logger: logging.Logger
+        :param interval: Seconds during which repeats are suppressed.
+        :type interval: float
+        :param level: The logging level to use.
+        :type level: int
+        """
+        self.logger = logger
+        self.interval = interval
+        self.level = level
+        self._lock = threading.Lock()
+        # { key: [last_logged_time, suppressed_count] }
+        self._seen = {}
+
+    @staticmethod
+    def _key(error):
+        """
+        Returns what identifies a failure: the exception type and the
+        file and line it was raised from.
+        """
+        tb = error.__traceback__
+        while tb is not None and tb.tb_next is not None:
+            tb = tb.tb_next
+        if tb is None:
+            return (type(error), None, None)
+        return (type(error), tb.tb_frame.f_code.co_filename, tb.tb_lineno)
+
+    def log(self, error, event='exception', **fields):
+        """
+        Logs an exception unless the same failure was logged recently.
+
+        :param error: The exception to log.
+        :type error: Exception
+        :param event: Short dotted name of what failed.
+        :type event: str
+        :param fields: Values describing the event.
+        :type fields: dict
+        :returns: True if the exception was logged.
+        :rtype: bool
+        """
+        if not self.logger.isEnabledFor(self.level):
+            return False
+
+        key = self._key(error)
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self.interval:
+                seen[1] += 1
+                return False
+            suppressed = seen[1] if seen is not None else 0
+            self._seen[key] = [now, 0]
+
+        if suppressed:
+            fields['suppressed'] = suppressed
+        fields['error'] = error
+        self.logger.log(
+            self.level, StructuredMessage(event, fields),
+            exc_info=(type(error), error, error.__traceback__))
+        return True
@@ -0,0 +1,474 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In process metrics for services, exported in the Prometheus text format.
+"""
+
+import bisect
+import logging
+import threading
+
+#: Content type of the Prometheus text exposition format.
+CONTENT_TYPE_PROMETHEUS = 'text/plain; version=0.0.4; charset=utf-8'
+
+#: Default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0)
+
+
+def _escape(value):
+    """
+    Escapes a label value.
+    """
+    return str(value).replace('\\', r'\\').replace(
+        '"', r'\"').replace('\n', r'\n')
+
+
+def _format_value(value):
+    """
+    Formats a sample value.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class for metrics. Values are kept per tuple of label values.
+    """
+
+    #: Prometheus metric type
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Initializes a new Metric instance.
+
+        :param name: The metric name.
+        :type name: str
+        :param documentation: What the metric measures.
+        :type documentation: str
+        :param labelnames: Names of the metric labels.
+        :type labelnames: tuple
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def samples(self):
+        """
+        Returns the samples of the metric.
+
+        :returns: (suffix, label pairs, value) tuples.
+        :rtype: list
+        """
+        with self._lock:
+            items = sorted(self._values.items())
+        return [('', tuple(zip(self.labelnames, k)), v) for k, v in items]
+
+    def render(self):
+        """
+        Renders the metric in the Prometheus text format.
+
+        :returns: The metric family text.
+        :rtype: str
+        """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        for suffix, pairs, value in self.samples():
+            labels = ''
+            if pairs:
+                labels = '{' + ','.join(
+                    '{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, labels, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Returns the current values as JSON serializable data.
+
+        :returns: The metric type and a list of label/value dicts.
+        :rtype: dict
+        """
+        with self._lock:
+            items = sorted(self._values.items())
+        return {
+            'type': self.type,
+            'values': [
+                {'labels': dict(zip(self.labelnames, k)),
+                 'value': self._export(v)} for k, v in items],
+        }
+
+    def _export(self, value):
+        """
+        Returns a stored value as JSON serializable data.
+        """
+        return value
+
+
+class Counter(Metric):
+    """
+    A value which only goes up.
+    """
+
+    type = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        """
+        Increments the counter.
+
+        :param labels: Label values in labelnames order.
+        :type labels: tuple
+        :param amount: How much to add.
+        :type amount: int or float
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value which can go up and down.
+    """
+
+    type = 'gauge'
+
+    def inc(self, labels=(), amount=1):
+        """
+        Increments the gauge.
+
+        :param labels: Label values in labelnames order.
+        :type labels: tuple
+        :param amount: How much to add.
+        :type amount: int or float
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        """
+        Decrements the gauge.
+
+        :param labels: Label values in labelnames order.
+        :type labels: tuple
+        :param amount: How much to subtract.
+        :type amount: int or float
+        """
+        self.inc(labels, -amount)
+
+    def set(self, value, labels=()):
+        """
+        Sets the gauge.
+
+        :param value: The new value.
+        :type value: int or float
+        :param labels: Label values in labelnames order.
+        :type labels: tuple
+        """
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    Counts observations in buckets and keeps their sum.
+    """
+
+    type = 'histogram'
+
+    def __init__(
+            self, name, documentation, labelnames=(),
+            buckets=DEFAULT_BUCKETS):
+        """
+        Initializes a new Histogram instance.
+
+        :param name: The metric name.
+        :type name: str
+        :param documentation: What the metric measures.
+        :type documentation: str
+        :param labelnames: Names of the metric labels.
+        :type labelnames: tuple
+        :param buckets: Upper bounds of the buckets.
+        :type buckets: tuple
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        """
+        Records an observation.
+
+        :param value: The observed value.
+        :type value: int or float
+        :param labels: Label values in labelnames order.
+        :type labels: tuple
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(labels)
+            if data is None:
+                # One count per bucket plus +Inf, then the sum
+                data = self._values[labels] = [0] * (len(self.buckets) + 2)
+            data[index] += 1
+            data[-1] += value
+
+    def _cumulative(self, data):
+        """
+        Returns (upper bound, cumulative count) pairs for stored data.
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'), ), data):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def samples(self):
+        """
+        Returns the bucket, sum and count samples of the histogram.
+
+        :returns: (suffix, label pairs, value) tuples.
+        :rtype: list
+        """
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        samples = []
+        for labels, data in items:
+            pairs = tuple(zip(self.labelnames, labels))
+            cumulative = self._cumulative(data)
+            for bound, total in cumulative:
+                samples.append((
+                    '_bucket', pairs + (('le', _format_value(bound)), ),
+                    total))
+            samples.append(('_sum', pairs, data[-1]))
+            samples.append(('_count', pairs, cumulative[-1][1]))
+        return samples
+
+    def _export(self, value):
+        """
+        Returns count, sum and cumulative buckets.
+        """
+        cumulative = self._cumulative(value)
+        return {
+            'count': cumulative[-1][1],
+            'sum': value[-1],
+            'buckets': dict(
+                (_format_value(bound), total)
+                for bound, total in cumulative),
+        }
+
+
+class MetricsRegistry:
+    """
+    A collection of metrics rendered together.
+    """
+
+    def __init__(self):
+        """
+        Initializes a new MetricsRegistry instance.
+        """
+        self._metrics = []
+
+    def register(self, metric):
+        """
+        Adds a metric to the registry.
+
+        :param metric: The metric to add.
+        :type metric: Metric
+        :returns: The metric.
+        :rtype: Metric
+        :raises: ValueError
+        """
+        if any(m.name == metric.name for m in self._metrics):
+            raise ValueError(
+                'Metric "{}" is already registered'.format(metric.name))
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text format.
+
+        :returns: The exposition text.
+        :rtype: str
+        """
+        return ''.join(metric.render() for metric in self._metrics)
+
+    def snapshot(self):
+        """
+        Returns every metric as JSON serializable data.
+
+        :returns: Mapping of metric name to its snapshot.
+        :rtype: dict
+        """
+        return dict(
+            (metric.name, metric.snapshot()) for metric in self._metrics)
+
+
+class ServiceMetrics(MetricsRegistry):
+    """
+    The metrics every CommissaireService records.
+    """
+
+    def __init__(self):
+        """
+        Initializes a new ServiceMetrics instance.
+        """
+        super().__init__()
+        self.requests = self.register(Counter(
+            'commissaire_requests_total',
+            'Requests handled, by method.', ('method', )))
+        self.errors = self.register(Counter(
+            'commissaire_request_errors_total',
+            'Requests which failed, by method and JSON-RPC error code.',
+            ('method', 'code')))
+        self.latency = self.register(Histogram(
+            'commissaire_request_duration_seconds',
+            'Time spent in on_* methods, by method.', ('method', )))
+        self.in_progress = self.register(Gauge(
+            'commissaire_requests_in_progress',
+            'on_* methods currently running, by method.', ('method', )))
+        self.in_flight = self.register(Gauge(
+            'commissaire_messages_in_flight',
+            'Messages received but not yet acked.'))
+        self.ack_latency = self.register(Histogram(
+            'commissaire_ack_latency_seconds',
+            'Time from receiving a message to acking it.'))
+        self.duplicates = self.register(Counter(
+            'commissaire_duplicate_requests_total',
+            'Requests answered from the idempotency cache, by method.',
+            ('method', )))
+        self.reply_latency = self.register(Histogram(
+            'commissaire_reply_publish_seconds',
+            'Time spent publishing replies.'))
+        self.expired = self.register(Counter(
+            'commissaire_requests_expired_total',
+            'Requests dropped because their deadline had passed.'))
+        self.requeued = self.register(Counter(
+            'commissaire_requests_requeued_total',
+            'Messages handed back to the broker without a reply because a '
+            'drain ran out of time, by method.', ('method', )))
+        self.cache_hits = self.register(Counter(
+            'commissaire_result_cache_hits_total',
+            'Calls answered from a result cache, by method.', ('method', )))
+        self.cache_misses = self.register(Counter(
+            'commissaire_result_cache_misses_total',
+            'Calls of cacheable methods which ran, by method.', ('method', )))
+
+
+def _http_server(address, port):
+    """
+    Creates the HTTP server of a MetricsServer. http.server is imported here
+    so services which do not serve metrics never load it.
+
+    :param address: The address to listen on.
+    :type address: str
+    :param port: The port to listen on. 0 picks a free port.
+    :type port: int
+    :returns: The bound server.
+    :rtype: http.server.HTTPServer
+    :raises: OSError
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        """
+        HTTPServer handling each request on its own thread.
+        """
+
+        daemon_threads = True
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        """
+        Serves the registry of the server.
+        """
+
+        def do_GET(self):
+            """
+            Responds with the rendered metrics.
+            """
+            if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = self.server.registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE_PROMETHEUS)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            """
+            Sends access logs to the debug log instead of stderr.
+            """
+            logging.getLogger('MetricsServer').debug(format, *args)
+
+    return ThreadingHTTPServer((address, int(port)), MetricsRequestHandler)
+
+
+class MetricsServer:
+    """
+    Serves a registry over HTTP from a daemon thread.
+    """
+
+    def __init__(self, registry, port, address='127.0.0.1'):
+        """
+        Initializes a new MetricsServer instance and binds the socket.
+
+        :param registry: The registry to serve.
+        :type registry: MetricsRegistry
+        :param port: The port to listen on. 0 picks a free port.
+        :type port: int
+        :param address: The address to listen on.
+        :type address: str
+        :raises: OSError
+        """
+        self.httpd = _http_server(address, port)
+        self.httpd.registry = registry
+        self._thread = None
+
+    @property
+    def port(self):
+        """
+        The port the server listens on.
+        """
+        return self.httpd.server_address[1]
+
+    def start(self):
+        """
+        Starts serving in a daemon thread.
+        """
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, name='MetricsServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops serving and closes the socket.
+        """
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.server_close()
@@ -0,0 +1,130 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Pooled bus connections for outgoing requests and notifications.
+"""
+
+import contextlib
+import threading
+
+from kombu import Producer
+
+
+class PooledBus:
+    """
+    A connection of the pool with its producer.
+    """
+
+    def __init__(self, connection, exchange):
+        """
+        Initializes a new PooledBus instance.
+
+        :param connection: A connection only this instance uses.
+        :type connection: kombu.Connection
+        :param exchange: The exchange requests are published to.
+        :type exchange: kombu.Exchange
+        """
+        self.connection = connection
+        self.channel = connection.default_channel
+        self.producer = Producer(self.channel, exchange)
+        #: Errors after which the connection is not reused
+        self.errors = tuple(connection.connection_errors) + tuple(
+            connection.channel_errors)
+
+    def close(self):
+        """
+        Closes the connection.
+        """
+        try:
+            self.connection.release()
+        except Exception:
+            pass
+
+
+class BusPool:
+    """
+    Lends connections to one thread at a time so a thread waiting on a
+    reply does not hold up others. Connections are opened on first use and
+    reused afterwards, most recently returned first.
+    """
+
+    def __init__(self, connection, exchange, limit):
+        """
+        Initializes a new BusPool instance.
+
+        :param connection: The connection pooled connections clone.
+        :type connection: kombu.Connection
+        :param exchange: The exchange requests are published to.
+        :type exchange: kombu.Exchange
+        :param limit: Most connections open at once. Threads wait for a
+                      connection once all are lent.
+        :type limit: int
+        :raises: ValueError
+        """
+        if int(limit) < 1:
+            raise ValueError('The bus pool needs at least 1 connection')
+        self.limit = int(limit)
+        self._connection = connection
+        self._exchange = exchange
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.limit)
+
+    @property
+    def idle(self):
+        """
+        How many open connections are waiting to be lent.
+
+        :rtype: int
+        """
+        return len(self._idle)
+
+    @contextlib.contextmanager
+    def acquire(self):
+        """
+        Lends a connection for a block. A connection which failed with a
+        connection or channel error is closed instead of being reused.
+
+        :returns: The lent connection and its producer.
+        :rtype: PooledBus
+        """
+        self._slots.acquire()
+        bus = None
+        try:
+            with self._lock:
+                if self._idle:
+                    bus = self._idle.pop()
+            if bus is None:
+                bus = PooledBus(self._connection.clone(), self._exchange)
+            try:
+                yield bus
+            except bus.errors:
+                bus.close()
+                bus = None
+                raise
+        finally:
+            if bus is not None:
+                with self._lock:
+                    self._idle.append(bus)
+            self._slots.release()
+
+    def close(self):
+        """
+        Closes the idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for bus in idle:
+            bus.close()
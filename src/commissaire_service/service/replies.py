@@ -0,0 +1,120 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Long lived publisher for RPC replies.
+"""
+
+import logging
+
+from collections import OrderedDict
+
+from kombu import Exchange, Producer
+
+#: Publish replies on the nameless default exchange. The broker routes
+#: the message directly to the queue named by the routing key so nothing
+#: needs to be declared.
+REPLY_ROUTE_DEFAULT = 'default'
+
+#: Publish replies on the direct exchange created alongside the reply
+#: queue by the requesting side (what kombu's SimpleQueue sets up).
+REPLY_ROUTE_DIRECT = 'direct'
+
+REPLY_ROUTES = (REPLY_ROUTE_DEFAULT, REPLY_ROUTE_DIRECT)
+
+
+class ReplyPublisher:
+    """
+    Publishes replies to the reply_to queues of incoming requests.
+
+    Unlike a SimpleQueue per reply, a single producer is kept for the life
+    of the service and reply destinations are only declared the first time
+    they are seen. Known destinations are kept in a bounded LRU cache.
+    """
+
+    def __init__(self, channel, route=REPLY_ROUTE_DEFAULT, cache_size=128):
+        """
+        Initializes a new ReplyPublisher instance.
+
+        :param channel: The channel to publish on.
+        :type channel: kombu.transport.*.Channel
+        :param route: How replies are routed. One of REPLY_ROUTES.
+        :type route: str
+        :param cache_size: Maximum number of reply destinations to remember.
+        :type cache_size: int
+        :raises: ValueError
+        """
+        if route not in REPLY_ROUTES:
+            raise ValueError(
+                'Unknown reply route "{}". Expected one of: {}'.format(
+                    route, ', '.join(REPLY_ROUTES)))
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.route = route
+        self.cache_size = max(int(cache_size), 1)
+        self._destinations = OrderedDict()
+        self.producer = Producer(channel, Exchange(''))
+
+    def _destination(self, reply_to):
+        """
+        Returns the exchange to publish a reply on and a list of entities
+        which still need declaring.
+
+        :param reply_to: The name of the reply queue.
+        :type reply_to: str
+        :returns: The exchange and the entities to declare
+        :rtype: tuple
+        """
+        if self.route == REPLY_ROUTE_DEFAULT:
+            return self.producer.exchange, []
+
+        exchange = self._destinations.get(reply_to)
+        if exchange is not None:
+            self._destinations.move_to_end(reply_to)
+            return exchange, []
+
+        exchange = Exchange(reply_to, type='direct')
+        self._destinations[reply_to] = exchange
+        while len(self._destinations) > self.cache_size:
+            evicted, _ = self._destinations.popitem(last=False)
+            self.logger.debug(
+                'Evicted reply destination "{}" from cache'.format(evicted))
+        return exchange, [exchange]
+
+    def publish(self, body, reply_to, **kwargs):
+        """
+        Publishes a reply.
+
+        :param body: The reply body.
+        :type body: dict or str
+        :param reply_to: The name of the reply queue.
+        :type reply_to: str
+        :param kwargs: Other keyword arguments to pass to Producer.publish.
+        :type kwargs: dict
+        """
+        exchange, declare = self._destination(reply_to)
+        self.producer.publish(
+            body, exchange=exchange, routing_key=reply_to,
+            declare=declare, **kwargs)
+
+    def forget(self, reply_to=None):
+        """
+        Drops a cached reply destination, or all of them if none is given.
+
+        :param reply_to: The name of the reply queue.
+        :type reply_to: str or None
+        """
+        if reply_to is None:
+            self._destinations.clear()
+        else:
+            self._destinations.pop(reply_to, None)
@@ -0,0 +1,457 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Request tracing across bus calls. Trace and span ids travel in B3
+message headers and finished spans are exported in the Zipkin v2 JSON
+format.
+"""
+
+import contextlib
+import json
+import logging
+import random
+import threading
+
+from collections import deque, namedtuple
+from time import monotonic, sleep, time
+
+#: B3 headers carrying the trace through the bus.
+TRACE_HEADER = 'x-b3-traceid'
+SPAN_HEADER = 'x-b3-spanid'
+PARENT_HEADER = 'x-b3-parentspanid'
+SAMPLED_HEADER = 'x-b3-sampled'
+
+#: Zipkin span kinds.
+KIND_SERVER = 'SERVER'
+KIND_CLIENT = 'CLIENT'
+
+#: The ids of a span, enough to start children of it.
+SpanContext = namedtuple('SpanContext', ('trace_id', 'span_id', 'sampled'))
+
+# Tracer of the span the current thread is in, for child_span
+_active = threading.local()
+
+
+def _new_id(bits=64):
+    """
+    Returns a random hex id.
+    """
+    return '{:0{}x}'.format(random.getrandbits(bits), bits // 4)
+
+
+def read_trace(message):
+    """
+    Returns the span a message was sent from.
+
+    :param message: The message instance.
+    :type message: kombu.message.Message
+    :returns: The context of the sending span or None.
+    :rtype: SpanContext or None
+    """
+    headers = getattr(message, 'headers', None)
+    if not isinstance(headers, dict):
+        return None
+    try:
+        return SpanContext(
+            str(headers[TRACE_HEADER]), str(headers[SPAN_HEADER]),
+            str(headers.get(SAMPLED_HEADER, '1')) != '0')
+    except KeyError:
+        return None
+
+
+def trace_headers(span, headers=None):
+    """
+    Returns message headers carrying a span.
+
+    :param span: The span sending the message.
+    :type span: Span
+    :param headers: Other headers to send.
+    :type headers: dict or None
+    :returns: The headers to publish with.
+    :rtype: dict
+    """
+    headers = dict(headers or {})
+    headers[TRACE_HEADER] = span.trace_id
+    headers[SPAN_HEADER] = span.span_id
+    if span.parent_id:
+        headers[PARENT_HEADER] = span.parent_id
+    headers[SAMPLED_HEADER] = '1' if span.sampled else '0'
+    return headers
+
+
+class Span:
+    """
+    A timed operation within a trace.
+    """
+
+    def __init__(self, service_name, name, kind, trace_id, parent_id,
+                 sampled):
+        """
+        Initializes and starts a new Span instance.
+
+        :param service_name: Name of the service recording the span.
+        :type service_name: str
+        :param name: Name of the operation.
+        :type name: str
+        :param kind: KIND_SERVER, KIND_CLIENT or None for local work.
+        :type kind: str or None
+        :param trace_id: The trace the span belongs to.
+        :type trace_id: str
+        :param parent_id: Id of the parent span or None for a root.
+        :type parent_id: str or None
+        :param sampled: Whether the span is exported.
+        :type sampled: bool
+        """
+        self.service_name = service_name
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.tags = {}
+        self.timestamp = time()
+        self.duration = None
+        self._started = monotonic()
+
+    @property
+    def context(self):
+        """
+        The ids children of this span need.
+
+        :rtype: SpanContext
+        """
+        return SpanContext(self.trace_id, self.span_id, self.sampled)
+
+    def tag(self, key, value):
+        """
+        Adds a tag to the span.
+
+        :param key: The tag name.
+        :type key: str
+        :param value: The tag value, sent as a string.
+        :type value: mixed
+        """
+        self.tags[key] = str(value)
+
+    def finish(self):
+        """
+        Records the duration of the span.
+        """
+        self.duration = monotonic() - self._started
+
+    def to_zipkin(self):
+        """
+        Returns the span in the Zipkin v2 JSON format.
+
+        :rtype: dict
+        """
+        span = {
+            'traceId': self.trace_id,
+            'id': self.span_id,
+            'name': self.name,
+            'timestamp': int(self.timestamp * 1e6),
+            'duration': max(1, int((self.duration or 0) * 1e6)),
+            'localEndpoint': {'serviceName': self.service_name},
+        }
+        if self.parent_id:
+            span['parentId'] = self.parent_id
+        if self.kind:
+            span['kind'] = self.kind
+        if self.tags:
+            span['tags'] = self.tags
+        return span
+
+
+class Tracer:
+    """
+    Creates the spans of a service. Each thread has its own current span
+    which new spans are children of.
+    """
+
+    def __init__(self, service_name, exporter=None, sample_rate=1.0):
+        """
+        Initializes a new Tracer instance.
+
+        :param service_name: Name of the service in exported spans.
+        :type service_name: str
+        :param exporter: Receives finished spans. None to only pass ids on.
+        :type exporter: SpanExporter or None
+        :param sample_rate: Fraction of new traces which are exported.
+        :type sample_rate: float
+        """
+        self.service_name = service_name
+        self.exporter = exporter
+        self.sample_rate = float(sample_rate)
+        self._local = threading.local()
+
+    @property
+    def current(self):
+        """
+        The span or remote parent of the current thread.
+
+        :rtype: Span, SpanContext or None
+        """
+        return getattr(self._local, 'current', None)
+
+    @contextlib.contextmanager
+    def scope(self, parent):
+        """
+        Makes spans started by the current thread within the block
+        children of a span, for instance one read from a message.
+
+        :param parent: The parent span or None for new traces.
+        :type parent: Span, SpanContext or None
+        """
+        previous = self.current
+        previous_tracer = getattr(_active, 'tracer', None)
+        self._local.current = parent
+        _active.tracer = self
+        try:
+            yield
+        finally:
+            self._local.current = previous
+            _active.tracer = previous_tracer
+
+    def start_span(self, name, kind=None, parent=None):
+        """
+        Starts a span. It must be passed to finish_span.
+
+        :param name: Name of the operation.
+        :type name: str
+        :param kind: KIND_SERVER, KIND_CLIENT or None for local work.
+        :type kind: str or None
+        :param parent: The parent. Defaults to the current span.
+        :type parent: Span, SpanContext or None
+        :returns: The started span.
+        :rtype: Span
+        """
+        if parent is None:
+            parent = self.current
+        if parent is None:
+            return Span(
+                self.service_name, name, kind, _new_id(128), None,
+                random.random() < self.sample_rate)
+        return Span(
+            self.service_name, name, kind, parent.trace_id, parent.span_id,
+            parent.sampled)
+
+    def finish_span(self, span):
+        """
+        Finishes a span and exports it if it is sampled.
+
+        :param span: A span from start_span.
+        :type span: Span
+        """
+        span.finish()
+        if span.sampled and self.exporter is not None:
+            self.exporter.export(span)
+
+    @contextlib.contextmanager
+    def span(self, name, kind=None, parent=None, **tags):
+        """
+        Records a span around a block. The span is the current span within
+        the block and is tagged with the error if the block raises.
+
+        :param name: Name of the operation.
+        :type name: str
+        :param kind: KIND_SERVER, KIND_CLIENT or None for local work.
+        :type kind: str or None
+        :param parent: The parent. Defaults to the current span.
+        :type parent: Span, SpanContext or None
+        :param tags: Tags for the span.
+        :type tags: dict
+        """
+        span = self.start_span(name, kind, parent)
+        for key, value in tags.items():
+            span.tag(key, value)
+        try:
+            with self.scope(span):
+                yield span
+        except Exception as error:
+            span.tag('error', '{}: {}'.format(type(error).__name__, error))
+            raise
+        finally:
+            self.finish_span(span)
+
+
+@contextlib.contextmanager
+def child_span(name, **tags):
+    """
+    Records a span for local work, for instance a transport run, within
+    the request the current thread is handling. Does nothing outside of
+    a traced request.
+
+    :param name: Name of the operation.
+    :type name: str
+    :param tags: Tags for the span.
+    :type tags: dict
+    """
+    tracer = getattr(_active, 'tracer', None)
+    if tracer is None or tracer.current is None:
+        yield None
+        return
+    with tracer.span(name, **tags) as span:
+        yield span
+
+
+class SpanExporter:
+    """
+    Buffers finished spans and writes them in batches from a background
+    thread so handlers never wait on the export.
+    """
+
+    def __init__(self, interval=1.0, max_buffer=10000):
+        """
+        Initializes a new SpanExporter instance.
+
+        :param interval: Seconds between writes.
+        :type interval: float
+        :param max_buffer: Most spans kept waiting. Older ones are dropped.
+        :type max_buffer: int
+        """
+        self.logger = logging.getLogger('tracing')
+        self.interval = float(interval)
+        self._buffer = deque(maxlen=max_buffer)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def export(self, span):
+        """
+        Queues a finished span for writing.
+
+        :param span: The finished span.
+        :type span: Span
+        """
+        self._buffer.append(span.to_zipkin())
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name='span-exporter', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        """
+        Writes buffered spans every interval.
+        """
+        while True:
+            sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered spans. Failures are logged and the spans
+        dropped.
+        """
+        spans = []
+        while self._buffer:
+            spans.append(self._buffer.popleft())
+        if not spans:
+            return
+        try:
+            self._write(spans)
+        except Exception as error:
+            self.logger.warn('Dropped {} spans: {}: {}'.format(
+                len(spans), type(error).__name__, error))
+
+    def _write(self, spans):
+        """
+        Writes spans. Implemented by subclasses.
+
+        :param spans: Spans in the Zipkin v2 JSON format.
+        :type spans: list
+        """
+        raise NotImplementedError()
+
+
+class FileSpanExporter(SpanExporter):
+    """
+    Appends spans to a file, one Zipkin v2 JSON span per line.
+    """
+
+    def __init__(self, path, **kwargs):
+        """
+        Initializes a new FileSpanExporter instance.
+
+        :param path: The file to append to.
+        :type path: str
+        :param kwargs: Keyword arguments for SpanExporter.
+        :type kwargs: dict
+        """
+        super().__init__(**kwargs)
+        self.path = path
+
+    def _write(self, spans):
+        with open(self.path, 'a') as output:
+            output.write(''.join(json.dumps(x) + '\n' for x in spans))
+
+
+class ZipkinSpanExporter(SpanExporter):
+    """
+    Posts spans to a Zipkin compatible collector, for example
+    http://127.0.0.1:9411/api/v2/spans.
+    """
+
+    def __init__(self, url, timeout=5.0, **kwargs):
+        """
+        Initializes a new ZipkinSpanExporter instance.
+
+        :param url: The v2 spans endpoint of the collector.
+        :type url: str
+        :param timeout: Seconds to wait for the collector.
+        :type timeout: float
+        :param kwargs: Keyword arguments for SpanExporter.
+        :type kwargs: dict
+        """
+        super().__init__(**kwargs)
+        self.url = url
+        self.timeout = timeout
+
+    def _write(self, spans):
+        import urllib.request
+        request = urllib.request.Request(
+            self.url, data=json.dumps(spans).encode('utf-8'),
+            headers={'Content-Type': 'application/json'})
+        urllib.request.urlopen(request, timeout=self.timeout).close()
+
+
+def build_tracer(service_name, config):
+    """
+    Creates the tracer described by the tracing configuration key.
+
+    :param service_name: Name of the service in exported spans.
+    :type service_name: str
+    :param config: Dict with "file" or "zipkin_url" and optionally
+                   "sample_rate" and "interval". None only passes trace
+                   ids on.
+    :type config: dict or None
+    :returns: The tracer.
+    :rtype: Tracer
+    :raises: ValueError
+    """
+    config = dict(config or {})
+    exporter = None
+    kwargs = {}
+    if 'interval' in config:
+        kwargs['interval'] = config['interval']
+    if config.get('file'):
+        exporter = FileSpanExporter(config['file'], **kwargs)
+    elif config.get('zipkin_url'):
+        exporter = ZipkinSpanExporter(config['zipkin_url'], **kwargs)
+    elif config:
+        raise ValueError('tracing needs "file" or "zipkin_url"')
+    return Tracer(
+        service_name, exporter, config.get('sample_rate', 1.0))
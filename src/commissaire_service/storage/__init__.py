@@ -14,7 +14,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import fnmatch
-import json
+import logging
 
 import commissaire.models as models
 
@@ -23,7 +23,8 @@ from commissaire.storage import StoreHandlerBase
 from commissaire.util.config import (ConfigurationError, import_plugin)
 
 from commissaire_service.service import (
-    CommissaireService, add_service_arguments)
+    CommissaireService, add_service_arguments, cacheable, codec)
+from commissaire_service.service.logs import log_event
 
 from .custodia import CustodiaStoreHandler
 
@@ -244,10 +245,11 @@ class StorageService(CommissaireService):
         :rtype: commissaire_service.storage.models.Model
         """
         if isinstance(model_json_data, str):
-            model_json_data = json.loads(model_json_data)
+            document = model_json_data
+            model_json_data = codec.loads(document)
             if not isinstance(model_json_data, dict):
-                raise json.decoder.JSONDecodeError(
-                    'Model data expected to be a JSON object')
+                raise codec.DecodeError(
+                    'Model data expected to be a JSON object', document, 0)
         model_type = self._model_types[model_type_name]
         return model_type.new(**model_json_data)
 
@@ -268,9 +270,11 @@ class StorageService(CommissaireService):
             self.logger.error(ve.args[0])
             self.logger.error(ve.args[1])
             raise ve
-        self.logger.debug('> SAVE {}'.format(model_instance))
+        log_event(
+            self.logger, logging.DEBUG, 'storage.save', model=model_instance)
         model_instance = handler._save(model_instance)
-        self.logger.debug('< SAVE {}'.format(model_instance))
+        log_event(
+            self.logger, logging.DEBUG, 'storage.saved', model=model_instance)
         return model_instance
 
     def _get_model(self, model_instance):
@@ -283,7 +287,8 @@ class StorageService(CommissaireService):
         :rtype: commissaire.model.Model
         """
         handler = self._get_handler(model_instance)
-        self.logger.debug('> GET {}'.format(model_instance))
+        log_event(
+            self.logger, logging.DEBUG, 'storage.get', model=model_instance)
         model_instance = handler._get(model_instance)
         # Validate after getting
         try:
@@ -292,7 +297,8 @@ class StorageService(CommissaireService):
             self.logger.error(ve.args[0])
             self.logger.error(ve.args[1])
             raise ve
-        self.logger.debug('< GET {}'.format(model_instance))
+        log_event(
+            self.logger, logging.DEBUG, 'storage.found', model=model_instance)
         return model_instance
 
     def _delete_model(self, model_instance):
@@ -303,7 +309,8 @@ class StorageService(CommissaireService):
         :type model_instance:
         """
         handler = self._get_handler(model_instance)
-        self.logger.debug('> DELETE {}'.format(model_instance))
+        log_event(
+            self.logger, logging.DEBUG, 'storage.delete', model=model_instance)
         handler._delete(model_instance)
 
     def _list_models(self, model_instance):
@@ -317,9 +324,11 @@ class StorageService(CommissaireService):
         :rtype: list
         """
         handler = self._get_handler(model_instance)
-        self.logger.debug('> LIST {}'.format(model_instance))
+        log_event(
+            self.logger, logging.DEBUG, 'storage.list', model=model_instance)
         model_instance = handler._list(model_instance)
-        self.logger.debug('< LIST {}'.format(model_instance))
+        log_event(
+            self.logger, logging.DEBUG, 'storage.listed', model=model_instance)
         return getattr(model_instance, model_instance._list_attr, [])
 
     def on_save(self, message, model_type_name, model_json_data):
@@ -427,9 +436,12 @@ class StorageService(CommissaireService):
         model_list = self._list_models(model_type.new())
         return [model_instance.to_dict() for model_instance in model_list]
 
+    @cacheable(ttl=300, maxsize=1)
     def on_list_store_handlers(self, message):
         """
         Handler for the "storage.list_store_handlers" routing key.
+        Store handlers only change when the service is restarted so the
+        result is cached.
 
         Returns a list of registered store handlers as dictionaries.
         Each dictionary contains the following:
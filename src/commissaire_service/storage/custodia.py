@@ -14,15 +14,15 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 Custodia based StoreHandler.
-"""
 
-import requests
+requests is imported when the handler is first created, since
+StorageService registers this handler whether or not secrets are stored.
+"""
 
 from urllib.parse import quote
 
 from commissaire.bus import StorageLookupError
 from commissaire.storage import StoreHandlerBase
-from commissaire.util.unixadapter import UnixAdapter
 
 
 HTTP_SOCKET_PREFIX = 'http+unix://'
@@ -52,6 +52,11 @@ class CustodiaStoreHandler(StoreHandlerBase):
         """
         super().__init__(config)
 
+        import requests
+        from commissaire.util.unixadapter import UnixAdapter
+
+        # Raised by failed requests, see the module docstring
+        self._http_error = requests.HTTPError
         self.session = requests.Session()
         self.session.headers['REMOTE_USER'] = 'commissaire'
         self.session.mount(HTTP_SOCKET_PREFIX, UnixAdapter())
@@ -103,7 +108,7 @@ class CustodiaStoreHandler(StoreHandlerBase):
             response = self.session.request(
                 'POST', url, timeout=self.CUSTODIA_TIMEOUT)
             response.raise_for_status()
-        except requests.HTTPError as error:
+        except self._http_error as error:
             # XXX bool(response) defers to response.ok, which is a misfeature.
             #     Have to explicitly test "if response is None" to know if the
             #     object is there.
@@ -149,7 +154,7 @@ class CustodiaStoreHandler(StoreHandlerBase):
             response.raise_for_status()
 
             return model_instance.new(**response.json())
-        except requests.HTTPError as error:
+        except self._http_error as error:
             # XXX bool(response) defers to response.ok, which is a misfeature.
             #     Have to explicitly test "if response is None" to know if the
             #     object is there.
@@ -174,7 +179,7 @@ class CustodiaStoreHandler(StoreHandlerBase):
             response = self.session.request(
                 'DELETE', url, timeout=self.CUSTODIA_TIMEOUT)
             response.raise_for_status()
-        except requests.HTTPError as error:
+        except self._http_error as error:
             # XXX bool(response) defers to response.ok, which is a misfeature.
             #     Have to explicitly test "if response is None" to know if the
             #     object is there.
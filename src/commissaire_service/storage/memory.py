@@ -0,0 +1,122 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In memory StoreHandler for benchmarks and development. Nothing is kept
+once the process exits.
+
+Use it by setting the type of a storage handler to
+"commissaire_service.storage.memory".
+"""
+
+import threading
+
+from commissaire.bus import StorageLookupError
+from commissaire.storage import StoreHandlerBase
+
+
+class MemoryStoreHandler(StoreHandlerBase):
+    """
+    Handler keeping models in a dictionary of the process.
+    """
+
+    @classmethod
+    def check_config(cls, config):
+        """
+        This store handler has no configuration checks.
+        """
+        pass
+
+    def __init__(self, config):
+        """
+        Creates a new instance of MemoryStoreHandler.
+
+        :param config: Not applicable to this handler
+        :type config: dict
+        """
+        super().__init__(config)
+        self._lock = threading.Lock()
+        # { model type name: { primary key: model dict } }
+        self._models = {}
+
+    def _save(self, model_instance):
+        """
+        Stores a copy of the model instance.
+
+        :param model_instance: Model instance to save.
+        :type model_instance: commissaire.model.Model
+        :returns: The saved model instance.
+        :rtype: commissaire.model.Model
+        """
+        with self._lock:
+            self._models.setdefault(
+                model_instance.__class__.__name__, {})[
+                    model_instance.primary_key] = model_instance.to_dict()
+        return model_instance
+
+    def _get(self, model_instance):
+        """
+        Retrieves a stored model.
+
+        :param model_instance: Model instance to search and get.
+        :type model_instance: commissaire.model.Model
+        :returns: The saved model instance.
+        :rtype: commissaire.model.Model
+        :raises StorageLookupError: if the model was never saved
+        """
+        with self._lock:
+            data = self._models.get(
+                model_instance.__class__.__name__, {}).get(
+                    model_instance.primary_key)
+        if data is None:
+            raise StorageLookupError(
+                'No {} stored for {}'.format(
+                    model_instance.__class__.__name__,
+                    model_instance.primary_key), model_instance)
+        return model_instance.new(**data)
+
+    def _delete(self, model_instance):
+        """
+        Deletes a stored model.
+
+        :param model_instance: Model instance to delete.
+        :type model_instance: commissaire.model.Model
+        :raises StorageLookupError: if the model was never saved
+        """
+        with self._lock:
+            stored = self._models.get(model_instance.__class__.__name__, {})
+            if stored.pop(model_instance.primary_key, None) is None:
+                raise StorageLookupError(
+                    'No {} stored for {}'.format(
+                        model_instance.__class__.__name__,
+                        model_instance.primary_key), model_instance)
+
+    def _list(self, model_instance):
+        """
+        Lists all stored models of the list model's item type.
+
+        :param model_instance: List model instance to fill.
+        :type model_instance: commissaire.model.ListModel
+        :returns: The list model instance.
+        :rtype: commissaire.model.ListModel
+        """
+        item_class = model_instance._list_class
+        with self._lock:
+            items = list(self._models.get(item_class.__name__, {}).values())
+        setattr(model_instance, model_instance._list_attr,
+                [item_class.new(**data) for data in items])
+        return model_instance
+
+
+PluginClass = MemoryStoreHandler
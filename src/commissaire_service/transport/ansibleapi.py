@@ -18,12 +18,28 @@ Ansible API transport.
 
 import json
 import logging
+import os
 from subprocess import CalledProcessError
 
-from pkg_resources import resource_filename
 from time import sleep
 
-from .ansible_wrapper import gather_facts, execute_playbook
+from commissaire_service.service.tracing import child_span
+
+
+def resource_filename(package, resource):  # pragma: no cover
+    """
+    Returns the path of a file shipped with a package. pkg_resources is
+    slow to import, so it is only loaded once a playbook runs.
+
+    :param package: The package the file belongs to.
+    :type package: str
+    :param resource: Path of the file within the package.
+    :type resource: str
+    :returns: The path of the file.
+    :rtype: str
+    """
+    import pkg_resources
+    return pkg_resources.resource_filename(package, resource)
 
 
 class Transport:  # pragma: no cover
@@ -89,6 +105,8 @@ class Transport:  # pragma: no cover
         :returns: Ansible exit code
         :type: int
         """
+        # Ansible is only loaded by the processes running playbooks
+        from .ansible_wrapper import execute_playbook
         ansible_args = self._get_ansible_args(key_file)
         if play_vars:
             ansible_args.extend(['--extra-vars', json.dumps(play_vars)])
@@ -98,7 +116,10 @@ class Transport:  # pragma: no cover
         # actually run it
         for attempt in range(0, 3):
             try:
-                execute_playbook(play_file, ips, ansible_args)
+                with child_span(
+                        'ansible.' + os.path.basename(play_file),
+                        hosts=ips, attempt=attempt):
+                    execute_playbook(play_file, ips, ansible_args)
                 break
             except CalledProcessError as error:
                 result = error.returncode
@@ -203,7 +224,10 @@ class Transport:  # pragma: no cover
         :raises subprocess.CalledProcessError: if Ansible returns a non-zero
                                                exit status
         """
-        ansible_facts = gather_facts(ip, self._get_ansible_args(key_file))
+        from .ansible_wrapper import gather_facts
+        with child_span('ansible.gather_facts', hosts=ip):
+            ansible_facts = gather_facts(
+                ip, self._get_ansible_args(key_file))
         self.logger.debug('Ansible facts: {}'.format(ansible_facts))
         facts = {}
         facts['os'] = ansible_facts['ansible_distribution'].lower()
@@ -16,19 +16,17 @@
 The host node watcher.
 """
 
-import json
-
 from datetime import datetime, timedelta
 from time import sleep
 
 from commissaire import constants as C
-from commissaire.models import HostCreds, WatcherRecord
+from commissaire.models import Host, HostCreds, WatcherRecord
 from commissaire.storage.client import StorageClient
 from commissaire.util.date import formatted_dt
 from commissaire.util.ssh import TemporarySSHKey
 
 from commissaire_service.service import (
-    CommissaireService, add_service_arguments)
+    CommissaireService, add_service_arguments, codec)
 from commissaire_service.transport import ansibleapi
 
 
@@ -56,6 +54,10 @@ class WatcherService(CommissaireService):
             'name': 'watcher',
             'exclusive': False,
             'routing_key': 'jobs.watcher',
+        }, {
+            # jobs.watcher.ping and the other built-in methods
+            'name': 'watcher.health',
+            'routing_key': 'jobs.watcher.*',
         }]
         # Store the last address seen for backoff
         self.last_address = None
@@ -70,16 +72,55 @@ class WatcherService(CommissaireService):
 
     def on_message(self, body, message):
         """
-        Called when a non-jsonrpc message arrives.
+        Called when a non-jsonrpc message arrives. Requests for built-in
+        methods such as jobs.watcher.ping are handled as usual. With a
+        worker pool the check runs on it and the message is acked once it
+        is done.
 
         :param body: Body of the message.
         :type body: dict
         :param message: The message instance.
         :type message: kombu.message.Message
         """
-        record = WatcherRecord(**json.loads(body))
-        # Ack the message so it does not requeue on it's own
-        message.ack()
+        if self._method_of(message) != 'watcher':
+            return super().on_message(body, message)
+        if self._executor is None:
+            # Ack the message so it does not requeue on it's own
+            message.ack()
+            self.producer.publish(self._watch(body), 'jobs.watcher')
+            return
+        self._received(message)
+        self._executor.submit(self._watch_in_pool, body, message)
+
+    def _watch_in_pool(self, body, message):
+        """
+        Runs _watch on a pool worker and queues the message to be acked.
+
+        :param body: Body of the message.
+        :type body: dict
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        """
+        if not self._claim(message):
+            # Requeued by a drain, another process handles it
+            return
+        try:
+            record = self._watch(body)
+            with self._lend_bus():
+                self.producer.publish(record, 'jobs.watcher')
+        finally:
+            self._completed.append((message, None))
+
+    def _watch(self, body):
+        """
+        Checks the host of a WatcherRecord when it is due.
+
+        :param body: Body of the message.
+        :type body: dict
+        :returns: The record to put back on the queue, as json.
+        :rtype: str
+        """
+        record = WatcherRecord(**codec.loads(body))
         self.logger.debug(
             'Checking on WatcherQueue item: {}'.format(record.to_json()))
         if datetime.strptime(record.last_check, C.DATE_FORMAT) < (
@@ -100,8 +141,7 @@ class WatcherService(CommissaireService):
                 # Since the top item wasn't ready for processing sleep a bit
                 sleep(2)
         self.last_address = record.address
-        # Requeue the host
-        self.producer.publish(record.to_json(), 'jobs.watcher')
+        return record.to_json()
 
     def _check(self, address):
         """
@@ -117,8 +157,9 @@ class WatcherService(CommissaireService):
 
         self.logger.info('Checking host "{}".'.format(address))
 
-        host = self.storage.get_host(address)
-        host_creds = self.storage.get(HostCreds.new(address=host.address))
+        # Get the host and its credentials in one round trip
+        host, host_creds = self.get_models(
+            Host.new(address=address), HostCreds.new(address=address))
 
         transport = ansibleapi.Transport(host_creds.remote_user)
 
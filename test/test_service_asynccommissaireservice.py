@@ -0,0 +1,268 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.AsyncCommissaireService class.
+"""
+
+import asyncio
+import threading
+import time
+import uuid
+
+from . import TestCase, mock
+from commissaire import constants as C
+from commissaire.bus import RemoteProcedureCallError
+from commissaire_service.service import AsyncCommissaireService
+from commissaire_service.service.deadlines import DEADLINE_HEADER
+from commissaire_service.service.limits import JSONRPC_SERVICE_BUSY
+from commissaire_service.service.tracing import SPAN_HEADER, TRACE_HEADER
+
+
+ID = str(uuid.uuid4())
+
+
+class AsyncService(AsyncCommissaireService):
+    """
+    Service with a coroutine handler and a plain handler.
+    """
+
+    async def on_echo(self, message, words):
+        return words
+
+    def on_add(self, message, x, y):
+        return x + y
+
+    async def on_fail(self, message):
+        raise RemoteProcedureCallError('failed', {'why': 'test'})
+
+    async def on_lookup(self, message):
+        return await self.request_async('storage.get', 'get')
+
+    def on_plain_lookup(self, message):
+        return self.request('storage.get', 'get')
+
+    async def on_slow(self, message):
+        await asyncio.sleep(0.05)
+        return 'done'
+
+
+class TestAsyncCommissaireService(TestCase):
+    """
+    Tests for the AsyncCommissaireService class.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.service_instance = AsyncService(
+            'commissaire',
+            'redis://127.0.0.1:6379/',
+            [{'name': 'simple', 'routing_key': 'simple.*'}]
+        )
+        self.addCleanup(self.service_instance._loop.close)
+
+    def _run(self, method, params):
+        """
+        Runs a message through _handle_async and returns the queued result.
+        """
+        body = {
+            'jsonrpc': '2.0',
+            'id': ID,
+            'method': method,
+            'params': params,
+        }
+        message = mock.MagicMock(
+            payload=body,
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'simple.' + method})
+        self.service_instance._loop.run_until_complete(
+            self.service_instance._handle_async(body, message))
+        self.assertEquals(1, len(self.service_instance._completed))
+        queued_message, response = self.service_instance._completed.popleft()
+        self.assertIs(message, queued_message)
+        return response
+
+    def test_initialization(self):
+        """
+        Verify AsyncCommissaireService defaults the in-flight limit.
+        """
+        self.assertEquals(
+            AsyncService._default_prefetch_count,
+            self.service_instance._prefetch_count)
+
+    def test_coroutine_handler(self):
+        """
+        Verify coroutine handlers are awaited.
+        """
+        self.assertEquals(
+            {'jsonrpc': '2.0', 'id': ID, 'result': 'hello'},
+            self._run('echo', {'words': 'hello'}))
+
+    def test_plain_handler(self):
+        """
+        Verify plain handlers are run in an executor.
+        """
+        self.assertEquals(
+            {'jsonrpc': '2.0', 'id': ID, 'result': 3},
+            self._run('add', [1, 2]))
+
+    def test_error_mapping(self):
+        """
+        Verify errors map to the same jsonrpc errors as CommissaireService.
+        """
+        response = self._run('fail', {})
+        self.assertEquals({
+            'code': RemoteProcedureCallError.code,
+            'message': 'failed',
+            'data': {'why': 'test'}}, response['error'])
+
+        response = self._run('doesnotexist', {})
+        self.assertEquals(
+            C.JSONRPC_ERRORS['METHOD_NOT_FOUND'], response['error']['code'])
+
+    def test_batch(self):
+        """
+        Verify batches mix coroutine and plain handlers in one reply.
+        """
+        body = [
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'echo',
+             'params': {'words': 'hi'}},
+            {'jsonrpc': '2.0', 'method': 'echo', 'params': ['ignored']},
+            {'jsonrpc': '2.0', 'id': 2, 'method': 'add', 'params': [1, 2]},
+        ]
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'simple.batch'})
+        self.service_instance._loop.run_until_complete(
+            self.service_instance._handle_async(body, message))
+        _, response = self.service_instance._completed.popleft()
+        self.assertEquals([
+            {'jsonrpc': '2.0', 'id': 1, 'result': 'hi'},
+            {'jsonrpc': '2.0', 'id': 2, 'result': 3},
+        ], response)
+
+    def _configured(self, config):
+        """
+        Returns an AsyncService reading the given configuration.
+        """
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = config
+            service = AsyncService(
+                'commissaire', 'redis://127.0.0.1:6379/',
+                [{'name': 'simple', 'routing_key': 'simple.*'}])
+        self.addCleanup(service._loop.close)
+        return service
+
+    def test_batch_elements_count_against_their_method(self):
+        """
+        Verify concurrent batch elements respect per-method limits.
+        """
+        service = self._configured({'in_flight_limits': {'simple.slow': 1}})
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'simple.batch'})
+        service._loop.run_until_complete(service._handle_async([
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'slow'},
+            {'jsonrpc': '2.0', 'id': 2, 'method': 'slow'}], message))
+        _, (done, busy) = service._completed.popleft()
+        self.assertEquals('done', done['result'])
+        self.assertEquals(JSONRPC_SERVICE_BUSY, busy['error']['code'])
+        self.assertEquals({'slow': 0}, service._limits.in_flight)
+
+    def test_isolation_pools_are_refused(self):
+        """
+        Verify isolation_pools is not silently ignored.
+        """
+        self.assertRaises(
+            ValueError, self._configured, {'isolation_pools': {'slow': 1}})
+
+    def test_on_message_schedules_on_loop(self):
+        """
+        Verify AsyncCommissaireService.on_message does not run the handler.
+        """
+        with mock.patch('asyncio.run_coroutine_threadsafe') as rct:
+            self.service_instance.on_message({}, mock.MagicMock())
+            rct.assert_called_once_with(
+                mock.ANY, self.service_instance._loop)
+            rct.call_args[0][0].close()
+
+    def test_nested_requests_keep_the_call_scope(self):
+        """
+        Verify requests from coroutine and plain handlers continue the trace
+        and carry the deadline of the message.
+        """
+        seen = []
+
+        def request(*args, **kwargs):
+            seen.append((
+                self.service_instance._context.deadline,
+                self.service_instance._tracer.current))
+            return 'ok'
+
+        self.service_instance.request = request
+        deadline = time.time() + 30
+        for method in ('lookup', 'plain_lookup'):
+            body = {'jsonrpc': '2.0', 'id': ID, 'method': method}
+            message = mock.MagicMock(
+                properties={'reply_to': 'test_queue'},
+                delivery_info={'routing_key': 'simple.' + method},
+                headers={
+                    DEADLINE_HEADER: deadline,
+                    TRACE_HEADER: 'a' * 32, SPAN_HEADER: 'b' * 16})
+            self.service_instance._loop.run_until_complete(
+                self.service_instance._handle_async(body, message))
+            _, response = self.service_instance._completed.popleft()
+            self.assertEquals('ok', response['result'])
+        self.assertEquals(2, len(seen))
+        for seen_deadline, span in seen:
+            self.assertEquals(deadline, seen_deadline)
+            self.assertEquals(
+                ('a' * 32, 'b' * 16), (span.trace_id, span.parent_id))
+        # Outside of a handler nothing is passed on
+        self.service_instance._loop.run_until_complete(
+            self.service_instance.request_async('storage.get', 'get'))
+        self.assertEquals((None, None), seen[-1])
+
+    def test_concurrent_requests(self):
+        """
+        Verify overlapping request_async calls do not wait on each other.
+        """
+        self.addCleanup(self.service_instance._executor.shutdown)
+        self.assertEquals(
+            AsyncService._default_prefetch_count,
+            self.service_instance._bus_pool.limit)
+        barrier = threading.Barrier(2, timeout=5)
+
+        def get(*args, **kwargs):
+            # Only returns once both requests wait for their reply
+            barrier.wait()
+            return mock.MagicMock(payload={'result': 'ok'})
+
+        connection = self.service_instance.connection.clone.return_value
+        connection.SimpleQueue.return_value.get.side_effect = get
+
+        async def both():
+            return await asyncio.gather(
+                self.service_instance.request_async('storage.get', 'get'),
+                self.service_instance.request_async('storage.get', 'get'))
+
+        with mock.patch('commissaire_service.service.pools.Producer'):
+            responses = self.service_instance._loop.run_until_complete(
+                both())
+        self.assertEquals([{'result': 'ok'}] * 2, responses)
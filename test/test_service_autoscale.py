@@ -0,0 +1,124 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.autoscale.
+"""
+
+from kombu import Connection
+
+from . import TestCase
+from commissaire_service.service.autoscale import Autoscaler, QueueBacklog
+
+
+class TestAutoscaler(TestCase):
+    """
+    Tests for the Autoscaler class.
+    """
+
+    def setUp(self):
+        self.autoscaler = Autoscaler(
+            1, 8, scale_up_backlog=10, scale_down_backlog=0,
+            scale_up_samples=2, scale_down_samples=3)
+
+    def test_invalid_limits(self):
+        """
+        Verify impossible limits are rejected.
+        """
+        self.assertRaises(ValueError, Autoscaler, 0, 1)
+        self.assertRaises(ValueError, Autoscaler, 4, 2)
+        self.assertRaises(
+            ValueError, Autoscaler, 1, 2,
+            scale_up_backlog=1, scale_down_backlog=1)
+
+    def test_scale_up_needs_consecutive_samples(self):
+        """
+        Verify a single burst does not add processes.
+        """
+        self.assertEquals(1, self.autoscaler.decide(1, 50))
+        self.assertEquals(1, self.autoscaler.decide(1, 5))
+        self.assertEquals(1, self.autoscaler.decide(1, 50))
+        # Second sample in a row above the threshold
+        self.assertEquals(5, self.autoscaler.decide(1, 50))
+
+    def test_scale_up_is_capped(self):
+        """
+        Verify the process count never goes above max_workers.
+        """
+        self.autoscaler.decide(1, 1000)
+        self.assertEquals(8, self.autoscaler.decide(1, 1000))
+
+    def test_scale_down_one_at_a_time(self):
+        """
+        Verify idle processes are retired one per scale_down_samples.
+        """
+        decisions = [self.autoscaler.decide(4, 0) for _ in range(3)]
+        self.assertEquals([4, 4, 3], decisions)
+        decisions = [self.autoscaler.decide(3, 0) for _ in range(3)]
+        self.assertEquals([3, 3, 2], decisions)
+
+    def test_scale_down_stops_at_min(self):
+        """
+        Verify the process count never goes below min_workers.
+        """
+        for _ in range(10):
+            self.assertEquals(1, self.autoscaler.decide(1, 0))
+
+    def test_hysteresis(self):
+        """
+        Verify a backlog between the thresholds keeps the count steady.
+        """
+        for backlog in (0, 0, 5, 0, 0, 5):
+            self.assertEquals(4, self.autoscaler.decide(4, backlog))
+
+    def test_target_latency(self):
+        """
+        Verify a slowly draining backlog adds processes.
+        """
+        autoscaler = Autoscaler(
+            1, 8, interval=1.0, scale_up_backlog=100,
+            target_latency=10.0, scale_up_samples=1)
+        # The drain rate is unknown until the backlog shrinks
+        self.assertEquals(2, autoscaler.decide(2, 42))
+        # Drains at 2 messages per second
+        self.assertEquals(3, autoscaler.decide(2, 40))
+        self.assertEquals(20.0, autoscaler.estimated_latency(40))
+        # Drains at 20 messages per second
+        autoscaler = Autoscaler(
+            1, 8, interval=1.0, scale_up_backlog=100,
+            target_latency=10.0, scale_up_samples=1)
+        autoscaler.decide(2, 60)
+        self.assertEquals(2, autoscaler.decide(2, 40))
+
+
+class TestQueueBacklog(TestCase):
+    """
+    Tests for the QueueBacklog class.
+    """
+
+    def test_backlog(self):
+        """
+        Verify QueueBacklog counts waiting messages on named queues.
+        """
+        connection = Connection('memory://')
+        self.addCleanup(connection.release)
+        queue = connection.SimpleQueue('test_backlog')
+        for x in range(3):
+            queue.put({'x': x})
+
+        backlog = QueueBacklog('memory://', ['test_backlog', 'missing'])
+        self.addCleanup(backlog.close)
+        self.assertEquals(3, backlog())
+        queue.get(timeout=1).ack()
+        self.assertEquals(2, backlog())
@@ -0,0 +1,177 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.caching.
+"""
+
+import json
+
+from . import TestCase, mock
+from commissaire_service.service import CommissaireService, cacheable
+from commissaire_service.service.caching import (
+    CacheOptions, ResultCache, default_key)
+
+
+class TestResultCache(TestCase):
+    """
+    Tests for the ResultCache class.
+    """
+
+    def setUp(self):
+        self.method = mock.MagicMock(side_effect=lambda *a, **kw: object())
+        self.cache = ResultCache(
+            'test', self.method, CacheOptions(10, 2, default_key))
+
+    def test_hits_and_misses(self):
+        """
+        Verify results are reused and the message is not part of the key.
+        """
+        first = self.cache(mock.MagicMock(), 'a')
+        self.assertIs(first, self.cache(mock.MagicMock(), 'a'))
+        self.assertIs(first, self.cache(mock.MagicMock(), 'a'))
+        self.assertIsNot(first, self.cache(message=mock.MagicMock(), x='a'))
+        self.assertEquals(2, self.method.call_count)
+        self.assertEquals((2, 2), (self.cache.hits, self.cache.misses))
+
+    def test_ttl(self):
+        """
+        Verify results expire.
+        """
+        with mock.patch(
+                'commissaire_service.service.caching.monotonic') as _now:
+            _now.return_value = 100
+            first = self.cache(None, 'a')
+            _now.return_value = 109
+            self.assertIs(first, self.cache(None, 'a'))
+            _now.return_value = 110
+            self.assertIsNot(first, self.cache(None, 'a'))
+
+    def test_maxsize(self):
+        """
+        Verify the least recently used result is evicted.
+        """
+        a = self.cache(None, 'a')
+        b = self.cache(None, 'b')
+        self.cache(None, 'a')
+        self.cache(None, 'c')
+        self.assertIs(a, self.cache(None, 'a'))
+        self.assertIsNot(b, self.cache(None, 'b'))
+
+    def test_errors_are_not_cached(self):
+        """
+        Verify failed calls run again.
+        """
+        self.method.side_effect = [Exception, 'ok']
+        self.assertRaises(Exception, self.cache, None, 'a')
+        self.assertEquals('ok', self.cache(None, 'a'))
+
+    def test_params_are_bound(self):
+        """
+        Verify calls share a key however their params were passed.
+        """
+        def on_list(message, name, namespace='default'):
+            return object()
+
+        cache = ResultCache(
+            'list', on_list, CacheOptions(10, 8, default_key))
+        first = cache(None, 'a', 'default')
+        self.assertIs(first, cache(None, 'a', namespace='default'))
+        self.assertIs(first, cache(None, name='a'))
+        self.assertIs(first, cache(message=None, name='a'))
+        self.assertIsNot(first, cache(None, 'a', 'other'))
+        cache.invalidate(name='a')
+        self.assertIsNot(first, cache(None, 'a'))
+
+    def test_invalidate(self):
+        """
+        Verify results can be dropped one at a time or all at once.
+        """
+        a = self.cache(None, 'a')
+        b = self.cache(None, 'b')
+        self.cache.invalidate('a')
+        self.assertIsNot(a, self.cache(None, 'a'))
+        self.assertIs(b, self.cache(None, 'b'))
+        self.cache.invalidate()
+        self.assertIsNot(b, self.cache(None, 'b'))
+
+
+class CachingService(CommissaireService):
+    """
+    Service with a cacheable method.
+    """
+
+    calls = 0
+
+    @cacheable(ttl=60, key=lambda name: name)
+    def on_lookup(self, message, name):
+        self.calls += 1
+        return {'name': name, 'calls': self.calls}
+
+
+class TestCacheableService(TestCase):
+    """
+    Tests for @cacheable methods of a CommissaireService.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.service_instance = CachingService(
+            'commissaire',
+            'redis://127.0.0.1:6379/',
+            [{'name': 'simple', 'routing_key': 'simple.*'}]
+        )
+        self.service_instance._replies = mock.MagicMock()
+
+    def _deliver(self, params):
+        """
+        Delivers a lookup request and returns the result.
+        """
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'simple.lookup'})
+        self.service_instance.on_message({
+            'jsonrpc': '2.0', 'id': '1', 'method': 'lookup',
+            'params': params}, message)
+        return json.loads(
+            self.service_instance._replies.publish.call_args[0][0])['result']
+
+    def test_results_are_cached(self):
+        """
+        Verify named and positional params share cached results.
+        """
+        self.assertEquals(1, self._deliver({'name': 'a'})['calls'])
+        self.assertEquals(1, self._deliver(['a'])['calls'])
+        self.assertEquals(2, self._deliver(['b'])['calls'])
+        metrics = self.service_instance.on_stats(None)
+        self.assertEquals(
+            [{'labels': {'method': 'lookup'}, 'value': 1}],
+            metrics['commissaire_result_cache_hits_total']['values'])
+        self.assertEquals(
+            [{'labels': {'method': 'lookup'}, 'value': 2}],
+            metrics['commissaire_result_cache_misses_total']['values'])
+
+    def test_invalidate_cache(self):
+        """
+        Verify invalidate_cache drops cached results.
+        """
+        self._deliver(['a'])
+        self.service_instance.invalidate_cache('lookup', 'a')
+        self.assertEquals(2, self._deliver(['a'])['calls'])
+        self.assertRaises(
+            KeyError, self.service_instance.invalidate_cache, 'reboot')
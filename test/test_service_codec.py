@@ -0,0 +1,148 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.codec.
+"""
+
+import json
+
+from . import TestCase, mock
+from commissaire_service.service import codec
+
+
+class TestCodec(TestCase):
+    """
+    Tests for the codec module.
+    """
+
+    def setUp(self):
+        self.addCleanup(codec.use_backend, codec.BACKEND)
+
+    def _backends(self):
+        """
+        Yields the name of each installed backend after switching to it.
+        """
+        for name in codec.BACKENDS:
+            try:
+                codec.use_backend(name)
+            except ImportError:
+                continue
+            yield name
+
+    def test_round_trip(self):
+        """
+        Verify every installed backend round trips bus payloads.
+        """
+        data = {
+            'jsonrpc': '2.0',
+            'id': 'abc',
+            'result': [{'address': '10.0.0.{}'.format(x), 'ok': True}
+                       for x in range(3)],
+            'big': 2 ** 70,
+        }
+        for name in self._backends():
+            encoded = codec.dumps(data)
+            self.assertIs(str, type(encoded), name)
+            self.assertEquals(data, json.loads(encoded), name)
+            self.assertEquals(data, codec.loads(encoded), name)
+            self.assertEquals(data, codec.loads(encoded.encode()), name)
+
+    def test_decode_error(self):
+        """
+        Verify every installed backend raises codec.DecodeError.
+        """
+        for name in self._backends():
+            self.assertRaises(codec.DecodeError, codec.loads, '{"bad"')
+            self.assertTrue(issubclass(codec.DecodeError, ValueError))
+
+    def test_use_backend(self):
+        """
+        Verify use_backend picks an installed backend or rejects unknowns.
+        """
+        self.assertIn(codec.use_backend(), codec.BACKENDS)
+        self.assertEquals('json', codec.use_backend('json'))
+        self.assertRaises(ValueError, codec.use_backend, 'pickle')
+
+
+class TestReplyNegotiation(TestCase):
+    """
+    Tests for reply serializer negotiation.
+    """
+
+    def test_accept_content(self):
+        """
+        Verify accept_content keeps plain strings acceptable.
+        """
+        self.assertIsNone(codec.accept_content(None))
+        with mock.patch.object(codec, 'HAVE_MSGPACK', True):
+            self.assertEquals(
+                ['json', 'msgpack'] + list(codec.PLAIN_CONTENT_TYPES),
+                codec.accept_content(['json', 'msgpack']))
+
+    def test_accept_content_without_msgpack(self):
+        """
+        Verify msgpack is not accepted when it can not be decoded.
+        """
+        with mock.patch.object(codec, 'HAVE_MSGPACK', False):
+            self.assertEquals(
+                ['json'] + list(codec.PLAIN_CONTENT_TYPES),
+                codec.accept_content(
+                    ['json', 'msgpack', codec.CONTENT_TYPE_MSGPACK]))
+
+    def test_reply_serializer(self):
+        """
+        Verify reply_serializer honors the request content type and header.
+        """
+        def message(content_type, headers=None):
+            return mock.MagicMock(
+                content_type=content_type, headers=headers or {})
+
+        self.assertIsNone(codec.reply_serializer(
+            message(codec.CONTENT_TYPE_JSON)))
+        self.assertIsNone(codec.reply_serializer(message('text/plain')))
+        with mock.patch.object(codec, 'HAVE_MSGPACK', True):
+            self.assertEquals('msgpack', codec.reply_serializer(
+                message(codec.CONTENT_TYPE_MSGPACK)))
+            self.assertEquals('msgpack', codec.reply_serializer(message(
+                codec.CONTENT_TYPE_JSON,
+                {'accept': 'application/json, application/x-msgpack'})))
+        with mock.patch.object(codec, 'HAVE_MSGPACK', False):
+            self.assertIsNone(codec.reply_serializer(
+                message(codec.CONTENT_TYPE_MSGPACK)))
+
+    def test_compressions(self):
+        """
+        Verify compressions only accepts codecs kombu knows.
+        """
+        self.assertEquals((), codec.compressions(None))
+        self.assertEquals(('zlib', ), codec.compressions(['zlib']))
+        self.assertRaises(ValueError, codec.compressions, ['zip'])
+
+    def test_reply_compression(self):
+        """
+        Verify reply_compression picks the first codec both sides support.
+        """
+        def message(accept):
+            return mock.MagicMock(
+                headers={codec.ACCEPT_ENCODING_HEADER: accept})
+
+        self.assertEquals('zlib', codec.reply_compression(
+            message('lzma, zlib'), ('zlib', 'bzip2')))
+        self.assertIsNone(codec.reply_compression(
+            message('lzma'), ('zlib', )))
+        self.assertIsNone(codec.reply_compression(
+            message('zlib'), ()))
+        self.assertIsNone(codec.reply_compression(
+            mock.MagicMock(headers=None), ('zlib', )))
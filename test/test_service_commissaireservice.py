@@ -16,14 +16,41 @@
 Tests for commissaire_service.service.CommissaireService class.
 """
 
+import json
+import threading
+import time
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
+
+from kombu import serialization
+
 from . import TestCase, mock
-from commissaire_service.service import CommissaireService
+from commissaire import constants as C
+from commissaire.bus import RemoteProcedureCallError, StorageLookupError
+from commissaire.models import Host, HostCreds
+from commissaire_service.service import CommissaireService, codec
+from commissaire_service.service.deadlines import DeadlineExceededError
+from commissaire_service.service.tracing import TRACE_HEADER
 
 
 ID = str(uuid.uuid4())
 
+#: Publish arguments of a JSON reply
+JSON_REPLY = {
+    'content_type': codec.CONTENT_TYPE_JSON, 'content_encoding': 'utf-8'}
+
+
+def _msgpack_reply(publish):
+    """
+    Returns the single reply published as msgpack, decoded.
+    """
+    publish.assert_called_once_with(
+        mock.ANY, 'test_queue', content_type=codec.CONTENT_TYPE_MSGPACK,
+        content_encoding='binary')
+    return serialization.loads(
+        publish.call_args[0][0], codec.CONTENT_TYPE_MSGPACK, 'binary')
+
 
 class TestCommissaireService(TestCase):
     """
@@ -52,9 +79,9 @@ class TestCommissaireService(TestCase):
         )
 
     def tearDown(self):
-        self._connection.stop()
-        self._exchange.stop()
-        self._producer.stop()
+        self._connection_patcher.stop()
+        self._exchange_patcher.stop()
+        self._producer_patcher.stop()
 
     def test_initialization(self):
         """
@@ -103,23 +130,109 @@ class TestCommissaireService(TestCase):
         message = mock.MagicMock(properties={'properties': 'here'})
         self.service_instance.on_message('test', message)
 
+    def test_on_message_with_json_string(self):
+        """
+        Verify CommissaireService.on_message decodes string bodies once.
+        """
+        body = json.dumps({
+            'jsonrpc': '2.0',
+            'id': ID,
+            'method': 'method',
+            'params': {'kwarg': 'value'},
+        })
+        message = mock.MagicMock(
+            payload=body,
+            properties={},
+            delivery_info={'routing_key': 'test.method'})
+        self.service_instance.on_method = mock.MagicMock(return_value='{}')
+        with mock.patch('commissaire_service.service.codec.loads',
+                        side_effect=json.loads) as _loads:
+            self.service_instance.on_message(body, message)
+            _loads.assert_called_once_with(body)
+        self.service_instance.on_method.assert_called_once_with(
+            kwarg='value', message=message)
+        # The decoded request is kept on the message
+        self.assertEquals(ID, message.jsonrpc_request['id'])
+
     def test_responds(self):
         """
         Verify CommissaireService.respond can respond to a request.
         """
         queue_name = 'test_queue'
         payload = {'test': 'data'}
+        self.service_instance._replies = mock.MagicMock()
         self.service_instance.respond(queue_name, ID, payload)
+        # There should be 1 reply published with a jsonrpc structure
+        self.service_instance._replies.publish.assert_called_once_with(
+            mock.ANY, queue_name, **JSON_REPLY)
+        self.assertEquals({
+            'jsonrpc': "2.0",
+            'id': ID,
+            'result': payload,
+        }, json.loads(self.service_instance._replies.publish.call_args[0][0]))
+        # No SimpleQueue should have been created
+        self.assertEquals(
+            0, self.service_instance.connection.SimpleQueue.call_count)
+
+    def test_responds_with_msgpack(self):
+        """
+        Verify CommissaireService.respond honors a msgpack request.
+        """
+        self.service_instance._replies = mock.MagicMock()
+        message = mock.MagicMock(
+            content_type='application/x-msgpack', headers={})
+        with mock.patch(
+                'commissaire_service.service.codec.HAVE_MSGPACK', True):
+            self.service_instance.respond(
+                'test_queue', ID, {}, message=message)
+        self.assertEquals(
+            {'jsonrpc': "2.0", 'id': ID, 'result': {}},
+            _msgpack_reply(self.service_instance._replies.publish))
+
+    def test_on_message_replies_with_msgpack(self):
+        """
+        Verify CommissaireService.on_message replies in msgpack if asked.
+        """
+        body = {
+            'jsonrpc': '2.0',
+            'id': ID,
+            'method': 'method',
+            'params': {},
+        }
+        message = mock.MagicMock(
+            payload=body,
+            content_type='application/json',
+            headers={'accept': 'application/x-msgpack'},
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'test.method'})
+        self.service_instance.on_method = mock.MagicMock(return_value=1)
+        self.service_instance._replies = mock.MagicMock()
+        with mock.patch(
+                'commissaire_service.service.codec.HAVE_MSGPACK', True):
+            self.service_instance.on_message(body, message)
+        self.assertEquals(
+            {'jsonrpc': '2.0', 'id': ID, 'result': 1},
+            _msgpack_reply(self.service_instance._replies.publish))
+
+    def test_responds_with_queue_kwargs(self):
+        """
+        Verify CommissaireService.respond uses a SimpleQueue given kwargs.
+        """
+        queue_name = 'test_queue'
+        payload = {'test': 'data'}
+        self.service_instance.respond(
+            queue_name, ID, payload, serializer='json')
         # We should have had a SimpleQueue instance created
         self.service_instance.connection.SimpleQueue.assert_called_once_with(
-            queue_name)
+            queue_name, serializer='json')
         # And there should be 1 call to put with a jsonrpc structure
-        self.service_instance.connection.SimpleQueue.__call__(
-            ).put.assert_called_once_with({
-                'jsonrpc': "2.0",
-                'id': ID,
-                'result': payload,
-            })
+        put = self.service_instance.connection.SimpleQueue.__call__().put
+        put.assert_called_once_with(mock.ANY, **JSON_REPLY)
+        self.assertEquals({
+            'jsonrpc': "2.0",
+            'id': ID,
+            'result': payload,
+        }, json.loads(put.call_args[0][0]))
         # And finally the queue should be closed
         self.service_instance.connection.SimpleQueue.__call__(
             ).close.assert_called_once_with()
@@ -158,9 +271,48 @@ class TestCommissaireService(TestCase):
             payload=body,
             properties={'reply_to': 'test_queue'},
             delivery_info={'routing_key': 'test.doesnotexist'})
+        self.service_instance._replies = mock.MagicMock()
         self.service_instance.on_message(body, message)
-        self.service_instance.connection.SimpleQueue.assert_called_once_with(
-            'test_queue')
+        self.service_instance._replies.publish.assert_called_once_with(
+            mock.ANY, 'test_queue', **JSON_REPLY)
+        response = json.loads(
+            self.service_instance._replies.publish.call_args[0][0])
+        self.assertEquals(
+            C.JSONRPC_ERRORS['METHOD_NOT_FOUND'], response['error']['code'])
+
+    def test_on_message_records_metrics(self):
+        """
+        Verify CommissaireService.on_message records request metrics.
+        """
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'test.method'})
+        self.service_instance._replies = mock.MagicMock()
+        self.service_instance.on_method = mock.MagicMock(return_value=1)
+        for method in ('method', 'doesnotexist'):
+            message.delivery_info['routing_key'] = 'test.' + method
+            self.service_instance.on_message(
+                {'jsonrpc': '2.0', 'id': ID, 'method': method}, message)
+        stats = self.service_instance.on_stats(message)
+        self.assertEquals(
+            [{'labels': {'method': 'method'}, 'value': 1},
+             {'labels': {'method': 'unknown'}, 'value': 1}],
+            stats['commissaire_requests_total']['values'])
+        self.assertEquals(
+            [{'labels': {
+                'method': 'unknown',
+                'code': str(C.JSONRPC_ERRORS['METHOD_NOT_FOUND'])},
+              'value': 1}],
+            stats['commissaire_request_errors_total']['values'])
+        self.assertEquals(
+            1, stats['commissaire_request_duration_seconds'][
+                'values'][0]['value']['count'])
+        self.assertEquals(
+            2, stats['commissaire_ack_latency_seconds'][
+                'values'][0]['value']['count'])
+        self.assertEquals(
+            [{'labels': {}, 'value': 0}],
+            stats['commissaire_messages_in_flight']['values'])
 
     def test_on_message_with_bad_message(self):
         """
@@ -173,3 +325,411 @@ class TestCommissaireService(TestCase):
             properties={'reply_to': 'test_queue'})
         self.service_instance.on_message(body, message)
         self.assertEquals(1, self.service_instance.on_message.call_count)
+
+
+    def _batch(self, batch):
+        """
+        Sends a batch through on_message and returns the reply or None.
+        """
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'test.batch'})
+        self.service_instance._replies = mock.MagicMock()
+        self.service_instance.on_message(json.dumps(batch), message)
+        message.ack.assert_called_once_with()
+        if not self.service_instance._replies.publish.call_count:
+            return None
+        return json.loads(
+            self.service_instance._replies.publish.call_args[0][0])
+
+    def test_on_message_with_batch(self):
+        """
+        Verify CommissaireService.on_message answers batches with one reply.
+        """
+        self.service_instance.on_add = lambda message, x, y: x + y
+        self.service_instance.on_whoami = (
+            lambda message: message.jsonrpc_request['id'])
+        self.service_instance.on_notify = mock.MagicMock()
+        reply = self._batch([
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'add', 'params': [1, 2]},
+            {'jsonrpc': '2.0', 'method': 'notify', 'params': {}},
+            {'jsonrpc': '2.0', 'id': 2, 'method': 'whoami'},
+            {'jsonrpc': '2.0', 'id': 3, 'method': 'doesnotexist'},
+            'bogus',
+        ])
+        # The notification is called but left out of the reply
+        self.assertEquals(1, self.service_instance.on_notify.call_count)
+        self.assertEquals(4, len(reply))
+        self.assertEquals({'jsonrpc': '2.0', 'id': 1, 'result': 3}, reply[0])
+        # Handlers see their own element as the request
+        self.assertEquals({'jsonrpc': '2.0', 'id': 2, 'result': 2}, reply[1])
+        self.assertEquals(
+            C.JSONRPC_ERRORS['METHOD_NOT_FOUND'], reply[2]['error']['code'])
+        self.assertEquals(
+            C.JSONRPC_ERRORS['INVALID_REQUEST'], reply[3]['error']['code'])
+
+    def test_on_message_with_empty_batch(self):
+        """
+        Verify an empty batch gets a single error response.
+        """
+        reply = self._batch([])
+        self.assertEquals(
+            C.JSONRPC_ERRORS['INVALID_REQUEST'], reply['error']['code'])
+
+    def test_on_message_with_notification_batch(self):
+        """
+        Verify a batch of notifications gets no reply.
+        """
+        self.service_instance.on_notify = mock.MagicMock()
+        self.assertIsNone(self._batch([
+            {'jsonrpc': '2.0', 'method': 'notify'},
+            {'jsonrpc': '2.0', 'method': 'notify'},
+        ]))
+        self.assertEquals(2, self.service_instance.on_notify.call_count)
+
+    def test_request_batch(self):
+        """
+        Verify CommissaireService.request_batch returns responses in order.
+        """
+        self.service_instance._bus_pool = mock.MagicMock()
+        bus = self.service_instance._bus_pool.acquire().__enter__()
+        queue = bus.connection.SimpleQueue.return_value
+
+        def reply(body, *args, **kwargs):
+            requests = json.loads(body)
+            queue.get.return_value.payload = json.dumps([
+                {'jsonrpc': '2.0', 'id': requests[1]['id'], 'result': 2},
+                {'jsonrpc': '2.0', 'id': requests[0]['id'], 'result': 1},
+            ])
+
+        bus.producer.publish.side_effect = reply
+        responses = self.service_instance.request_batch(
+            'simple.batch', [('one', {}), ('two', [1])])
+        self.assertEquals([1, 2], [x['result'] for x in responses])
+        requests = json.loads(bus.producer.publish.call_args[0][0])
+        self.assertEquals(['one', 'two'], [x['method'] for x in requests])
+        queue.get.return_value.ack.assert_called_once_with()
+        queue.close.assert_called_once_with()
+
+    def test_get_models_keeps_error_types(self):
+        """
+        Verify get_models raises the error class storage raised.
+        """
+        self.service_instance.request_batch = mock.MagicMock(return_value=[
+            {'jsonrpc': '2.0', 'id': '1', 'result': {'address': '1.2.3.4'}},
+            {'jsonrpc': '2.0', 'id': '2', 'error': {
+                'code': StorageLookupError.code, 'message': 'missing',
+                'data': {}}},
+        ])
+        self.assertRaises(
+            StorageLookupError, self.service_instance.get_models,
+            Host.new(address='1.2.3.4'), HostCreds.new(address='1.2.3.4'))
+        self.service_instance.request_batch.return_value = [None]
+        with self.assertRaises(RemoteProcedureCallError) as context:
+            self.service_instance.get_models(Host.new(address='1.2.3.4'))
+        self.assertIn('no response for Host', str(context.exception))
+
+    def test_get_models_times_out(self):
+        """
+        Verify get_models does not wait for storage forever.
+        """
+        self.service_instance.request_batch = mock.MagicMock(return_value=[
+            {'jsonrpc': '2.0', 'id': '1', 'result': {'address': '1.2.3.4'}}])
+        self.service_instance.get_models(Host.new(address='1.2.3.4'))
+        self.assertEquals(
+            30.0, self.service_instance.request_batch.call_args[1]['timeout'])
+        self.service_instance.get_models(
+            Host.new(address='1.2.3.4'), timeout=2)
+        self.assertEquals(
+            2, self.service_instance.request_batch.call_args[1]['timeout'])
+
+    def test_large_replies_are_compressed(self):
+        """
+        Verify replies over the threshold use the requester's compression.
+        """
+        self.service_instance._replies = mock.MagicMock()
+        self.service_instance._compression_threshold = 100
+        self.service_instance.on_echo = lambda message, words: words
+        for words, accept, expected in (
+                ('x' * 200, 'lzma, zlib', dict(
+                    JSON_REPLY, compression='zlib')),
+                ('x' * 200, None, JSON_REPLY),
+                ('x', 'zlib', JSON_REPLY)):
+            message = mock.MagicMock(
+                properties={'reply_to': 'test_queue'},
+                delivery_info={'routing_key': 'simple.echo'},
+                headers={codec.ACCEPT_ENCODING_HEADER: accept})
+            self.service_instance.on_message({
+                'jsonrpc': '2.0', 'id': ID, 'method': 'echo',
+                'params': [words]}, message)
+            self.assertEquals(
+                expected,
+                self.service_instance._replies.publish.call_args[1])
+
+    def test_large_batches_are_compressed(self):
+        """
+        Verify large batches are compressed and replies may be.
+        """
+        self.service_instance._compression_threshold = 100
+        self.service_instance._bus_pool = mock.MagicMock()
+        bus = self.service_instance._bus_pool.acquire().__enter__()
+        queue = bus.connection.SimpleQueue.return_value
+        queue.get.return_value.payload = '[]'
+        self.service_instance.request_batch(
+            'storage.batch', [('save', {'x': 'x' * 200})])
+        kwargs = bus.producer.publish.call_args[1]
+        self.assertEquals('zlib', kwargs['compression'])
+        self.assertEquals(
+            'zlib', kwargs['headers'][codec.ACCEPT_ENCODING_HEADER])
+
+
+class TestCommissaireServiceWithWorkers(TestCase):
+    """
+    Tests for the CommissaireService class dispatching to a worker pool.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {'max_workers': 2}
+            self.service_instance = CommissaireService(
+                'commissaire',
+                'redis://127.0.0.1:6379/',
+                [{'name': 'simple', 'routing_key': 'simple.*'}]
+            )
+        self.addCleanup(self.service_instance._executor.shutdown)
+        self.service_instance._replies = mock.MagicMock()
+
+    def test_get_consumers_with_prefetch(self):
+        """
+        Verify CommissaireService.get_consumers sets the prefetch count.
+        """
+        Consumer = mock.MagicMock()
+        self.service_instance.get_consumers(Consumer, mock.MagicMock())
+        Consumer.assert_called_once_with(
+            mock.ANY, callbacks=[self.service_instance.on_message],
+            prefetch_count=2)
+
+    def test_on_message_acks_after_completion(self):
+        """
+        Verify the message is only replied to and acked by on_iteration.
+        """
+        body = {
+            'jsonrpc': '2.0',
+            'id': ID,
+            'method': 'method',
+            'params': {},
+        }
+        message = mock.MagicMock(
+            payload=body,
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'test.method'})
+        self.service_instance.on_method = mock.MagicMock(return_value='ok')
+        self.service_instance.on_message(body, message)
+        # Wait for the worker to finish
+        self.service_instance._executor.shutdown(wait=True)
+        self.service_instance.on_method.assert_called_once_with(
+            message=message)
+        self.assertEquals(0, message.ack.call_count)
+        self.assertEquals(
+            0, self.service_instance._replies.publish.call_count)
+
+        self.service_instance.on_iteration()
+        message.ack.assert_called_once_with()
+        self.service_instance._replies.publish.assert_called_once_with(
+            mock.ANY, 'test_queue', **JSON_REPLY)
+        self.assertEquals(
+            {'jsonrpc': '2.0', 'id': ID, 'result': 'ok'},
+            json.loads(
+                self.service_instance._replies.publish.call_args[0][0]))
+
+    def test_batch_elements_run_concurrently(self):
+        """
+        Verify batch elements run on the batch pool when configured.
+        """
+        self.service_instance._batch_executor = ThreadPoolExecutor(2)
+        self.addCleanup(self.service_instance._batch_executor.shutdown)
+        barrier = threading.Barrier(2, timeout=5)
+        self.service_instance.on_wait = lambda message: barrier.wait()
+        message = mock.MagicMock(
+            properties={}, delivery_info={'routing_key': 'test.batch'})
+        # Both elements must run at the same time to pass the barrier
+        reply = self.service_instance._handle([
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'wait'},
+            {'jsonrpc': '2.0', 'id': 2, 'method': 'wait'},
+        ], message)
+        self.assertEquals([1, 2], [x['id'] for x in reply])
+        self.assertTrue(all('result' in x for x in reply))
+
+    def _start(self, method):
+        """
+        Hands a request to the pool without letting it finish.
+        """
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'test.' + method})
+        self.service_instance.on_message(
+            {'jsonrpc': '2.0', 'id': ID, 'method': method}, message)
+        return message
+
+    def test_drain_finishes_in_flight_messages(self):
+        """
+        Verify a drain stops consuming and waits for messages in flight.
+        """
+        release = threading.Event()
+        self.service_instance.on_wait = lambda message: release.wait(5)
+        consumer = mock.MagicMock()
+        self.service_instance._consumers = [consumer]
+        message = self._start('wait')
+
+        self.service_instance.drain(grace=30)
+        self.service_instance.on_iteration()
+        consumer.cancel.assert_called_once_with()
+        self.assertFalse(self.service_instance.should_stop)
+
+        release.set()
+        self.service_instance._executor.shutdown(wait=True)
+        self.service_instance.on_iteration()
+        message.ack.assert_called_once_with()
+        self.service_instance._replies.publish.assert_called_once_with(
+            mock.ANY, 'test_queue', **JSON_REPLY)
+        self.assertTrue(self.service_instance.should_stop)
+
+    def test_drain_finishes_started_messages_after_grace(self):
+        """
+        Verify messages a worker started are finished, not requeued, when
+        the grace period ends.
+        """
+        release = threading.Event()
+        self.service_instance.on_wait = lambda message: release.wait(5)
+        message = self._start('wait')
+        while not self.service_instance._running:
+            time.sleep(0.01)
+
+        self.service_instance.drain(grace=0)
+        self.service_instance.on_iteration()
+        self.assertFalse(message.requeue.called)
+        self.assertFalse(self.service_instance.should_stop)
+
+        release.set()
+        self.service_instance._executor.shutdown(wait=True)
+        self.service_instance.on_iteration()
+        message.ack.assert_called_once_with()
+        self.assertTrue(self.service_instance.should_stop)
+
+    def test_drain_requeued_messages_are_not_handled(self):
+        """
+        Verify messages requeued by a drain never run here as well.
+        """
+        handled = []
+        release = threading.Event()
+
+        def on_wait(message):
+            handled.append(message)
+            release.wait(5)
+
+        self.service_instance.on_wait = on_wait
+        messages = [self._start('wait') for _ in range(3)]
+        while len(handled) < 2:
+            time.sleep(0.01)
+
+        self.service_instance.drain(grace=0)
+        self.service_instance.on_iteration()
+        messages[2].requeue.assert_called_once_with()
+
+        release.set()
+        self.service_instance._executor.shutdown(wait=True)
+        self.service_instance.on_iteration()
+        self.assertEquals(messages[:2], handled)
+        for message in messages[:2]:
+            message.ack.assert_called_once_with()
+            self.assertFalse(message.requeue.called)
+        self.assertFalse(messages[2].ack.called)
+        self.assertTrue(self.service_instance.should_stop)
+
+
+class EchoService(CommissaireService):
+    """
+    Service answering over the memory transport.
+    """
+
+    def on_echo(self, message, words):
+        return {
+            'words': words,
+            'headers': sorted(message.headers or {}),
+        }
+
+    def on_fail(self, message):
+        raise StorageLookupError('missing', {})
+
+    def on_deadline(self, message):
+        return {
+            'remaining': self.time_remaining(message),
+            'expiration': message.properties.get('expiration'),
+        }
+
+
+class TestCommissaireServiceOverTheBus(TestCase):
+    """
+    Tests for requests sent over the memory transport, end to end.
+    """
+
+    def _service(self, service_class, qkwargs):
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {
+                'transport_options': {'polling_interval': 0.01}}
+            return service_class('commissaire', 'memory://', qkwargs)
+
+    def setUp(self):
+        # The memory transport is shared by the whole process
+        self.prefix = 'echo{}'.format(uuid.uuid4().hex)
+        self.server = self._service(EchoService, [{
+            'name': self.prefix, 'routing_key': self.prefix + '.*'}])
+        thread = threading.Thread(target=self.server.run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(setattr, self.server, 'should_stop', True)
+        for _ in range(500):
+            if self.server._consumers:
+                break
+            thread.join(0.01)
+        self.client = self._service(CommissaireService, [])
+
+    def test_request(self):
+        """
+        Verify request gets the result with the trace headers sent along.
+        """
+        response = self.client.request(
+            self.prefix + '.echo', 'echo', params={'words': 'hello'},
+            timeout=5)
+        self.assertEquals('hello', response['result']['words'])
+        self.assertIn(TRACE_HEADER, response['result']['headers'])
+        self.assertIn(
+            codec.ACCEPT_ENCODING_HEADER, response['result']['headers'])
+
+    def test_request_error(self):
+        """
+        Verify errors are raised as the class the handler raised.
+        """
+        self.assertRaises(
+            StorageLookupError, self.client.request, self.prefix + '.fail',
+            timeout=5)
+
+    def test_request_deadline(self):
+        """
+        Verify the deadline and a matching expiration reach the handler.
+        """
+        response = self.client.request(
+            self.prefix + '.deadline', deadline=time.time() + 30)
+        self.assertTrue(25 < response['result']['remaining'] <= 30)
+        self.assertTrue(25000 < int(response['result']['expiration']) <= 30000)
+        # A passed deadline is never sent
+        self.assertRaises(
+            DeadlineExceededError, self.client.request,
+            self.prefix + '.deadline', deadline=time.time() - 1)
@@ -58,9 +58,9 @@ class TestContainerManagerService(TestCase):
         """
         Called after each test case.
         """
-        self._connection.stop()
-        self._exchange.stop()
-        self._producer.stop()
+        self._connection_patcher.stop()
+        self._exchange_patcher.stop()
+        self._producer_patcher.stop()
 
     def test_config_notification(self):
         """
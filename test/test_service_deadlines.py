@@ -0,0 +1,166 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.deadlines.
+"""
+
+import json
+
+from . import TestCase, mock
+from commissaire_service.service import CommissaireService
+from commissaire_service.service.deadlines import (
+    DEADLINE_HEADER, DeadlineContext, DeadlineExceededError,
+    deadline_headers, read_deadline, time_remaining)
+
+
+def _message(deadline=None, routing_key='simple.lookup'):
+    """
+    Returns a message with an optional deadline header.
+    """
+    headers = {}
+    if deadline is not None:
+        headers[DEADLINE_HEADER] = deadline
+    return mock.MagicMock(
+        headers=headers,
+        properties={'reply_to': 'test_queue'},
+        delivery_info={'routing_key': routing_key})
+
+
+class TestDeadlineHelpers(TestCase):
+    """
+    Tests for the deadline helpers.
+    """
+
+    def test_read_deadline(self):
+        """
+        Verify deadlines are read from headers and bad values ignored.
+        """
+        self.assertEquals(10.5, read_deadline(_message('10.5')))
+        self.assertIsNone(read_deadline(_message()))
+        self.assertIsNone(read_deadline(_message('soon')))
+        self.assertIsNone(read_deadline(mock.MagicMock()))
+
+    def test_time_remaining(self):
+        """
+        Verify the remaining time is relative to the wall clock.
+        """
+        with mock.patch('time.time', return_value=100.0):
+            self.assertEquals(5.0, time_remaining(105.0))
+            self.assertEquals(-1.0, time_remaining(99.0))
+        self.assertIsNone(time_remaining(None))
+
+    def test_deadline_headers(self):
+        """
+        Verify other headers are kept.
+        """
+        self.assertEquals(
+            {'a': 1, DEADLINE_HEADER: 5.0}, deadline_headers(5.0, {'a': 1}))
+
+    def test_context(self):
+        """
+        Verify scopes nest and restore the previous deadline.
+        """
+        context = DeadlineContext()
+        with context.scope(10.0):
+            with context.scope(5.0):
+                self.assertEquals(5.0, context.deadline)
+            self.assertEquals(10.0, context.deadline)
+        self.assertIsNone(context.deadline)
+
+
+class TestDeadlineService(TestCase):
+    """
+    Tests for deadlines in CommissaireService.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.service_instance = CommissaireService(
+            'commissaire',
+            'redis://127.0.0.1:6379/',
+            [{'name': 'simple', 'routing_key': 'simple.*'}]
+        )
+        self.service_instance._replies = mock.MagicMock()
+        self.service_instance.on_lookup = mock.MagicMock(return_value='ok')
+
+    def test_expired_messages_are_dropped(self):
+        """
+        Verify expired messages are acked without running or replying.
+        """
+        message = _message(1.0)
+        self.service_instance.on_message(
+            {'jsonrpc': '2.0', 'id': '1', 'method': 'lookup'}, message)
+        self.assertFalse(self.service_instance.on_lookup.called)
+        self.assertFalse(self.service_instance._replies.publish.called)
+        message.ack.assert_called_once_with()
+        self.assertEquals(
+            [{'labels': {}, 'value': 1}],
+            self.service_instance.on_stats(None)[
+                'commissaire_requests_expired_total']['values'])
+
+    def test_live_messages_are_handled(self):
+        """
+        Verify messages before their deadline are handled and can see it.
+        """
+        with mock.patch('time.time', return_value=100.0):
+            message = _message(130.0)
+            self.service_instance.on_lookup.side_effect = (
+                lambda message: self.service_instance.time_remaining(message))
+            self.service_instance.on_message(
+                {'jsonrpc': '2.0', 'id': '1', 'method': 'lookup'}, message)
+        self.assertTrue(self.service_instance._replies.publish.called)
+        self.assertEquals(30.0, json.loads(
+            self.service_instance._replies.publish.call_args[0][0])['result'])
+
+    def test_nested_requests_carry_the_deadline(self):
+        """
+        Verify requests made by a handler send the deadline along.
+        """
+        with mock.patch.object(
+                self.service_instance, '_send_request') as _request, \
+                mock.patch('time.time', return_value=100.0):
+            _request.return_value = {'result': 'ok'}
+            self.service_instance.on_lookup.side_effect = (
+                lambda message: self.service_instance.request(
+                    'storage.get', 'get', params={}))
+            self.service_instance.on_message(
+                {'jsonrpc': '2.0', 'id': '1', 'method': 'lookup'},
+                _message(130.0))
+            _request.assert_called_once_with(
+                'storage.get', mock.ANY, 30.0,
+                headers=mock.ANY, expiration=30.0)
+            self.assertEquals(
+                130.0, _request.call_args[1]['headers'][DEADLINE_HEADER])
+            # Outside of a handler there is no deadline
+            self.service_instance.request('storage.get', 'get')
+            _request.assert_called_with(
+                'storage.get', mock.ANY, None, headers=mock.ANY)
+            self.assertNotIn(
+                DEADLINE_HEADER, _request.call_args[1]['headers'])
+
+    def test_request_after_deadline(self):
+        """
+        Verify requests are not sent once the deadline passed.
+        """
+        with mock.patch.object(
+                self.service_instance, '_send_request') as _request:
+            self.assertRaises(
+                DeadlineExceededError, self.service_instance.request,
+                'storage.get', 'get', deadline=1.0)
+            self.assertFalse(_request.called)
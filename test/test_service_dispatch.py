@@ -0,0 +1,155 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.dispatch.
+"""
+
+from . import TestCase, mock
+from commissaire_service.service import (
+    CommissaireService, RESERVED_HANDLERS)
+from commissaire_service.service.dispatch import (
+    InvalidParamsError, JSONRPC_INVALID_PARAMS, MethodBinder,
+    build_dispatch_table)
+
+
+class DispatchService(CommissaireService):
+    """
+    Service with a few exposed methods.
+    """
+
+    def on_get(self, message, model_type_name, model_json_data=None):
+        return model_type_name
+
+    def on_anything(self, message, *args, **kwargs):
+        return args, kwargs
+
+    def on_named(self, message, *, name):
+        return name
+
+
+class TestMethodBinder(TestCase):
+    """
+    Tests for the MethodBinder class.
+    """
+
+    def setUp(self):
+        self.message = mock.MagicMock()
+        self.binder = MethodBinder('get', DispatchService.on_get.__get__(
+            mock.MagicMock()))
+
+    def test_bind_with_dict(self):
+        """
+        Verify MethodBinder.bind builds keyword arguments from a dict.
+        """
+        self.assertEquals(
+            ((), {'message': self.message, 'model_type_name': 'Host'}),
+            self.binder.bind(self.message, {'model_type_name': 'Host'}))
+
+    def test_bind_with_list(self):
+        """
+        Verify MethodBinder.bind builds positional arguments from a list.
+        """
+        self.assertEquals(
+            ((self.message, 'Host', {}), {}),
+            self.binder.bind(self.message, ['Host', {}]))
+
+    def test_bind_with_invalid_params(self):
+        """
+        Verify MethodBinder.bind rejects params not matching the signature.
+        """
+        for params in (
+                {},
+                {'model_type_name': 'Host', 'bogus': 1},
+                {'model_type_name': 'Host', 'message': 1},
+                [],
+                ['Host', {}, 'extra'],
+                'Host'):
+            self.assertRaises(
+                InvalidParamsError, self.binder.bind, self.message, params)
+
+    def test_bind_with_var_arguments(self):
+        """
+        Verify MethodBinder.bind accepts anything for *args and **kwargs.
+        """
+        binder = MethodBinder('anything', mock.MagicMock())
+        self.assertEquals(
+            ((), {'message': self.message, 'a': 1}),
+            binder.bind(self.message, {'a': 1}))
+        self.assertEquals(
+            ((self.message, 1, 2, 3), {}),
+            binder.bind(self.message, [1, 2, 3]))
+
+    def test_bind_with_keyword_only(self):
+        """
+        Verify MethodBinder.bind requires a dict for keyword only params.
+        """
+        binder = MethodBinder('named', DispatchService.on_named.__get__(
+            mock.MagicMock()))
+        self.assertRaises(
+            InvalidParamsError, binder.bind, self.message, ['x'])
+        self.assertEquals(
+            ((), {'message': self.message, 'name': 'x'}),
+            binder.bind(self.message, {'name': 'x'}))
+
+
+class TestDispatchTable(TestCase):
+    """
+    Tests for the dispatch table of CommissaireService.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.service_instance = DispatchService(
+            'commissaire', 'redis://127.0.0.1:6379/',
+            [{'name': 'simple', 'routing_key': 'simple.*'}])
+
+    def test_build_dispatch_table(self):
+        """
+        Verify only bus methods end up in the dispatch table.
+        """
+        table = build_dispatch_table(
+            self.service_instance, RESERVED_HANDLERS)
+        self.assertEquals(
+            set(['get', 'anything', 'named', 'stats', 'ping', 'introspect']),
+            set(table.keys()))
+        self.assertEquals(table.keys(), self.service_instance._dispatch.keys())
+
+    def test_invalid_params_are_rejected_before_the_call(self):
+        """
+        Verify bad params get INVALID_PARAMS without calling the method.
+        """
+        self.service_instance._dispatch['get'].method = mock.MagicMock()
+        message = mock.MagicMock(
+            properties={}, delivery_info={'routing_key': 'simple.get'})
+        response = self.service_instance._handle({
+            'jsonrpc': '2.0', 'id': 1, 'method': 'get',
+            'params': {'wrong': 'Host'}}, message)
+        self.assertEquals(JSONRPC_INVALID_PARAMS, response['error']['code'])
+        self.assertEquals(
+            0, self.service_instance._dispatch['get'].method.call_count)
+
+    def test_consumer_callbacks_are_not_exposed(self):
+        """
+        Verify consumer callbacks like on_message can not be called remotely.
+        """
+        message = mock.MagicMock(
+            properties={}, delivery_info={'routing_key': 'simple.message'})
+        self.assertRaises(
+            AttributeError, self.service_instance._prepare_call,
+            {'jsonrpc': '2.0', 'id': 1, 'method': 'message', 'params': {}},
+            message, {})
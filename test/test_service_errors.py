@@ -0,0 +1,52 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.errors.
+"""
+
+from . import TestCase
+from commissaire.bus import RemoteProcedureCallError, StorageLookupError
+from commissaire_service.service.errors import rebuild_error
+from commissaire_service.service.limits import (
+    JSONRPC_SERVICE_BUSY, ServiceBusyError)
+
+
+class TestRebuildError(TestCase):
+    """
+    Tests for the rebuild_error function.
+    """
+
+    def test_known_codes(self):
+        """
+        Verify errors come back as the class declaring their code.
+        """
+        error = rebuild_error({
+            'code': StorageLookupError.code, 'message': 'missing',
+            'data': {'exception': 'KeyError'}})
+        self.assertIs(StorageLookupError, type(error))
+        self.assertEquals('missing', str(error))
+        self.assertEquals({'exception': 'KeyError'}, error.data)
+        error = rebuild_error({
+            'code': JSONRPC_SERVICE_BUSY, 'message': 'busy',
+            'data': {'retry_after': 1.0}})
+        self.assertIs(ServiceBusyError, type(error))
+
+    def test_unknown_codes(self):
+        """
+        Verify other errors are plain RemoteProcedureCallErrors.
+        """
+        error = rebuild_error({'code': -32601, 'message': 'no method'})
+        self.assertIs(RemoteProcedureCallError, type(error))
+        self.assertEquals('no method', str(error))
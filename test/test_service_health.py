@@ -0,0 +1,153 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.health.
+"""
+
+import json
+import os
+import threading
+
+from . import TestCase, mock
+from commissaire_service.service import CommissaireService
+from commissaire_service.service.health import Heartbeat, config_digest
+
+
+class TestHealthHelpers(TestCase):
+    """
+    Tests for the health helpers.
+    """
+
+    def test_heartbeat(self):
+        """
+        Verify the heartbeat holds the time of the last beat.
+        """
+        heartbeat = Heartbeat()
+        self.assertIsNone(heartbeat.last)
+        with mock.patch(
+                'commissaire_service.service.health.monotonic',
+                return_value=12.5):
+            heartbeat.beat()
+        self.assertEquals(12.5, heartbeat.last)
+
+    def test_config_digest(self):
+        """
+        Verify the digest ignores key order and follows values.
+        """
+        self.assertEquals(
+            config_digest({'a': 1, 'b': 2}), config_digest({'b': 2, 'a': 1}))
+        self.assertNotEqual(
+            config_digest({'a': 1}), config_digest({'a': 2}))
+
+
+class TestHealthMethods(TestCase):
+    """
+    Tests for the ping and introspect methods of CommissaireService.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {'max_workers': 1, 'max_in_flight': 1}
+            self.service_instance = CommissaireService(
+                'commissaire',
+                'redis://127.0.0.1:6379/',
+                [{'name': 'simple', 'routing_key': 'simple.*'}]
+            )
+        self.addCleanup(self.service_instance._executor.shutdown)
+        self.service_instance._replies = mock.MagicMock()
+
+    def _deliver(self, method, id):
+        """
+        Delivers a request and returns the message.
+        """
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'simple.' + method})
+        self.service_instance.on_message(
+            {'jsonrpc': '2.0', 'id': id, 'method': method}, message)
+        return message
+
+    def _last_reply(self):
+        """
+        Returns the last reply published.
+        """
+        return json.loads(
+            self.service_instance._replies.publish.call_args[0][0])
+
+    def test_ping(self):
+        """
+        Verify ping reports the process and whether it is draining.
+        """
+        result = self.service_instance.on_ping(None)
+        self.assertEquals('ok', result['status'])
+        self.assertEquals('CommissaireService', result['service'])
+        self.assertEquals(os.getpid(), result['pid'])
+        self.assertEquals(0, result['in_flight'])
+        self.service_instance._drain_deadline = 0
+        self.assertEquals(
+            'draining', self.service_instance.on_ping(None)['status'])
+
+    def test_introspect(self):
+        """
+        Verify introspect describes the queues, methods and last error.
+        """
+        self.service_instance.on_fail = mock.MagicMock(
+            side_effect=Exception('broken'))
+        self._deliver('fail', '1')
+        self.service_instance._executor.shutdown(wait=True)
+        self.service_instance.on_iteration()
+        result = self.service_instance.on_introspect(None)
+        queue = self.service_instance._queues[0]
+        self.assertEquals([{
+            'name': 'simple',
+            'exchange': queue.exchange.name,
+            'routing_key': 'simple.*'}], result['queues'])
+        self.assertEquals(['fail', 'introspect', 'ping', 'stats'], result['methods'])
+        self.assertEquals(
+            self.service_instance._config_digest, result['config_digest'])
+        self.assertEquals('fail', result['last_error']['method'])
+        self.assertEquals('broken', result['last_error']['message'])
+        self.assertEquals(1, result['handled'])
+
+    def test_answered_while_busy(self):
+        """
+        Verify health methods are answered even with every worker busy.
+        """
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.service_instance.on_list = lambda message: release.wait(5)
+        self._deliver('list', '1')
+
+        message = self._deliver('ping', '2')
+        message.ack.assert_called_once_with()
+        reply = self._last_reply()
+        self.assertEquals('2', reply['id'])
+        self.assertEquals('ok', reply['result']['status'])
+        # The busy request and the ping itself
+        self.assertEquals(2, reply['result']['in_flight'])
+
+    def test_heartbeat(self):
+        """
+        Verify the consumer loop beats the heartbeat it was given.
+        """
+        self.service_instance._heartbeat = mock.MagicMock()
+        self.service_instance.on_iteration()
+        self.service_instance._heartbeat.beat.assert_called_once_with()
@@ -0,0 +1,127 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.host.
+"""
+
+from . import TestCase, mock
+from commissaire_service.service import CommissaireService
+from commissaire_service.service.host import (
+    ServiceHost, load_service_class)
+
+
+class TestServiceHost(TestCase):
+    """
+    Tests for the ServiceHost class.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.first = CommissaireService(
+            'commissaire', 'redis://127.0.0.1:6379/',
+            [{'name': 'simple', 'routing_key': 'simple.*'}])
+        self.second = CommissaireService(
+            'commissaire', 'redis://127.0.0.1:6379/',
+            [{'name': 'other', 'routing_key': 'other.*'}])
+        self.second_connection = self.second.connection
+        self.host = ServiceHost([self.first, self.second])
+        for service in (self.first, self.second):
+            self.addCleanup(service._executor.shutdown)
+
+    def test_connections_are_shared(self):
+        """
+        Verify the services reply and send on the first one's connections.
+        """
+        self.assertIs(self.first.connection, self.host.connection)
+        self.assertIs(self.first.connection, self.second.connection)
+        self.assertIs(self.first._replies, self.second._replies)
+        self.assertIs(self.first._bus_pool, self.second._bus_pool)
+        self.assertEquals(2, self.first._bus_pool.limit)
+        self.second_connection.release.assert_called_once_with()
+
+    def test_handlers_run_on_worker_pools(self):
+        """
+        Verify hosted services keep handlers off the shared consumer thread
+        and take one message at a time.
+        """
+        for service in (self.first, self.second):
+            self.assertEquals(1, service._executor._max_workers)
+            self.assertEquals(1, service._prefetch_count)
+
+    def test_consumers(self):
+        """
+        Verify every service consumes its own queues on its own channel.
+        """
+        Consumer = mock.MagicMock(side_effect=lambda queue, **kwargs: queue)
+        channel = mock.MagicMock()
+        self.host._consumer_connection = mock.MagicMock()
+        own_channel = self.host._consumer_connection.channel.return_value
+        with mock.patch(
+                'commissaire_service.service.host.Consumer') as own_consumer:
+            own_consumer.side_effect = lambda channel, queue, **kwargs: queue
+            consumers = self.host.get_consumers(Consumer, channel)
+        self.assertEquals(['simple', 'other'], [x.name for x in consumers])
+        self.assertEquals(
+            [self.first.on_message], Consumer.call_args[1]['callbacks'])
+        self.assertIs(own_channel, own_consumer.call_args[0][0])
+        self.assertEquals(
+            [self.second.on_message], own_consumer.call_args[1]['callbacks'])
+
+        with mock.patch.object(self.second, 'on_consume_ready') as ready:
+            self.host.on_consume_ready(None, channel, consumers)
+        ready.assert_called_once_with(None, own_channel, [consumers[1]])
+        self.assertEquals([consumers[0]], self.first._consumers)
+
+        with mock.patch.object(self.first, 'on_consume_end'), \
+                mock.patch.object(self.second, 'on_consume_end'):
+            self.host.on_consume_end(None, channel)
+        own_channel.close.assert_called_once_with()
+        self.assertEquals([], self.host._channels)
+
+    def test_stops_with_the_last_service(self):
+        """
+        Verify the host runs until every service stopped.
+        """
+        self.first.should_stop = True
+        self.assertFalse(self.host.should_stop)
+        self.second.should_stop = True
+        self.assertTrue(self.host.should_stop)
+
+        self.host.should_stop = False
+        self.assertFalse(self.first.should_stop)
+
+    def test_consume_interval(self):
+        """
+        Verify the host wakes up as often as its services need.
+        """
+        self.second._executor = mock.MagicMock()
+        with mock.patch('kombu.mixins.ConsumerMixin.consume') as consume:
+            self.host.consume(limit=1)
+        consume.assert_called_once_with(
+            limit=1, safety_interval=self.second._completion_interval)
+
+    def test_invalid_services(self):
+        """
+        Verify unknown services and mismatched exchanges are refused.
+        """
+        self.assertRaises(ValueError, load_service_class, 'nope')
+        self.assertRaises(ValueError, ServiceHost, [])
+        self.second._exchange = mock.MagicMock()
+        self.second._exchange.name = 'elsewhere'
+        self.assertRaises(ValueError, ServiceHost, [self.first, self.second])
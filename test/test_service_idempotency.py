@@ -0,0 +1,250 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.idempotency.
+"""
+
+import json
+import sys
+
+from . import TestCase, mock
+from commissaire_service.service import CommissaireService
+from commissaire_service.service.idempotency import (
+    IN_PROGRESS, RedisResponseCache, ResponseCache, build_response_cache)
+from commissaire_service.service.limits import JSONRPC_SERVICE_BUSY
+
+
+class RedisError(Exception):
+    pass
+
+
+class TestResponseCache(TestCase):
+    """
+    Tests for the ResponseCache class.
+    """
+
+    def test_get_and_set(self):
+        """
+        Verify completed requests are remembered.
+        """
+        cache = ResponseCache()
+        self.assertIsNone(cache.get('get:1'))
+        cache.set('get:1', {'result': 1})
+        self.assertEquals({'result': 1}, cache.get('get:1'))
+
+    def test_ttl(self):
+        """
+        Verify entries expire.
+        """
+        cache = ResponseCache(ttl=10)
+        with mock.patch(
+                'commissaire_service.service.idempotency.monotonic') as _now:
+            _now.return_value = 100
+            cache.set('get:1', {'result': 1})
+            _now.return_value = 109
+            self.assertEquals({'result': 1}, cache.get('get:1'))
+            _now.return_value = 110
+            self.assertIsNone(cache.get('get:1'))
+
+    def test_max_size(self):
+        """
+        Verify the least recently used entry is evicted.
+        """
+        cache = ResponseCache(max_size=2)
+        cache.set('get:1', {'result': 1})
+        cache.set('get:2', {'result': 2})
+        cache.get('get:1')
+        cache.set('get:3', {'result': 3})
+        self.assertIsNone(cache.get('get:2'))
+        self.assertEquals({'result': 1}, cache.get('get:1'))
+
+    def test_claim(self):
+        """
+        Verify a request is marked as running until it completes or is
+        released.
+        """
+        cache = ResponseCache(claim_ttl=10)
+        with mock.patch(
+                'commissaire_service.service.idempotency.monotonic') as _now:
+            _now.return_value = 100
+            self.assertIsNone(cache.claim('get:1'))
+            self.assertEquals(IN_PROGRESS, cache.claim('get:1'))
+            cache.release('get:1')
+            self.assertIsNone(cache.claim('get:1'))
+            cache.set('get:1', {'result': 1})
+            self.assertEquals({'result': 1}, cache.claim('get:1'))
+            # A mark left by a process that died expires
+            self.assertIsNone(cache.claim('get:2'))
+            _now.return_value = 110
+            self.assertIsNone(cache.claim('get:2'))
+
+
+class TestRedisResponseCache(TestCase):
+    """
+    Tests for the RedisResponseCache class.
+    """
+
+    def setUp(self):
+        self.redis = mock.MagicMock(RedisError=RedisError)
+        patcher = mock.patch.dict(sys.modules, {'redis': self.redis})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = self.redis.StrictRedis.from_url.return_value
+        self.cache = RedisResponseCache(
+            'redis://127.0.0.1:6379/', ttl=60, prefix='test:')
+
+    def test_get_and_set(self):
+        """
+        Verify entries are stored with a ttl and decoded on the way out.
+        """
+        self.cache.set('get:1', {'result': 1})
+        self.client.setex.assert_called_once_with(
+            'test:get:1', 60, mock.ANY)
+        self.client.get.return_value = self.client.setex.call_args[0][2]
+        self.assertEquals({'result': 1}, self.cache.get('get:1'))
+        self.client.get.return_value = None
+        self.assertIsNone(self.cache.get('get:2'))
+
+    def test_claim(self):
+        """
+        Verify only one process can claim a request.
+        """
+        self.cache.claim_ttl = 30
+        self.client.set.return_value = True
+        self.assertIsNone(self.cache.claim('get:1'))
+        self.client.set.assert_called_once_with(
+            'test:get:1', mock.ANY, nx=True, ex=30)
+        self.client.set.return_value = None
+        self.client.get.return_value = self.client.set.call_args[0][1]
+        self.assertEquals(IN_PROGRESS, self.cache.claim('get:1'))
+        self.cache.release('get:1')
+        self.client.delete.assert_called_once_with('test:get:1')
+
+    def test_errors_are_misses(self):
+        """
+        Verify Redis errors do not fail requests.
+        """
+        self.client.get.side_effect = RedisError
+        self.client.setex.side_effect = RedisError
+        self.client.set.side_effect = RedisError
+        self.client.delete.side_effect = RedisError
+        self.assertIsNone(self.cache.get('get:1'))
+        self.cache.set('get:1', {'result': 1})
+        self.assertIsNone(self.cache.claim('get:1'))
+        self.cache.release('get:1')
+
+
+class TestBuildResponseCache(TestCase):
+    """
+    Tests for build_response_cache.
+    """
+
+    def test_build(self):
+        """
+        Verify the configured backend is built.
+        """
+        self.assertIsNone(build_response_cache({}, 'Test'))
+        cache = build_response_cache(
+            {'idempotency': 'memory', 'idempotency_ttl': 5}, 'Test')
+        self.assertIsInstance(cache, ResponseCache)
+        self.assertEquals(5, cache.ttl)
+        self.assertRaises(
+            ValueError, build_response_cache,
+            {'idempotency': 'redis'}, 'Test', 'memory://')
+        self.assertRaises(
+            ValueError, build_response_cache, {'idempotency': 'bogus'}, 'x')
+
+    def test_build_redis_from_bus_uri(self):
+        """
+        Verify the Redis backend defaults to a Redis bus.
+        """
+        with mock.patch.dict(sys.modules, {'redis': mock.MagicMock()}):
+            cache = build_response_cache(
+                {'idempotency': 'redis'}, 'Test', 'redis://127.0.0.1:6379/')
+        self.assertEquals('commissaire:idempotency:Test:', cache.prefix)
+
+
+class TestIdempotentService(TestCase):
+    """
+    Tests for CommissaireService with idempotency enabled.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {'idempotency': 'memory'}
+            self.service_instance = CommissaireService(
+                'commissaire',
+                'redis://127.0.0.1:6379/',
+                [{'name': 'simple', 'routing_key': 'simple.*'}]
+            )
+        self.service_instance._replies = mock.MagicMock()
+        self.service_instance.on_reboot = mock.MagicMock(return_value='done')
+
+    def _deliver(self, id):
+        """
+        Delivers a reboot request and returns the reply.
+        """
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'simple.reboot'})
+        self.service_instance.on_message(
+            {'jsonrpc': '2.0', 'id': id, 'method': 'reboot'}, message)
+        return json.loads(
+            self.service_instance._replies.publish.call_args[0][0])
+
+    def test_duplicates_are_not_run(self):
+        """
+        Verify a redelivered request gets the cached reply.
+        """
+        first = self._deliver('abc')
+        second = self._deliver('abc')
+        self.assertEquals(first, second)
+        self.assertEquals(
+            {'jsonrpc': '2.0', 'id': 'abc', 'result': 'done'}, second)
+        self.assertEquals(1, self.service_instance.on_reboot.call_count)
+        self._deliver('def')
+        self.assertEquals(2, self.service_instance.on_reboot.call_count)
+
+    def test_errors_are_not_cached(self):
+        """
+        Verify failed requests run again when redelivered.
+        """
+        self.service_instance.on_reboot.side_effect = [Exception, 'done']
+        self.assertIn('error', self._deliver('abc'))
+        self.assertEquals('done', self._deliver('abc')['result'])
+
+    def test_running_duplicates_are_turned_away(self):
+        """
+        Verify a request delivered again while it still runs is not run
+        twice.
+        """
+        replies = []
+
+        def on_reboot(message):
+            replies.append(self._deliver('abc'))
+            return 'done'
+
+        self.service_instance.on_reboot = on_reboot
+        self.assertEquals('done', self._deliver('abc')['result'])
+        self.assertEquals(1, len(replies))
+        self.assertEquals(
+            JSONRPC_SERVICE_BUSY, replies[0]['error']['code'])
+        self.assertEquals('done', self._deliver('abc')['result'])
@@ -0,0 +1,307 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.isolation.
+"""
+
+import json
+import threading
+import time
+import uuid
+
+from . import TestCase, mock
+from commissaire import constants as C
+from commissaire_service.service import CommissaireService
+from commissaire_service.service.isolation import (
+    IsolationPool, build_isolation_pools, isolated_routing_key,
+    isolation_routing_keys)
+
+
+class TestIsolationPool(TestCase):
+    """
+    Tests for the IsolationPool class.
+    """
+
+    def test_submit(self):
+        """
+        Verify calls run on the threads of the pool and are counted until
+        they finish.
+        """
+        pool = IsolationPool('list', 1, backlog=1)
+        self.addCleanup(pool.shutdown)
+        release = threading.Event()
+        ran = []
+        pool.submit(release.wait)
+        pool.submit(ran.append, 'queued')
+        self.assertEquals(2, pool.pending)
+        self.assertEquals([], ran)
+        release.set()
+        pool.shutdown(wait=True)
+        self.assertEquals(['queued'], ran)
+        self.assertEquals(0, pool.pending)
+
+    def test_invalid(self):
+        """
+        Verify impossible budgets are rejected.
+        """
+        self.assertRaises(ValueError, IsolationPool, 'list', 0)
+        self.assertRaises(ValueError, IsolationPool, 'list', 1, -1)
+
+    def test_build(self):
+        """
+        Verify pools are keyed by method from routing keys or names.
+        """
+        pools = build_isolation_pools({
+            'storage.list': 2, 'get': {'slots': 16, 'backlog': 0}})
+        self.addCleanup(lambda: [p.shutdown() for p in pools.values()])
+        self.assertEquals(['get', 'list'], sorted(pools))
+        self.assertEquals(4, pools['list'].capacity)
+        self.assertEquals(16, pools['get'].capacity)
+        self.assertEquals({}, build_isolation_pools(None))
+
+
+class TestIsolationRoutingKeys(TestCase):
+    """
+    Tests for the routing keys of isolation queues.
+    """
+
+    def test_isolated_routing_key(self):
+        """
+        Verify requests of every lane map to one isolation queue.
+        """
+        lanes = ('urgent', 'default')
+        for routing_key in ('storage.list', 'storage.urgent.list',
+                            'isolated.storage.list'):
+            self.assertEquals(
+                'isolated.storage.list',
+                isolated_routing_key(routing_key, lanes))
+
+    def test_isolation_routing_keys(self):
+        """
+        Verify an isolation queue is declared for every binding routing
+        the method.
+        """
+        self.assertEquals(
+            ['isolated.jobs.investigate'],
+            isolation_routing_keys([
+                {'routing_key': 'jobs.investigate'},
+                {'routing_key': 'jobs.other'}], 'investigate'))
+        self.assertEquals(
+            ['isolated.storage.list'],
+            isolation_routing_keys([
+                {'name': 'storage', 'routing_key': 'storage.*'}], 'list'))
+        self.assertEquals([], isolation_routing_keys([{}], 'list'))
+
+
+class TestIsolatedService(TestCase):
+    """
+    Tests for CommissaireService with isolation pools.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {
+                'isolation_pools': {'simple.list': {'slots': 1, 'backlog': 0}}}
+            self.service_instance = CommissaireService(
+                'commissaire',
+                'redis://127.0.0.1:6379/',
+                [{'name': 'simple', 'routing_key': 'simple.*'}]
+            )
+        self.pool = self.service_instance._isolation_pools['list']
+        self.addCleanup(self.pool.shutdown)
+        self.service_instance._replies = mock.MagicMock()
+
+    def _deliver(self, method, routing_key=None):
+        """
+        Delivers a request and returns the message.
+        """
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue', 'correlation_id': 'c'},
+            headers={'compression': 'application/x-gzip'},
+            delivery_info={'routing_key': routing_key or 'simple.' + method})
+        self.service_instance.on_message(
+            {'jsonrpc': '2.0', 'id': method, 'method': method}, message)
+        return message
+
+    def test_isolated_methods_have_their_own_consumer(self):
+        """
+        Verify the queue of a pooled method is consumed on its own channel
+        with the capacity of the pool as prefetch count.
+        """
+        Consumer = mock.MagicMock()
+        channel = mock.MagicMock()
+        with mock.patch('commissaire_service.service.Consumer') as own:
+            self.service_instance.get_consumers(Consumer, channel)
+        self.assertNotIn('prefetch_count', Consumer.call_args[1])
+        own_channel = channel.connection.client.channel.return_value
+        self.assertIs(own_channel, own.call_args[0][0])
+        self.assertEquals(
+            ['isolated.simple.list'], [q.name for q in own.call_args[0][1]])
+        self.assertEquals(1, own.call_args[1]['prefetch_count'])
+        self.assertEquals(
+            [self.service_instance.on_message], own.call_args[1]['callbacks'])
+
+        self.service_instance.on_consume_end(None, channel)
+        own_channel.close.assert_called_once_with()
+
+    def test_unroutable_pool(self):
+        """
+        Verify a pool for a method none of the queues route is refused.
+        """
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {'isolation_pools': {'list': 1}}
+            self.assertRaises(
+                ValueError, CommissaireService, 'commissaire',
+                'redis://127.0.0.1:6379/', [{'routing_key': 'simple.get'}])
+
+    def test_batches_can_not_call_pooled_methods(self):
+        """
+        Verify batch elements do not run pooled methods off their pool.
+        """
+        calls = []
+        self.service_instance.on_list = lambda message: calls.append(1)
+        self.service_instance.on_get = lambda message: 'got'
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'simple.batch'})
+        self.service_instance.on_message([
+            {'jsonrpc': '2.0', 'id': '1', 'method': 'list'},
+            {'jsonrpc': '2.0', 'id': '2', 'method': 'get'}], message)
+        message.ack.assert_called_once_with()
+        refused, got = json.loads(
+            self.service_instance._replies.publish.call_args[0][0])
+        self.assertEquals(
+            C.JSONRPC_ERRORS['INVALID_REQUEST'], refused['error']['code'])
+        self.assertEquals([], calls)
+        self.assertEquals('got', got['result'])
+
+    def test_isolated_messages_are_moved_to_their_queue(self):
+        """
+        Verify pooled methods are moved off the shared queue and run on
+        their pool once they arrive from their own queue.
+        """
+        release = threading.Event()
+        self.service_instance.on_list = lambda message: release.wait(5)
+        self.service_instance.on_get = lambda message: 'got'
+        producer = self.service_instance.producer
+
+        moved = self._deliver('list')
+        moved.ack.assert_called_once_with()
+        producer.publish.assert_called_once_with(
+            moved.body, routing_key='isolated.simple.list',
+            content_type=moved.content_type,
+            content_encoding=moved.content_encoding, headers={},
+            reply_to='test_queue', correlation_id='c')
+        self.assertEquals(0, self.pool.pending)
+        self.assertEquals({}, self.service_instance._in_flight)
+
+        first = self._deliver('list', 'isolated.simple.list')
+        self.assertEquals(1, producer.publish.call_count)
+        self.assertEquals(1, self.pool.pending)
+
+        # Other methods still run inline
+        get = self._deliver('get')
+        get.ack.assert_called_once_with()
+        self.assertEquals('got', json.loads(
+            self.service_instance._replies.publish.call_args[0][0])['result'])
+
+        release.set()
+        for _ in range(500):
+            if self.service_instance._completed:
+                break
+            time.sleep(0.01)
+        self.service_instance.on_iteration()
+        first.ack.assert_called_once_with()
+
+
+class SlowService(CommissaireService):
+    """
+    Service with a slow and a fast method answering over the memory
+    transport.
+    """
+
+    def on_slow(self, message, n):
+        time.sleep(0.2)
+        return n
+
+    def on_fast(self, message):
+        return 'fast'
+
+
+class TestIsolatedServiceOverTheBus(TestCase):
+    """
+    Tests for isolation pools over the memory transport, end to end.
+    """
+
+    def _service(self, service_class, qkwargs, **config):
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = dict(
+                config, transport_options={'polling_interval': 0.01})
+            return service_class('commissaire', 'memory://', qkwargs)
+
+    def test_backlog_does_not_hold_up_other_methods(self):
+        """
+        Verify a backlog of a pooled method waits on its own queue, is
+        delivered once and does not delay other methods.
+        """
+        # The memory transport is shared by the whole process
+        prefix = 'slow{}'.format(uuid.uuid4().hex)
+        server = self._service(SlowService, [{
+            'name': prefix, 'routing_key': prefix + '.*'}],
+            isolation_pools={'slow': {'slots': 1, 'backlog': 0}})
+        deliveries = []
+        on_message = server.on_message
+
+        def record(body, message):
+            if message.delivery_info['routing_key'].startswith('isolated.'):
+                deliveries.append(server._decode(body, message)['id'])
+            on_message(body, message)
+
+        server.on_message = record
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(setattr, server, 'should_stop', True)
+
+        results = {}
+
+        def call(n):
+            client = self._service(CommissaireService, [])
+            results[n] = client.request(
+                prefix + '.slow', params={'n': n}, timeout=10)['result']
+
+        callers = [
+            threading.Thread(target=call, args=(n, )) for n in range(5)]
+        for caller in callers:
+            caller.start()
+        time.sleep(0.1)
+        client = self._service(CommissaireService, [])
+        started = time.monotonic()
+        self.assertEquals(
+            'fast', client.request(prefix + '.fast', timeout=10)['result'])
+        self.assertLess(time.monotonic() - started, 0.5)
+        for caller in callers:
+            caller.join(15)
+        self.assertEquals({n: n for n in range(5)}, results)
+        self.assertEquals(5, len(deliveries))
+        self.assertEquals(5, len(set(deliveries)))
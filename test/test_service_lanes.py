@@ -0,0 +1,183 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.lanes.
+"""
+
+from . import TestCase, mock
+from commissaire_service import service
+from commissaire_service.service import CommissaireService
+from commissaire_service.service.lanes import (
+    LANE_DEFAULT, QUEUE_ORDER_STRATEGY, LaneCycle, PendingWork, lane_of,
+    lane_queues, lane_routing_key, parse_lanes)
+
+LANES = ('interactive', LANE_DEFAULT, 'bulk')
+
+
+class TestLaneHelpers(TestCase):
+    """
+    Tests for the lane helpers.
+    """
+
+    def test_parse_lanes(self):
+        """
+        Verify lanes are validated.
+        """
+        self.assertEquals((LANE_DEFAULT, ), parse_lanes(None))
+        self.assertEquals(LANES, parse_lanes(list(LANES)))
+        for lanes in (['bulk'], ['bulk', 'bulk', LANE_DEFAULT],
+                      ['a.b', LANE_DEFAULT]):
+            self.assertRaises(ValueError, parse_lanes, lanes)
+
+    def test_lane_routing_key(self):
+        """
+        Verify the lane is inserted before the method.
+        """
+        self.assertEquals(
+            'storage.bulk.list', lane_routing_key('storage.list', 'bulk'))
+        self.assertEquals(
+            'storage.list', lane_routing_key('storage.list', None))
+        self.assertEquals(
+            'storage.list', lane_routing_key('storage.list', LANE_DEFAULT))
+
+    def test_lane_queues(self):
+        """
+        Verify every lane gets a copy of the default queues.
+        """
+        qkwargs = [
+            {'name': 'storage', 'routing_key': 'storage.*',
+             'exclusive': False}]
+        self.assertEquals([
+            {'name': 'storage', 'routing_key': 'storage.*',
+             'exclusive': False},
+            {'name': 'storage.interactive',
+             'routing_key': 'storage.interactive.*', 'exclusive': False},
+            {'name': 'storage.bulk', 'routing_key': 'storage.bulk.*',
+             'exclusive': False},
+        ], lane_queues(qkwargs, LANES))
+
+    def test_lane_of(self):
+        """
+        Verify the lane is found from the routing key.
+        """
+        self.assertEquals('bulk', lane_of('storage.bulk.list', LANES))
+        self.assertEquals(LANE_DEFAULT, lane_of('storage.list', LANES))
+        self.assertEquals(LANE_DEFAULT, lane_of('a.other.list', LANES))
+
+    def test_pending_work(self):
+        """
+        Verify items are handed out by priority then arrival.
+        """
+        pending = PendingWork()
+        for priority, item in ((1, 'a'), (2, 'b'), (0, 'c'), (1, 'd')):
+            pending.put(priority, item)
+        self.assertEquals(4, len(pending))
+        self.assertEquals(
+            ['c', 'a', 'd', 'b'], [pending.get() for _ in range(4)])
+        self.assertRaises(IndexError, pending.get)
+
+    def test_lane_cycle(self):
+        """
+        Verify queues are read most urgent lane first, without rotating.
+        """
+        for name, priority in (
+                ('cycle', 1), ('cycle.bulk', 2), ('cycle.interactive', 0)):
+            LaneCycle.rank(name, priority)
+        cycle = LaneCycle()
+        cycle.update({'cycle.bulk', 'unranked', 'cycle', 'cycle.interactive'})
+        expected = ['cycle.interactive', 'cycle', 'cycle.bulk', 'unranked']
+        self.assertEquals(expected, cycle.consume(4))
+        cycle.rotate('cycle.interactive')
+        self.assertEquals(expected[:2], cycle.consume(2))
+
+
+class TestLaneService(TestCase):
+    """
+    Tests for CommissaireService with priority lanes.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {
+                'priority_lanes': list(LANES), 'max_workers': 1}
+            self.service_instance = CommissaireService(
+                'commissaire',
+                'redis://127.0.0.1:6379/',
+                [{'name': 'simple', 'routing_key': 'simple.*'}]
+            )
+        self.service_instance._executor = mock.MagicMock()
+
+    def test_queues_and_consumers(self):
+        """
+        Verify each lane gets a queue consumed in priority order.
+        """
+        self.assertEquals(
+            ['simple', 'simple.interactive', 'simple.bulk'],
+            [q.name for q in self.service_instance._queues])
+        Consumer = mock.MagicMock()
+        self.service_instance.get_consumers(Consumer, mock.MagicMock())
+        self.assertEquals(
+            ['simple.interactive', 'simple', 'simple.bulk'],
+            [c[0][0].name for c in Consumer.call_args_list])
+
+    def test_transport_reads_lanes_in_order(self):
+        """
+        Verify the transport is told to read more urgent lanes first.
+        """
+        self.assertEquals(
+            QUEUE_ORDER_STRATEGY,
+            service.Connection.call_args[1]['transport_options'][
+                'queue_order_strategy'])
+        self.assertEquals(
+            [0, 1, 2],
+            [LaneCycle.ranks[x] for x in (
+                'simple.interactive', 'simple', 'simple.bulk')])
+
+    def test_urgent_messages_run_first(self):
+        """
+        Verify waiting messages are handled by lane priority.
+        """
+        handled = []
+        self.service_instance._handle_in_pool = (
+            lambda body, message: handled.append(body))
+        for body, key in (
+                ('bulk', 'simple.bulk.list'),
+                ('default', 'simple.list'),
+                ('interactive', 'simple.interactive.get')):
+            self.service_instance.on_message(
+                body, mock.MagicMock(delivery_info={'routing_key': key}))
+        self.assertEquals(
+            3, self.service_instance._executor.submit.call_count)
+        for _ in range(3):
+            self.service_instance._handle_next()
+        self.assertEquals(['interactive', 'default', 'bulk'], handled)
+
+    def test_request_lane(self):
+        """
+        Verify clients can pick the lane of a request.
+        """
+        with mock.patch.object(
+                self.service_instance, '_send_request') as _request:
+            _request.return_value = {'result': []}
+            self.service_instance.request(
+                'storage.list', 'list', params={}, lane='bulk')
+            _request.assert_called_once_with(
+                'storage.bulk.list', mock.ANY, None, headers=mock.ANY)
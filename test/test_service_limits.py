@@ -0,0 +1,212 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.limits.
+"""
+
+import json
+import threading
+import time
+
+from . import TestCase, mock
+from commissaire.bus import RemoteProcedureCallError
+from commissaire_service.service import CommissaireService
+from commissaire_service.service.limits import (
+    JSONRPC_SERVICE_BUSY, InFlightLimits, ServiceBusyError,
+    build_in_flight_limits, retry_after)
+
+
+class TestInFlightLimits(TestCase):
+    """
+    Tests for the InFlightLimits class.
+    """
+
+    def test_method_and_total_limits(self):
+        """
+        Verify requests over a method or service limit are turned away.
+        """
+        limits = InFlightLimits({'storage.list': 1}, total=2)
+        self.assertTrue(limits.try_acquire('list'))
+        self.assertFalse(limits.try_acquire('list'))
+        self.assertTrue(limits.try_acquire('get'))
+        self.assertFalse(limits.try_acquire('get'))
+
+        limits.release('list', 0.5)
+        self.assertTrue(limits.try_acquire('get'))
+        self.assertEquals({'list': 0, 'get': 2}, limits.in_flight)
+
+    def test_method_limits_without_total(self):
+        """
+        Verify batch elements only count against their method.
+        """
+        limits = InFlightLimits({'list': 1}, total=1)
+        self.assertTrue(limits.try_acquire('batch'))
+        self.assertTrue(limits.try_acquire('list', count_total=False))
+        self.assertFalse(limits.try_acquire('list', count_total=False))
+        limits.release('list', 0.5, count_total=False)
+        self.assertFalse(limits.try_acquire('get'))
+        self.assertEquals({'batch': 1, 'list': 0}, limits.in_flight)
+
+    def test_busy_error(self):
+        """
+        Verify the retry hint grows with the duration of the method.
+        """
+        limits = InFlightLimits({'list': 1}, retry_after=0.5)
+        self.assertEquals(
+            0.5, limits.busy_error('list').data['retry_after'])
+        limits.try_acquire('list')
+        limits.release('list', 3.0)
+        error = limits.busy_error('list')
+        self.assertEquals(JSONRPC_SERVICE_BUSY, error.code)
+        self.assertEquals(3.0, retry_after(error))
+
+    def test_build(self):
+        """
+        Verify the configuration keys and their checks.
+        """
+        self.assertFalse(build_in_flight_limits({}).enabled)
+        limits = build_in_flight_limits({
+            'in_flight_limits': {'storage.list': 2},
+            'max_in_flight': 8, 'busy_retry_after': 2})
+        self.assertEquals(({'list': 2}, 8, 2.0), (
+            limits.methods, limits.total, limits.retry_after))
+        self.assertRaises(ValueError, InFlightLimits, {'list': 0})
+        self.assertRaises(ValueError, InFlightLimits, None, 0)
+
+    def test_retry_after(self):
+        """
+        Verify only busy errors are retried.
+        """
+        self.assertIsNone(retry_after(RemoteProcedureCallError('x')))
+        self.assertEquals(1.5, retry_after(RemoteProcedureCallError('x', {
+            'code': JSONRPC_SERVICE_BUSY, 'retry_after': 1.5})))
+
+
+class TestLimitedService(TestCase):
+    """
+    Tests for CommissaireService with in flight limits.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {
+                'max_workers': 2,
+                'in_flight_limits': {'simple.list': 1},
+                'busy_retry_after': 0.25}
+            self.service_instance = CommissaireService(
+                'commissaire',
+                'redis://127.0.0.1:6379/',
+                [{'name': 'simple', 'routing_key': 'simple.*'}]
+            )
+        self.addCleanup(self.service_instance._executor.shutdown)
+        self.service_instance._replies = mock.MagicMock()
+
+    def _deliver(self, method, id):
+        """
+        Delivers a request and returns the message.
+        """
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'simple.' + method})
+        self.service_instance.on_message(
+            {'jsonrpc': '2.0', 'id': id, 'method': method}, message)
+        return message
+
+    def test_busy_requests_are_answered_right_away(self):
+        """
+        Verify a request over the limit gets a busy error and is acked.
+        """
+        release = threading.Event()
+        self.service_instance.on_list = lambda message: release.wait(5)
+
+        first = self._deliver('list', '1')
+        second = self._deliver('list', '2')
+        second.ack.assert_called_once_with()
+        self.assertFalse(first.ack.called)
+        reply = json.loads(
+            self.service_instance._replies.publish.call_args[0][0])
+        self.assertEquals('2', reply['id'])
+        self.assertEquals(JSONRPC_SERVICE_BUSY, reply['error']['code'])
+        self.assertEquals(0.25, reply['error']['data']['retry_after'])
+
+        release.set()
+        self.service_instance._executor.shutdown(wait=True)
+        self.service_instance.on_iteration()
+        first.ack.assert_called_once_with()
+        self.assertEquals({'list': 0}, self.service_instance._limits.in_flight)
+
+    def test_request_raises_busy_errors(self):
+        """
+        Verify callers can tell busy errors apart from other failures.
+        """
+        with mock.patch.object(
+                self.service_instance, '_send_request') as _request:
+            _request.return_value = {'error': {
+                'code': JSONRPC_SERVICE_BUSY, 'message': 'busy',
+                'data': {'retry_after': 1.0}}}
+            self.assertRaises(
+                ServiceBusyError, self.service_instance.request,
+                'storage.list', 'list')
+            # Busy errors wrapped by an older service
+            _request.return_value = {'error': {
+                'code': RemoteProcedureCallError.code, 'message': 'busy',
+                'data': {'code': JSONRPC_SERVICE_BUSY, 'retry_after': 1.0}}}
+            self.assertRaises(
+                ServiceBusyError, self.service_instance.request,
+                'storage.list', 'list')
+            _request.return_value = {'error': {
+                'code': RemoteProcedureCallError.code, 'message': 'nope'}}
+            with self.assertRaises(RemoteProcedureCallError) as context:
+                self.service_instance.request('storage.list', 'list')
+            self.assertNotIsInstance(context.exception, ServiceBusyError)
+
+    def test_batch_elements_count_against_their_method(self):
+        """
+        Verify batch elements over their method's limit get busy errors.
+        """
+        release = threading.Event()
+        self.service_instance.on_list = lambda message: release.wait(5)
+        self.service_instance.on_get = lambda message: 'got'
+
+        first = self._deliver('list', '1')
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'simple.batch'})
+        self.service_instance.on_message([
+            {'jsonrpc': '2.0', 'id': '2', 'method': 'list'},
+            {'jsonrpc': '2.0', 'id': '3', 'method': 'get'}], message)
+        for _ in range(500):
+            if self.service_instance._completed:
+                break
+            time.sleep(0.01)
+        self.service_instance.on_iteration()
+        message.ack.assert_called_once_with()
+        busy, got = json.loads(
+            self.service_instance._replies.publish.call_args[0][0])
+        self.assertEquals(JSONRPC_SERVICE_BUSY, busy['error']['code'])
+        self.assertEquals('got', got['result'])
+
+        release.set()
+        self.service_instance._executor.shutdown(wait=True)
+        self.service_instance.on_iteration()
+        first.ack.assert_called_once_with()
+        self.assertEquals(
+            {'list': 0, 'batch': 0}, self.service_instance._limits.in_flight)
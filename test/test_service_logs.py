@@ -0,0 +1,132 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.logs.
+"""
+
+import logging
+
+from . import TestCase, mock
+from commissaire_service.service.logs import (
+    ExceptionLogger, StructuredMessage, log_event)
+
+
+class Unprintable:
+    """
+    Fails the test if it is ever formatted.
+    """
+
+    def __repr__(self):
+        raise AssertionError('Formatted while logging was disabled')
+
+
+def raise_value_error():
+    raise ValueError('boom')
+
+
+class TestLogEvent(TestCase):
+    """
+    Tests for log_event and StructuredMessage.
+    """
+
+    def test_structured_message(self):
+        """
+        Verify StructuredMessage renders the event and sorted fields.
+        """
+        self.assertEquals(
+            "message.received body={'a': 1} delivery_tag=3",
+            str(StructuredMessage(
+                'message.received', {'delivery_tag': 3, 'body': {'a': 1}})))
+
+    def test_log_event_disabled(self):
+        """
+        Verify log_event neither formats nor logs when the level is off.
+        """
+        logger = mock.MagicMock(logging.Logger)
+        logger.isEnabledFor.return_value = False
+        log_event(logger, logging.DEBUG, 'test', value=Unprintable())
+        logger.log.assert_not_called()
+
+    def test_log_event_enabled(self):
+        """
+        Verify log_event passes an unformatted StructuredMessage.
+        """
+        logger = mock.MagicMock(logging.Logger)
+        logger.isEnabledFor.return_value = True
+        log_event(logger, logging.DEBUG, 'test', value=1)
+        level, msg = logger.log.call_args[0]
+        self.assertEquals(logging.DEBUG, level)
+        self.assertIsInstance(msg, StructuredMessage)
+        self.assertEquals({'value': 1}, msg.fields)
+
+
+class TestExceptionLogger(TestCase):
+    """
+    Tests for the ExceptionLogger class.
+    """
+
+    def setUp(self):
+        self.logger = mock.MagicMock(logging.Logger)
+        self.logger.isEnabledFor.return_value = True
+        self.exception_logger = ExceptionLogger(self.logger, interval=60)
+
+    def _raise(self):
+        try:
+            raise_value_error()
+        except ValueError as error:
+            return error
+
+    def test_log(self):
+        """
+        Verify the first exception is logged with its traceback.
+        """
+        error = self._raise()
+        self.assertTrue(self.exception_logger.log(error, 'test', id=1))
+        _, kwargs = self.logger.log.call_args
+        self.assertIs(error, kwargs['exc_info'][1])
+
+    def test_log_aggregates_repeats(self):
+        """
+        Verify repeats are suppressed and counted until the interval ends.
+        """
+        with mock.patch('time.monotonic') as _monotonic:
+            _monotonic.return_value = 100.0
+            self.assertTrue(self.exception_logger.log(self._raise()))
+            for _ in range(3):
+                self.assertFalse(self.exception_logger.log(self._raise()))
+            self.assertEquals(1, self.logger.log.call_count)
+
+            _monotonic.return_value = 200.0
+            self.assertTrue(self.exception_logger.log(self._raise()))
+            msg = self.logger.log.call_args[0][1]
+            self.assertEquals(3, msg.fields['suppressed'])
+
+    def test_log_different_failures(self):
+        """
+        Verify failures raised from different places are logged separately.
+        """
+        self.assertTrue(self.exception_logger.log(self._raise()))
+        try:
+            raise ValueError('elsewhere')
+        except ValueError as error:
+            self.assertTrue(self.exception_logger.log(error))
+
+    def test_log_disabled(self):
+        """
+        Verify nothing is done when the level is disabled.
+        """
+        self.logger.isEnabledFor.return_value = False
+        self.assertFalse(self.exception_logger.log(self._raise()))
+        self.logger.log.assert_not_called()
@@ -0,0 +1,164 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.metrics.
+"""
+
+import json
+
+from urllib.request import urlopen
+
+from . import TestCase, mock
+from commissaire_service.service import CommissaireService
+from commissaire_service.service.metrics import (
+    CONTENT_TYPE_PROMETHEUS, Counter, Gauge, Histogram, MetricsRegistry,
+    MetricsServer, ServiceMetrics)
+
+
+class TestMetrics(TestCase):
+    """
+    Tests for the metric classes and MetricsRegistry.
+    """
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        """
+        Verify counters render per label set.
+        """
+        counter = self.registry.register(
+            Counter('test_total', 'Test counter.', ('method', )))
+        counter.inc(('get', ))
+        counter.inc(('get', ))
+        counter.inc(('say "hi"', ), 3)
+        self.assertEquals(
+            '# HELP test_total Test counter.\n'
+            '# TYPE test_total counter\n'
+            'test_total{method="get"} 2\n'
+            'test_total{method="say \\"hi\\""} 3\n',
+            self.registry.render())
+
+    def test_gauge(self):
+        """
+        Verify gauges go up and down.
+        """
+        gauge = self.registry.register(Gauge('test', 'Test gauge.'))
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEquals(
+            [{'labels': {}, 'value': 1}],
+            self.registry.snapshot()['test']['values'])
+        gauge.set(5)
+        self.assertIn('test 5\n', self.registry.render())
+
+    def test_histogram(self):
+        """
+        Verify histograms render cumulative buckets, sum and count.
+        """
+        histogram = self.registry.register(
+            Histogram('test_seconds', 'Test.', buckets=(0.1, 1.0)))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        text = self.registry.render()
+        for line in (
+                'test_seconds_bucket{le="0.1"} 1',
+                'test_seconds_bucket{le="1.0"} 2',
+                'test_seconds_bucket{le="+Inf"} 3',
+                'test_seconds_sum 5.55',
+                'test_seconds_count 3'):
+            self.assertIn(line + '\n', text)
+        value = self.registry.snapshot()['test_seconds']['values'][0]['value']
+        self.assertEquals(3, value['count'])
+        self.assertEquals(
+            {'0.1': 1, '1.0': 2, '+Inf': 3}, value['buckets'])
+
+    def test_register_duplicate(self):
+        """
+        Verify a metric name can only be registered once.
+        """
+        self.registry.register(Counter('test', 'Test.'))
+        self.assertRaises(
+            ValueError, self.registry.register, Counter('test', 'Test.'))
+
+    def test_service_metrics_snapshot_is_json(self):
+        """
+        Verify ServiceMetrics snapshots can be sent on the bus.
+        """
+        metrics = ServiceMetrics()
+        metrics.requests.inc(('get', ))
+        metrics.latency.observe(0.2, ('get', ))
+        metrics.ack_latency.observe(0.3)
+        self.assertEquals(
+            metrics.snapshot(), json.loads(json.dumps(metrics.snapshot())))
+
+
+class TestMetricsServer(TestCase):
+    """
+    Tests for the MetricsServer class.
+    """
+
+    def test_serves_metrics(self):
+        """
+        Verify the registry is served in the Prometheus text format.
+        """
+        metrics = ServiceMetrics()
+        metrics.requests.inc(('get', ))
+        server = MetricsServer(metrics, 0)
+        server.start()
+        self.addCleanup(server.stop)
+        response = urlopen(
+            'http://127.0.0.1:{}/metrics'.format(server.port), timeout=5)
+        self.assertEquals(
+            CONTENT_TYPE_PROMETHEUS, response.headers['Content-Type'])
+        self.assertIn(
+            'commissaire_requests_total{method="get"} 1',
+            response.read().decode('utf-8'))
+
+
+class TestServiceMetricsEndpoint(TestCase):
+    """
+    Tests for the metrics endpoint of a CommissaireService.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {'metrics_port': 9100}
+            self.service_instance = CommissaireService(
+                'commissaire',
+                'redis://127.0.0.1:6379/',
+                [{'name': 'simple', 'routing_key': 'simple.*'}]
+            )
+
+    def test_port_per_worker(self):
+        """
+        Verify ServiceManager workers do not share the metrics port.
+        """
+        with mock.patch.object(
+                self.service_instance, '_start_metrics_server') as start:
+            self.service_instance._serve_metrics()
+            start.assert_called_once_with(9100, '127.0.0.1')
+            start.reset_mock()
+            self.service_instance._worker_index = 2
+            self.service_instance._serve_metrics()
+            start.assert_called_once_with(9102, '127.0.0.1')
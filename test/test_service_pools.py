@@ -0,0 +1,143 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.pools.
+"""
+
+import threading
+
+from . import TestCase, mock
+from commissaire_service.service import CommissaireService
+from commissaire_service.service.pools import BusPool
+
+
+class BrokenConnection(Exception):
+    pass
+
+
+class TestBusPool(TestCase):
+    """
+    Tests for the BusPool class.
+    """
+
+    def setUp(self):
+        patcher = mock.patch('commissaire_service.service.pools.Producer')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection = mock.MagicMock(
+            connection_errors=(BrokenConnection, ), channel_errors=())
+        self.connection.clone.side_effect = lambda: mock.MagicMock(
+            connection_errors=(BrokenConnection, ), channel_errors=())
+        self.pool = BusPool(self.connection, mock.MagicMock(), 2)
+
+    def test_connections_are_reused(self):
+        """
+        Verify connections are opened once and lent again.
+        """
+        with self.pool.acquire() as first:
+            with self.pool.acquire() as second:
+                self.assertIsNot(first, second)
+        self.assertEquals(2, self.pool.idle)
+        with self.pool.acquire() as bus:
+            self.assertIs(first, bus)
+        self.assertEquals(2, self.connection.clone.call_count)
+
+    def test_limit(self):
+        """
+        Verify threads wait once every connection is lent.
+        """
+        acquired = []
+
+        def borrow():
+            with self.pool.acquire() as bus:
+                acquired.append(bus)
+
+        with self.pool.acquire(), self.pool.acquire():
+            thread = threading.Thread(target=borrow)
+            thread.start()
+            thread.join(0.1)
+            self.assertEquals([], acquired)
+        thread.join(1)
+        self.assertEquals(1, len(acquired))
+        self.assertRaises(ValueError, BusPool, self.connection, None, 0)
+
+    def test_broken_connections_are_dropped(self):
+        """
+        Verify a connection failing with a connection error is closed.
+        """
+        with self.pool.acquire() as bus:
+            pass
+        self.assertRaises(BrokenConnection, self._fail_with, BrokenConnection)
+        bus.connection.release.assert_called_once_with()
+        self.assertEquals(0, self.pool.idle)
+
+        self.assertRaises(ValueError, self._fail_with, ValueError)
+        self.assertEquals(1, self.pool.idle)
+
+    def _fail_with(self, error):
+        with self.pool.acquire():
+            raise error()
+
+
+class TestPooledRequests(TestCase):
+    """
+    Tests for requests of CommissaireService on pooled connections.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        with mock.patch(
+                'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {'max_workers': 3, 'batch_workers': 2}
+            self.service_instance = CommissaireService(
+                'commissaire',
+                'redis://127.0.0.1:6379/',
+                [{'name': 'simple', 'routing_key': 'simple.*'}]
+            )
+        self.addCleanup(self.service_instance._executor.shutdown)
+        self.addCleanup(self.service_instance._batch_executor.shutdown)
+
+    def test_pool_size(self):
+        """
+        Verify every handler thread can have a connection by default.
+        """
+        self.assertEquals(6, self.service_instance._bus_pool.limit)
+
+    def test_request_uses_a_lent_connection(self):
+        """
+        Verify requests and notifications send on a pooled connection.
+        """
+        main = self.service_instance.connection
+        self.service_instance._bus_pool = mock.MagicMock()
+        bus = self.service_instance._bus_pool.acquire().__enter__()
+        queue = bus.connection.SimpleQueue.return_value
+        queue.get.return_value.payload = {'result': 'ok'}
+        seen = []
+
+        with mock.patch('commissaire.bus.BusMixin.notify') as _notify:
+            _notify.side_effect = lambda *a, **k: seen.append(
+                self.service_instance.producer)
+            self.assertEquals(
+                {'result': 'ok'},
+                self.service_instance.request('storage.get', 'get'))
+            self.service_instance.notify('storage.notify', {})
+        self.assertEquals('storage.get', bus.producer.publish.call_args[0][1])
+        self.assertEquals([bus.producer], seen)
+        self.assertFalse(main.SimpleQueue.called)
+        self.assertIs(main, self.service_instance.connection)
@@ -0,0 +1,87 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.replies.ReplyPublisher class.
+"""
+
+from kombu import Connection
+
+from . import TestCase
+from commissaire_service.service.replies import (
+    REPLY_ROUTE_DEFAULT, REPLY_ROUTE_DIRECT, ReplyPublisher)
+
+
+class TestReplyPublisher(TestCase):
+    """
+    Tests for the ReplyPublisher class.
+    """
+
+    def setUp(self):
+        """
+        Set up an in memory connection and a requester owned reply queue.
+        """
+        self.connection = Connection('memory://')
+        self.addCleanup(self.connection.release)
+        self.reply_queue = self.connection.SimpleQueue(
+            'response-1', queue_opts={'auto_delete': True, 'durable': False})
+        self.addCleanup(self.reply_queue.close)
+
+    def test_initialization_with_unknown_route(self):
+        """
+        Verify ReplyPublisher rejects unknown routes.
+        """
+        self.assertRaises(
+            ValueError, ReplyPublisher,
+            self.connection.default_channel, route='nope')
+
+    def test_publish_on_default_exchange(self):
+        """
+        Verify ReplyPublisher.publish reaches the reply queue by name.
+        """
+        publisher = ReplyPublisher(
+            self.connection.default_channel, route=REPLY_ROUTE_DEFAULT)
+        publisher.publish('{"id": 1}', 'response-1')
+        message = self.reply_queue.get(timeout=1)
+        self.assertEquals('{"id": 1}', message.payload)
+        # Nothing is cached for the default exchange
+        self.assertEquals(0, len(publisher._destinations))
+
+    def test_publish_on_direct_route(self):
+        """
+        Verify ReplyPublisher.publish reaches the reply queue by its exchange.
+        """
+        publisher = ReplyPublisher(
+            self.connection.default_channel, route=REPLY_ROUTE_DIRECT)
+        publisher.publish({'id': 1}, 'response-1')
+        publisher.publish({'id': 2}, 'response-1')
+        self.assertEquals({'id': 1}, self.reply_queue.get(timeout=1).payload)
+        self.assertEquals({'id': 2}, self.reply_queue.get(timeout=1).payload)
+        # The destination is only cached once
+        self.assertEquals(['response-1'], list(publisher._destinations))
+
+    def test_destination_cache_eviction(self):
+        """
+        Verify ReplyPublisher evicts the least recently used destinations.
+        """
+        publisher = ReplyPublisher(
+            self.connection.default_channel,
+            route=REPLY_ROUTE_DIRECT, cache_size=2)
+        for name in ('a', 'b', 'a', 'c'):
+            publisher._destination(name)
+        self.assertEquals(['a', 'c'], list(publisher._destinations))
+        publisher.forget('a')
+        self.assertEquals(['c'], list(publisher._destinations))
+        publisher.forget()
+        self.assertEquals(0, len(publisher._destinations))
@@ -0,0 +1,72 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Test for commissaire_service.service.run_scaled_service function.
+"""
+
+import argparse
+
+from . import TestCase, mock
+from commissaire_service.service import (
+    add_scaling_arguments, add_service_arguments, run_scaled_service)
+
+
+class Test_run_scaled_service(TestCase):
+    """
+    Test for the run_scaled_service helper function.
+    """
+
+    def _args(self, *argv):
+        """
+        Parses service and scaling arguments.
+        """
+        parser = argparse.ArgumentParser()
+        add_service_arguments(parser)
+        add_scaling_arguments(parser)
+        return parser.parse_args(args=list(argv))
+
+    def test_single_process(self):
+        """
+        Verify one process runs the service directly.
+        """
+        service_class = mock.MagicMock()
+        with mock.patch(
+                'commissaire_service.service.ServiceManager') as _manager:
+            run_scaled_service(service_class, self._args())
+            self.assertEquals(0, _manager.call_count)
+        service_class.return_value.run.assert_called_once_with()
+
+    def test_autoscaled(self):
+        """
+        Verify --max-processes runs an autoscaled ServiceManager over the
+        queues of the service and its lanes.
+        """
+        service_class = mock.MagicMock(_queue_kwargs=[{'name': 'simple'}])
+        with mock.patch(
+                'commissaire_service.service.ServiceManager') as _manager, \
+                mock.patch(
+                    'commissaire_service.service.read_config_file') as rcf:
+            rcf.return_value = {'priority_lanes': ['urgent', 'default']}
+            run_scaled_service(service_class, self._args(
+                '--processes', '2', '--max-processes', '8'))
+            _manager.assert_called_once_with(
+                service_class, 2, 'commissaire', None, [{'name': 'simple'}],
+                autoscaler=mock.ANY, lanes=['urgent', 'default'],
+                config_file=None)
+            autoscaler = _manager.call_args[1]['autoscaler']
+            self.assertEquals(
+                (2, 8), (autoscaler.min_workers, autoscaler.max_workers))
+            _manager.return_value.run.assert_called_once_with()
+        self.assertEquals(0, service_class.call_count)
@@ -37,3 +37,7 @@ class Test_run_service(TestCase):
         service.assert_called_once_with(**kwargs)
         # An the instances run method should have been called
         service.__call__().run.assert_called_once_with()
+        self.assertIsNone(service.__call__()._worker_index)
+
+        run_service(service, kwargs, worker_index=3)
+        self.assertEquals(3, service.__call__()._worker_index)
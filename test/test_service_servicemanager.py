@@ -18,11 +18,13 @@ Tests for commissaire_service.service.ServiceManager class.
 
 import logging
 import os
+import signal
 
 import kombu
 
 from . import TestCase, mock
 from commissaire_service.service import ServiceManager, run_service
+from commissaire_service.service.autoscale import Autoscaler
 
 
 class TestServiceManager(TestCase):
@@ -40,20 +42,20 @@ class TestServiceManager(TestCase):
             'commissaire_service.service.Exchange')
         self._producer_patcher = mock.patch(
             'commissaire_service.service.Producer')
-        self._mppool_patcher = mock.patch(
-            'multiprocessing.Pool')
+        self._process_patcher = mock.patch('multiprocessing.Process')
 
         self._connection = self._connection_patcher.start()
         self._exchange = self._exchange_patcher.start()
         self._producer = self._producer_patcher.start()
-        self._mppool = self._mppool_patcher.start()
+        self._process = self._process_patcher.start()
+        self._process.return_value.exitcode = 1
 
         self.queue_kwargs = [
             {'name': 'simple', 'routing_key': 'simple.*'},
         ]
 
         self.manager_instance = ServiceManager(
-            mock.MagicMock(),
+            mock.MagicMock(__name__='SimpleService'),
             1,
             'commissaire',
             'redis://127.0.0.1:6379/',
@@ -64,42 +66,231 @@ class TestServiceManager(TestCase):
         """
         Stop all patchers.
         """
-        self._connection.stop()
-        self._exchange.stop()
-        self._producer.stop()
-        self._mppool.stop()
+        self._connection_patcher.stop()
+        self._exchange_patcher.stop()
+        self._producer_patcher.stop()
+        self._process_patcher.stop()
 
     def test_initialization(self):
         """
-        Verify CommissaireService initializes as expected.
+        Verify ServiceManager initializes as expected.
         """
-        # We should have a pool
-        self._mppool.assert_called_once_with(
-            1, maxtasksperchild=1)
+        # One idle worker per process and nothing started yet
+        self.assertEquals(1, len(self.manager_instance._workers))
+        self.assertIsNone(self.manager_instance._workers[0].process)
+        self.assertEquals(0, self._process.call_count)
 
     def test__start_process(self):
         """
-        Verify CommissaireService._start_process creates a single subprocess.
+        Verify ServiceManager._start_process creates a single subprocess.
         """
-        self.manager_instance._start_process()
+        worker = self.manager_instance._workers[0]
+        self.manager_instance._start_process(worker)
 
-        self.manager_instance._pool.apply_async.assert_called_once_with(
-            run_service,
-            args=[self.manager_instance.service_class],
-            kwds={'kwargs': {
+        self._process.assert_called_once_with(
+            target=run_service,
+            args=(self.manager_instance.service_class, {
                 'exchange_name': self.manager_instance.exchange_name,
                 'connection_url': self.manager_instance.connection_url,
                 'qkwargs': self.manager_instance.qkwargs,
-            }})
+            }),
+            kwargs={'worker_index': 0},
+            name='SimpleService-0')
+        self._process.return_value.start.assert_called_once_with()
+        self.assertIs(self._process.return_value, worker.process)
+        self.assertEquals(0, worker.restarts)
 
     def test_run(self):
         """
         Verify ServiceManager.run starts up all processes.
         """
         self.manager_instance._start_process = mock.MagicMock()
-        with mock.patch('commissaire_service.service.sleep') as _sleep:
-            _sleep.side_effect = Exception
-            # We should get through one iteration before raising
-            self.assertRaises(Exception, self.manager_instance.run)
-            # We should have one process started
-            self.manager_instance._start_process.assert_called_once_with()
+        self.manager_instance._supervise = mock.MagicMock(
+            side_effect=Exception)
+        # We should get through one iteration before raising
+        self.assertRaises(Exception, self.manager_instance.run)
+        # We should have one process started
+        self.manager_instance._start_process.assert_called_once_with(
+            self.manager_instance._workers[0])
+
+    def test_supervise_restarts_immediately(self):
+        """
+        Verify an exited process is replaced without waiting.
+        """
+        worker = self.manager_instance._workers[0]
+        self.manager_instance._start_process(worker)
+        worker.started_at -= 3600
+        with mock.patch('multiprocessing.connection.wait') as _wait:
+            _wait.return_value = [worker.process.sentinel]
+            self.manager_instance._supervise()
+            _wait.assert_called_once_with([worker.process.sentinel], None)
+            self.assertIsNotNone(worker.restart_at)
+            _wait.return_value = []
+            self.manager_instance._supervise()
+        self.assertEquals(2, self._process.call_count)
+        self.assertEquals(1, worker.restarts)
+        self.assertIsNone(worker.restart_at)
+
+    def test_supervise_backs_off_crash_loops(self):
+        """
+        Verify processes which keep exiting early are restarted slower.
+        """
+        worker = self.manager_instance._workers[0]
+        self.manager_instance._start_process(worker)
+        delays = []
+        with mock.patch('commissaire_service.service.monotonic') as _now:
+            _now.return_value = worker.started_at
+            for _ in range(4):
+                self.manager_instance._reap(worker)
+                delays.append(worker.restart_at - worker.started_at)
+        self.assertEquals([0.0, 0.5, 1.0, 2.0], delays)
+        with mock.patch('multiprocessing.connection.wait') as _wait:
+            _wait.return_value = []
+            self.manager_instance._supervise()
+            # Waits for the backoff instead of blocking forever
+            self.assertEquals([], _wait.call_args[0][0])
+            self.assertGreater(_wait.call_args[0][1], 0)
+
+    def test_workers(self):
+        """
+        Verify ServiceManager.workers reports the worker state.
+        """
+        worker = self.manager_instance._workers[0]
+        self.manager_instance._start_process(worker)
+        self._process.return_value.pid = 1234
+        self._process.return_value.is_alive.return_value = True
+        state = self.manager_instance.workers
+        self.assertEquals(1, len(state))
+        self.assertEquals(1234, state[0]['pid'])
+        self.assertTrue(state[0]['alive'])
+        self.assertEquals(0, state[0]['restarts'])
+        self.assertGreaterEqual(state[0]['uptime'], 0)
+
+    def test_autoscaler_requires_named_queues(self):
+        """
+        Verify autoscaling is refused when no queue can be measured.
+        """
+        self.assertRaises(
+            ValueError, ServiceManager, mock.MagicMock(), 1, 'commissaire',
+            'redis://127.0.0.1:6379/', [{'routing_key': 'simple.*'}],
+            autoscaler=Autoscaler(1, 4))
+
+    def test_autoscaler_measures_every_lane(self):
+        """
+        Verify the queues of every lane count towards the backlog.
+        """
+        manager = ServiceManager(
+            mock.MagicMock(), 1, 'commissaire', 'redis://127.0.0.1:6379/',
+            [{'name': 'simple', 'routing_key': 'simple.*'}],
+            autoscaler=Autoscaler(1, 4), lanes=['urgent', 'default'])
+        self.assertEquals(
+            ['simple', 'simple.urgent'], manager._backlog.queue_names)
+
+    def test_scale(self):
+        """
+        Verify ServiceManager._scale adds and retires processes.
+        """
+        manager = ServiceManager(
+            mock.MagicMock(__name__='SimpleService'), 1, 'commissaire',
+            'redis://127.0.0.1:6379/', self.queue_kwargs,
+            autoscaler=Autoscaler(1, 4, scale_up_samples=1,
+                                  scale_down_samples=1))
+        manager._backlog = mock.MagicMock(return_value=35)
+        for worker in manager._workers:
+            manager._start_process(worker)
+
+        manager._scale()
+        self.assertEquals(4, manager.process_count)
+        self.assertEquals(
+            [0, 1, 2, 3], [worker.index for worker in manager._workers])
+        self.assertEquals(4, self._process.return_value.start.call_count)
+
+        manager._backlog.return_value = 0
+        manager._scale()
+        self.assertEquals(3, manager.process_count)
+        retired = manager._workers[-1]
+        self.assertTrue(retired.retiring)
+        self._process.return_value.terminate.assert_called_once_with()
+
+        # A retired process is not replaced once it exits
+        manager._reap(retired)
+        self.assertEquals(3, len(manager._workers))
+        self.assertNotIn(retired, manager._workers)
+
+    def test_rolling_restart(self):
+        """
+        Verify every process is drained and replaced one at a time.
+        """
+        worker = self.manager_instance._workers[0]
+        self.manager_instance._start_process(worker)
+        process = self._process.return_value
+        process.is_alive.return_value = False
+        self.manager_instance.rolling_restart()
+        process.terminate.assert_called_once_with()
+        process.join.assert_called_once_with(mock.ANY)
+        self.assertEquals(2, self._process.call_count)
+        self.assertEquals(1, worker.restarts)
+        self.assertEquals(1, worker.exitcode)
+
+    def test_stop_kills_stuck_processes(self):
+        """
+        Verify processes which do not drain in time are killed.
+        """
+        worker = self.manager_instance._workers[0]
+        self.manager_instance._start_process(worker)
+        process = self._process.return_value
+        process.pid = 1234
+        process.is_alive.return_value = True
+        self.manager_instance._stop_timeout = 0
+        with mock.patch('os.kill') as _kill:
+            self.manager_instance._stop_processes([worker])
+            _kill.assert_called_once_with(1234, signal.SIGKILL)
+        self.assertEquals(2, process.join.call_count)
+
+    def test_hung_processes_are_killed(self):
+        """
+        Verify processes without a recent heartbeat are killed once.
+        """
+        manager = ServiceManager(
+            mock.MagicMock(__name__='SimpleService'), 1, 'commissaire',
+            'redis://127.0.0.1:6379/', self.queue_kwargs, hang_timeout=10)
+        worker = manager._workers[0]
+        with mock.patch('commissaire_service.service.monotonic') as _now:
+            _now.return_value = 100.0
+            manager._start_process(worker)
+        heartbeat = self._process.call_args[1]['args'][2]
+        self.assertIs(worker.heartbeat, heartbeat)
+        self._process.return_value.pid = 1234
+
+        with mock.patch('os.kill') as _kill, mock.patch(
+                'commissaire_service.service.monotonic') as _now:
+            _now.return_value = 105.0
+            manager._kill_hung()
+            self.assertFalse(_kill.called)
+            heartbeat._value.value = 104.0
+            _now.return_value = 113.0
+            manager._kill_hung()
+            self.assertFalse(_kill.called)
+            _now.return_value = 114.0
+            manager._kill_hung()
+            manager._kill_hung()
+            _kill.assert_called_once_with(1234, signal.SIGKILL)
+        self.assertEquals(1, worker.hangs)
+        self.assertRaises(
+            ValueError, ServiceManager, mock.MagicMock(), 1, 'commissaire',
+            'redis://127.0.0.1:6379/', self.queue_kwargs, hang_timeout=0)
+
+    def test_run_until_stopped(self):
+        """
+        Verify run drains the processes once stopped.
+        """
+        self.manager_instance._supervise = mock.MagicMock(
+            side_effect=self.manager_instance.stop)
+        self.manager_instance._stop_processes = mock.MagicMock()
+        previous = signal.getsignal(signal.SIGTERM)
+        self.manager_instance.run()
+        self.manager_instance._stop_processes.assert_called_once_with(
+            self.manager_instance._workers)
+        # Signal handlers are restored
+        self.assertIs(previous, signal.getsignal(signal.SIGTERM))
+        self.assertIsNone(self.manager_instance._wakeup)
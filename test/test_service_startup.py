@@ -0,0 +1,126 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Startup time budget of the service entry points.
+
+Each entry point module is imported in a new interpreter with
+``-X importtime``. The test fails when the import loads a module which
+should only be loaded on first use or takes longer than the budget.
+COMMISSAIRE_STARTUP_BUDGET overrides the budget, in seconds.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+from . import TestCase
+
+#: Seconds an entry point may take to import
+STARTUP_BUDGET = float(os.environ.get('COMMISSAIRE_STARTUP_BUDGET', 1.0))
+
+#: Modules only the code paths using them may import
+DEFERRED_MODULES = (
+    'ansible',
+    'asyncio',
+    'http.server',
+    'pkg_resources',
+    'requests',
+    'urllib.request',
+)
+
+
+def import_times(module):
+    """
+    Imports a module in a new interpreter.
+
+    :param module: The module to import.
+    :type module: str
+    :returns: Microseconds each imported module took, children included.
+    :rtype: dict
+    :raises: AssertionError
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+        universal_newlines=True)
+    if result.returncode != 0:
+        raise AssertionError('Importing {} failed:\n{}'.format(
+            module, result.stderr))
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+@unittest.skipIf(
+    sys.version_info < (3, 7), '-X importtime needs Python 3.7 or later')
+class TestStartup(TestCase):
+    """
+    Tests for the import time of the entry points.
+    """
+
+    def assertStartsQuickly(self, module):
+        """
+        Verify a module imports within budget and defers heavy modules.
+        """
+        times = import_times(module)
+        loaded = sorted(set(DEFERRED_MODULES).intersection(times))
+        self.assertEquals(
+            [], loaded, '{} imports {}'.format(module, ', '.join(loaded)))
+        self.assertLess(
+            times[module] / 1e6, STARTUP_BUDGET,
+            '{} took {:.3f}s to import'.format(module, times[module] / 1e6))
+
+    def test_service(self):
+        """
+        Verify commissaire_service.service starts quickly.
+        """
+        self.assertStartsQuickly('commissaire_service.service')
+
+    def test_clusterexec(self):
+        """
+        Verify commissaire-clusterexec-service starts quickly.
+        """
+        self.assertStartsQuickly('commissaire_service.clusterexec')
+
+    def test_containermgr(self):
+        """
+        Verify commissaire-containermgr-service starts quickly.
+        """
+        self.assertStartsQuickly('commissaire_service.containermgr')
+
+    def test_investigator(self):
+        """
+        Verify commissaire-investigator-service starts quickly.
+        """
+        self.assertStartsQuickly('commissaire_service.investigator')
+
+    def test_storage(self):
+        """
+        Verify commissaire-storage-service starts quickly.
+        """
+        self.assertStartsQuickly('commissaire_service.storage')
+
+    def test_watcher(self):
+        """
+        Verify commissaire-watcher-service starts quickly.
+        """
+        self.assertStartsQuickly('commissaire_service.watcher')
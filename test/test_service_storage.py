@@ -21,10 +21,12 @@ from . import TestCase, mock
 import json
 
 from commissaire import models
+from commissaire.bus import StorageLookupError
 from commissaire.storage import StoreHandlerBase
 from commissaire.util.config import ConfigurationError
 from commissaire_service.storage import StorageService
 from commissaire_service.storage.custodia import CustodiaStoreHandler
+from commissaire_service.storage.memory import MemoryStoreHandler
 
 
 SECRET_MODEL_TYPES = (
@@ -598,3 +600,27 @@ class TestStorageService(TestCase):
         self.assertIsInstance(list_of_models, list)
         self.assertEquals(len(list_of_models), 1)
         self.assertEquals(list_of_models[0], host.to_dict())
+
+
+class TestMemoryStoreHandler(TestCase):
+    """
+    Tests for the MemoryStoreHandler class.
+    """
+
+    def test_round_trip(self):
+        """
+        Verify models can be saved, listed, retrieved and deleted.
+        """
+        handler = MemoryStoreHandler({})
+        host = models.Host.new(address='127.0.0.1')
+        handler._save(host)
+
+        found = handler._get(models.Host.new(address='127.0.0.1'))
+        self.assertEquals(host.to_dict(), found.to_dict())
+        hosts = handler._list(models.Hosts.new())
+        self.assertEquals(
+            [host.to_dict()], [h.to_dict() for h in hosts.hosts])
+
+        handler._delete(host)
+        self.assertRaises(StorageLookupError, handler._get, host)
+        self.assertRaises(StorageLookupError, handler._delete, host)
@@ -0,0 +1,188 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.service.tracing.
+"""
+
+import json
+import os
+import tempfile
+
+from . import TestCase, mock
+from commissaire_service.service import CommissaireService
+from commissaire_service.service.tracing import (
+    KIND_CLIENT, KIND_SERVER, SAMPLED_HEADER, SPAN_HEADER, TRACE_HEADER,
+    FileSpanExporter, SpanContext, Tracer, build_tracer, child_span,
+    read_trace, trace_headers)
+
+
+class TestTracer(TestCase):
+    """
+    Tests for the Tracer class and header helpers.
+    """
+
+    def setUp(self):
+        self.exporter = mock.MagicMock()
+        self.tracer = Tracer('test', self.exporter)
+
+    def test_headers_round_trip(self):
+        """
+        Verify a span survives being sent in headers.
+        """
+        span = self.tracer.start_span('get')
+        message = mock.MagicMock(headers=trace_headers(span, {'a': 1}))
+        self.assertEquals(1, message.headers['a'])
+        self.assertEquals(span.context, read_trace(message))
+        self.assertIsNone(read_trace(mock.MagicMock(headers={'a': 1})))
+        self.assertIsNone(read_trace(mock.MagicMock(headers=None)))
+
+    def test_nested_spans(self):
+        """
+        Verify spans are children of the current span and exported.
+        """
+        parent = SpanContext('a' * 32, 'b' * 16, True)
+        with self.tracer.scope(parent):
+            with self.tracer.span('investigate', KIND_SERVER) as server:
+                with child_span('ansible.gather_facts', hosts='10.0.0.1'):
+                    pass
+        self.assertIsNone(self.tracer.current)
+
+        facts, investigate = [
+            c[0][0] for c in self.exporter.export.call_args_list]
+        self.assertEquals('a' * 32, investigate.trace_id)
+        self.assertEquals('b' * 16, investigate.parent_id)
+        self.assertEquals(server.span_id, facts.parent_id)
+        self.assertEquals({'hosts': '10.0.0.1'}, facts.tags)
+        self.assertEquals({
+            'traceId': 'a' * 32,
+            'id': server.span_id,
+            'parentId': 'b' * 16,
+            'name': 'investigate',
+            'kind': KIND_SERVER,
+            'timestamp': int(server.timestamp * 1e6),
+            'duration': max(1, int(server.duration * 1e6)),
+            'localEndpoint': {'serviceName': 'test'},
+        }, server.to_zipkin())
+
+    def test_errors_and_sampling(self):
+        """
+        Verify failures are tagged and unsampled spans are not exported.
+        """
+        def fail():
+            with self.tracer.span('get'):
+                raise ValueError('nope')
+
+        self.assertRaises(ValueError, fail)
+        self.assertEquals(
+            'ValueError: nope',
+            self.exporter.export.call_args[0][0].tags['error'])
+
+        self.exporter.reset_mock()
+        self.tracer.sample_rate = 0.0
+        with self.tracer.span('get') as span:
+            self.assertEquals(
+                '0', trace_headers(span)[SAMPLED_HEADER])
+        self.assertFalse(self.exporter.export.called)
+
+    def test_child_span_without_trace(self):
+        """
+        Verify child_span does nothing outside of a traced request.
+        """
+        with child_span('ansible.run') as span:
+            self.assertIsNone(span)
+
+    def test_build_tracer(self):
+        """
+        Verify the tracing configuration picks the exporter.
+        """
+        self.assertIsNone(build_tracer('test', None).exporter)
+        tracer = build_tracer('test', {'file': '/tmp/spans', 'interval': 5})
+        self.assertIsInstance(tracer.exporter, FileSpanExporter)
+        self.assertEquals(5.0, tracer.exporter.interval)
+        self.assertRaises(ValueError, build_tracer, 'test', {'x': 1})
+
+
+class TestFileSpanExporter(TestCase):
+    """
+    Tests for the FileSpanExporter class.
+    """
+
+    def test_flush(self):
+        """
+        Verify spans are appended one JSON object per line.
+        """
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        exporter = FileSpanExporter(path)
+        tracer = Tracer('test')
+        for name in ('a', 'b'):
+            span = tracer.start_span(name)
+            span.finish()
+            exporter._buffer.append(span.to_zipkin())
+        exporter.flush()
+        exporter.flush()
+        with open(path) as spans:
+            self.assertEquals(
+                ['a', 'b'], [json.loads(x)['name'] for x in spans])
+
+
+class TestTracedService(TestCase):
+    """
+    Tests for tracing in CommissaireService.
+    """
+
+    def setUp(self):
+        for name in ('Connection', 'Exchange', 'Producer'):
+            patcher = mock.patch('commissaire_service.service.' + name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.service_instance = CommissaireService(
+            'commissaire',
+            'redis://127.0.0.1:6379/',
+            [{'name': 'simple', 'routing_key': 'simple.*'}]
+        )
+        self.service_instance._replies = mock.MagicMock()
+        self.exporter = mock.MagicMock()
+        self.service_instance._tracer.exporter = self.exporter
+
+    def test_nested_request_joins_the_trace(self):
+        """
+        Verify handler and nested request spans continue the caller's trace.
+        """
+        self.service_instance.on_lookup = lambda message: (
+            self.service_instance.request('storage.get', 'get'))
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'simple.lookup'},
+            headers={TRACE_HEADER: 'a' * 32, SPAN_HEADER: 'b' * 16})
+        with mock.patch.object(
+                self.service_instance, '_send_request') as _request:
+            _request.return_value = {'result': 'ok'}
+            self.service_instance.on_message(
+                {'jsonrpc': '2.0', 'id': '1', 'method': 'lookup'}, message)
+            headers = _request.call_args[1]['headers']
+
+        client, server = [
+            c[0][0] for c in self.exporter.export.call_args_list]
+        self.assertEquals(
+            (KIND_SERVER, 'lookup', 'b' * 16),
+            (server.kind, server.name, server.parent_id))
+        self.assertEquals(
+            (KIND_CLIENT, 'storage.get', server.span_id),
+            (client.kind, client.name, client.parent_id))
+        self.assertEquals('a' * 32, headers[TRACE_HEADER])
+        self.assertEquals(client.span_id, headers[SPAN_HEADER])
@@ -17,6 +17,7 @@ Tests for commissaire_service.service.watcher module.
 """
 
 import datetime
+import json
 
 from . import TestCase, mock
 
@@ -50,9 +51,9 @@ class TestCommissaireService(TestCase):
         )
 
     def tearDown(self):
-        self._connection.stop()
-        self._exchange.stop()
-        self._producer.stop()
+        self._connection_patcher.stop()
+        self._exchange_patcher.stop()
+        self._producer_patcher.stop()
 
     def test_on_message_with_success(self):
         """
@@ -114,6 +115,45 @@ class TestCommissaireService(TestCase):
             # We should have been asked to sleep
             _sleep.assert_called_once_with(mock.ANY)
 
+    def test_on_message_with_worker_pool(self):
+        """
+        Verify WatcherService checks on its pool and acks once done.
+        """
+        body = models.WatcherRecord(
+            address='127.0.0.1',
+            last_check=(datetime.datetime.utcnow() - datetime.timedelta(
+                    minutes=10)).isoformat())
+        message = mock.MagicMock(
+            payload=body.to_json(),
+            delivery_info={'routing_key': 'jobs.watcher'})
+
+        self.service_instance._use_worker_pool()
+        self.service_instance._lend_bus = mock.MagicMock()
+        self.service_instance._check = mock.MagicMock()
+        self.service_instance.on_message(body.to_json(), message)
+        self.service_instance._executor.shutdown(wait=True)
+        self.service_instance._check.assert_called_once_with('127.0.0.1')
+        self.assertEquals(0, message.ack.call_count)
+        self.service_instance.on_iteration()
+        message.ack.assert_called_once_with()
+
+    def test_on_message_with_ping(self):
+        """
+        Verify WatcherService answers health checks instead of checking.
+        """
+        self.service_instance._replies = mock.MagicMock()
+        self.service_instance._check = mock.MagicMock()
+        message = mock.MagicMock(
+            properties={'reply_to': 'test_queue'},
+            delivery_info={'routing_key': 'jobs.watcher.ping'})
+        self.service_instance.on_message(
+            {'jsonrpc': '2.0', 'id': '1', 'method': 'ping'}, message)
+        message.ack.assert_called_once_with()
+        self.assertEquals(0, self.service_instance._check.call_count)
+        reply = json.loads(
+            self.service_instance._replies.publish.call_args[0][0])
+        self.assertEquals('ok', reply['result']['status'])
+
     def test__check_with_no_errors(self):
         """
         Verify _check works in a perfect scenario.
@@ -123,13 +163,15 @@ class TestCommissaireService(TestCase):
             transport = _transport()
 
             self.service_instance.storage = mock.MagicMock()
-            self.service_instance.storage.get_host.return_value = models.Host.new(
-                address='127.0.0.1',
-                last_check=datetime.datetime.min.isoformat())
-            self.service_instance.storage.get.return_value = models.HostCreds.new(
-                address='127.0.0.1')
+            self.service_instance.get_models = mock.MagicMock(return_value=[
+                models.Host.new(
+                    address='127.0.0.1',
+                    last_check=datetime.datetime.min.isoformat()),
+                models.HostCreds.new(address='127.0.0.1')])
             self.service_instance.storage.save.return_value = None
             self.service_instance._check('127.0.0.1')
+            # Host and credentials are fetched in one batch
+            self.assertEquals(1, self.service_instance.get_models.call_count)
             # The transport method should have been called once
             self.assertEquals(1, transport.check_host_availability.call_count)
             # Verify 'storage.save' got called